@@ -1,5 +1,14 @@
 import ast, time
+import atexit
 import os
+import signal
+import sys
+import threading
+import hashlib
+from collections import namedtuple
+from contextlib import contextmanager
+
+import log_writer
 
 try:
     os.mkdir("data")
@@ -11,46 +20,286 @@ try:
 except:
     pass
 
+# бот обрабатывает символы в нескольких потоках — запись файлов сериализуем
+_file_lock = threading.RLock()
+
 title_log = f"{int(time.time() * 100000)}.txt"
 def saveLog(log):
     if "connection" not in str(log).lower():
-        f = open(f"data/logs/{title_log}", "a", encoding='utf-8')
-        info = f"{str(log)}\n"
-        f.write(info)
-        f.close()
+        log_writer.write(f"data/logs/{title_log}", str(log))
+
+SETTINGS_PATH = "data/settings.txt"
+_store = None
+
+
+def _state_store():
+    """Хранилище состояния; при первом запуске переносит в него старый settings.txt."""
+    global _store
+    with _file_lock:
+        if _store is None:
+            from state_store import StateStore
+            store = StateStore()
+            if store.meta("migrated") is None:
+                if store.is_empty() and os.path.exists(SETTINGS_PATH):
+                    try:
+                        with open(SETTINGS_PATH) as f:
+                            store.save(ast.literal_eval(f.read()))
+                    except (OSError, ValueError, SyntaxError) as e:
+                        print(f"[state] {SETTINGS_PATH} не перенесён: {e}")
+                store.set_meta("migrated", int(time.time()))
+            _store = store
+        return _store
+
 
 def getSettings():
     settings = {}
     try:
-        f = open("data/settings.txt")
-        settings = ast.literal_eval(f.read())
-        f.close()
+        settings = _state_store().load()
     except:
         pass
 
     return settings
 
+def _write_settings(settings, symbols=None):
+    with _file_lock:
+        # другой воркер может менять свой settings[symbol] прямо во время обхода — повторяем;
+        # в базу уходят только изменившиеся строки, одной транзакцией
+        for _ in range(5):
+            try:
+                return _state_store().save(settings, symbols)
+            except RuntimeError:
+                time.sleep(0.01)
+        return _state_store().save(settings, symbols)
+
+
+# Отложенная запись (включает бот): saveSettings только помечает символ «грязным»,
+# а пишется он в конце прохода по символу, по таймеру или при выходе из процесса
+STATE_FLUSH_SEC = float(os.getenv("STATE_FLUSH_SEC", "5"))
+STATE_FLUSH_SYMBOLS = int(os.getenv("STATE_FLUSH_SYMBOLS", "20"))
+
+_coalesce = False
+_local = threading.local()      # символ, который сейчас обрабатывает поток
+_pending = None                 # последний переданный в saveSettings словарь
+_dirty = set()
+_dirty_since = 0.0
+_stats = {"saves": 0, "flushes": 0}
+
+
+def coalesce_saves(enabled=True):
+    """Включает отложенную запись; несброшенное пишется при выходе (atexit и SIGTERM)."""
+    global _coalesce
+    _coalesce = enabled
+    if enabled and not _stats.get("atexit"):
+        _stats["atexit"] = True
+        atexit.register(flushSettings)
+        if threading.current_thread() is threading.main_thread() \
+                and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # чтобы отработал atexit
+
+
+@contextmanager
+def symbol_scope(symbol):
+    """Проход по символу: сохранения внутри копятся и пишутся одним разом на выходе."""
+    prev = getattr(_local, "symbol", None)
+    _local.symbol = symbol
+    try:
+        yield
+    finally:
+        _local.symbol = prev
+        flushSettings(symbol)
+
+
+def flushSettings(symbol=None):
+    """Пишет отложенные изменения: одного символа или все. Возвращает число записанных строк."""
+    global _dirty_since
+    with _file_lock:
+        if _pending is None or not _dirty:
+            return 0
+        if symbol is None:
+            symbols = set(_dirty)
+        elif symbol in _dirty:
+            symbols = {symbol}
+        else:
+            return 0
+        _dirty.difference_update(symbols)
+        if not _dirty:
+            _dirty_since = 0.0
+        _stats["flushes"] += 1
+        try:
+            return _write_settings(_pending, symbols)
+        except Exception:
+            _dirty.update(symbols)  # не записалось — попробуем при следующем сбросе
+            raise
+
+
 def saveSettings(settings):
-    f = open("data/settings.txt", "w")
-    f.write(str(settings))
-    f.close()
+    global _pending, _dirty_since
+    symbol = getattr(_local, "symbol", None)
+    if not _coalesce or symbol is None:
+        with _file_lock:
+            _dirty.clear()
+            _dirty_since = 0.0
+            return _write_settings(settings)
+    with _file_lock:
+        _stats["saves"] += 1
+        _pending = settings
+        _dirty.add(symbol)
+        _dirty_since = _dirty_since or time.time()
+        if len(_dirty) >= STATE_FLUSH_SYMBOLS or time.time() - _dirty_since >= STATE_FLUSH_SEC:
+            return flushSettings()
+    return 0
+
+
+def state_stats() -> dict:
+    """Сколько раз звали saveSettings в отложенном режиме и сколько раз реально писали."""
+    with _file_lock:
+        return {"saves": _stats["saves"], "flushes": _stats["flushes"], "dirty": len(_dirty),
+                "rows_written": _store.rows_written if _store else 0}
+
+COUPLES_PATH = "data/couples.txt"
+
+
+class Couple(dict):
+    """
+    Настройки пары из couples.txt. Остаётся dict (старый код читает couple["size"] и т.п.),
+    а проверенные поля доступны как атрибуты.
+    """
+
+    def __init__(self, key, raw):
+        if not isinstance(raw, dict):
+            raise ValueError(f"{key}: ожидается словарь, получено {type(raw).__name__}")
+        super().__init__(raw)
+        enable = str(self.get("enable") or "OFF").upper()
+        if enable not in ("ON", "OFF"):
+            raise ValueError(f"{key}: enable={self.get('enable')!r}")
+        self["enable"] = enable
+        self.setdefault("symbol", key)
+
+    @property
+    def symbol(self) -> str:
+        return self["symbol"]
+
+    @property
+    def enabled(self) -> bool:
+        return self["enable"] == "ON"
+
+    @property
+    def side(self) -> str:
+        return str(self.get("side") or "").lower()
+
+    @property
+    def size(self) -> int:
+        return int(float(self.get("size") or 0))
+
+    @property
+    def portfolio_limit(self) -> int:
+        return int(float(self.get("portfolio_limit") or 0))
+
+
+def _parse_couples(text):
+    return _validate_couples(ast.literal_eval(text) or {})
+
+
+def _validate_couples(raw_couples):
+    couples, errors = {}, []
+    for key, raw in raw_couples.items():
+        try:
+            couples[key] = Couple(key, raw)
+        except Exception as e:
+            errors.append(str(e))
+    return couples, errors
+
 
 def saveCouples(couples):
-    f = open("data/couples.txt", "w")
-    f.write(str(couples))
-    f.close()
+    # атомарно: читатель (бот/наблюдатель) не увидит наполовину записанный файл
+    with _file_lock:
+        f = open(COUPLES_PATH + ".tmp", "w")
+        f.write(str(couples))
+        f.close()
+        os.replace(COUPLES_PATH + ".tmp", COUPLES_PATH)
 
 def getCouples():
+    """
+    Пары из couples.txt как есть: панель правит и сохраняет весь словарь через saveCouples,
+    поэтому ничего не отбрасываем и не дописываем. Ошибки в парах только пишем в лог —
+    проверенные Couple получает бот через CouplesWatcher.
+    """
     settings = {}
     try:
-        f = open("data/couples.txt")
+        f = open(COUPLES_PATH)
         settings = ast.literal_eval(f.read())
         f.close()
     except:
         pass
 
+    try:
+        for err in _validate_couples(settings)[1]:
+            saveLog(f"couples.txt: ошибка в паре — {err}")
+    except Exception:
+        pass
+
     return settings
 
+
+CouplesDiff = namedtuple("CouplesDiff", "added removed changed")
+
+
+class CouplesWatcher:
+    """
+    Следит за couples.txt: stat (inode/mtime/size) на каждый poll, чтение и хэш — только если
+    stat изменился, разбор и проверка — только если изменилось содержимое.
+    poll() -> (couples, CouplesDiff); пустой diff — ничего не поменялось.
+    """
+
+    def __init__(self, path=COUPLES_PATH):
+        self.path = path
+        self._sig = None
+        self._hash = None
+        self.couples = {}
+        self.reloads = 0
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_ino, st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def changed(self) -> bool:
+        return self._stat() != self._sig
+
+    def poll(self):
+        empty = CouplesDiff(set(), set(), set())
+        sig = self._stat()
+        if sig == self._sig:
+            return self.couples, empty
+        try:
+            with open(self.path) as f:  # та же кодировка, что у saveCouples
+                data = f.read()
+        except OSError:
+            data = ""
+        digest = hashlib.sha1(data.encode("utf-8", "replace")).hexdigest()
+        self._sig = sig
+        if digest == self._hash:
+            return self.couples, empty
+        try:
+            new, errors = _parse_couples(data) if data.strip() else ({}, [])
+        except Exception as e:
+            saveLog(f"couples.txt не разобран: {e} — оставляем прежние пары")
+            return self.couples, empty
+        for err in errors:
+            saveLog(f"couples.txt: пара пропущена — {err}")
+        old = self.couples
+        diff = CouplesDiff(
+            added=set(new) - set(old),
+            removed=set(old) - set(new),
+            changed={k for k in set(new) & set(old) if new[k] != old[k]},
+        )
+        self._hash = digest
+        self.couples = new
+        self.reloads += 1
+        return new, diff
+
 def saveAPI(API):
     f = open("data/API.txt", "w")
     f.write(str(API))
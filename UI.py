@@ -3,7 +3,6 @@ from config import *
 from qUI import Ui_MainWindow
 import sys
 from PyQt5.QtWidgets import QTableWidgetItem, QCheckBox, QGroupBox, QLabel, QMdiArea
-import time
 import Settings
 
 from sys import exc_info
@@ -340,15 +339,14 @@ class MainWindow(QtWidgets.QMainWindow):
                 return
             orders = trading_api.get_orders(symbol)
 
-            total, ok = 0, 0
-            for o in orders:
-                total += 1
-                try:
-                    trading_api.cancel_order(o["order_id"])
+            # отмена пачкой (параллельно, в пределах лимитов API)
+            results = trading_api.cancel_orders_bulk(o["order_id"] for o in orders)
+            total, ok = len(results), 0
+            for oid, err in results.items():
+                if err is None:
                     ok += 1
-                    time.sleep(0.2)  # ваш «троттлинг»
-                except Exception as e:
-                    misc.send_msg(f"{symbol}: ошибка отмены {o.get('order_id')}: {e}")
+                else:
+                    misc.send_msg(f"{symbol}: ошибка отмены {oid}: {err}")
 
             misc.send_msg(f"{symbol}: отмена всех ордеров завершена: всего {total}, успешно {ok}")
 
@@ -395,15 +393,13 @@ class MainWindow(QtWidgets.QMainWindow):
 
             buy_orders = [o for o in orders if is_buy(o)]
 
-            total, ok = 0, 0
-            for o in buy_orders:
-                total += 1
-                try:
-                    trading_api.cancel_order(o["order_id"])
+            results = trading_api.cancel_orders_bulk(o["order_id"] for o in buy_orders)
+            total, ok = len(results), 0
+            for oid, err in results.items():
+                if err is None:
                     ok += 1
-                    time.sleep(0.2)  # небольшой троттлинг
-                except Exception as e:
-                    misc.send_msg(f"{symbol}: ошибка отмены BUY {o.get('order_id')}: {e}")
+                else:
+                    misc.send_msg(f"{symbol}: ошибка отмены BUY {oid}: {err}")
 
             misc.send_msg(f"{symbol}: отмена BUY ордеров завершена: всего {total}, успешно {ok}")
 
@@ -425,15 +421,13 @@ class MainWindow(QtWidgets.QMainWindow):
             orders = trading_api.get_orders(symbol)
             sell_orders = [o for o in orders if int(o.get("direction", 0)) == 2]
 
-            total, ok = 0, 0
-            for o in sell_orders:
-                total += 1
-                try:
-                    trading_api.cancel_order(o["order_id"])
+            results = trading_api.cancel_orders_bulk(o["order_id"] for o in sell_orders)
+            total, ok = len(results), 0
+            for oid, err in results.items():
+                if err is None:
                     ok += 1
-                    time.sleep(0.2)
-                except Exception as e:
-                    misc.send_msg(f"{symbol}: ошибка отмены SELL {o.get('order_id')}: {e}")
+                else:
+                    misc.send_msg(f"{symbol}: ошибка отмены SELL {oid}: {err}")
 
             misc.send_msg(f"{symbol}: отмена SELL ордеров завершена: всего {total}, успешно {ok}")
 
@@ -1,4 +1,5 @@
 import time
+import os
 import trading_api
 import misc
 import Settings
@@ -9,11 +10,31 @@ from decimal import Decimal
 from misc import check_and_build_sell_grid
 import datetime as _dt
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import DeadlineScheduler
+from grid_planner import GridPlanner
 
 
 def _now_msk():
     return _dt.datetime.utcnow() + _dt.timedelta(hours=3)
 
+# сколько секунд живут общие на цикл снимки активных заявок и портфеля счёта
+ORDERS_SNAPSHOT_TTL = float(os.environ.get("BOT_ORDERS_SNAPSHOT_TTL", "120"))
+PORTFOLIO_SNAPSHOT_TTL = float(os.environ.get("BOT_PORTFOLIO_SNAPSHOT_TTL", "120"))
+
+# потоковый режим: цены и сделки приходят push-ом, цикл просыпается сразу по исполнению
+STREAMING = os.environ.get("BOT_STREAMING", "0") == "1"
+STREAM_IDLE_SEC = float(os.environ.get("BOT_STREAM_IDLE_SEC", "60"))     # максимум ожидания события
+STREAM_PRICE_TTL = float(os.environ.get("BOT_STREAM_PRICE_TTL", "30"))   # цена из стрима считается свежей
+BOT_WORKERS = max(1, int(os.environ.get("BOT_WORKERS", "4")))  # сколько символов обрабатывать одновременно
+
+# периодичность обязанностей главного цикла (сек)
+BOT_CYCLE_SEC = float(os.environ.get("BOT_CYCLE_SEC", "60"))   # плановый проход по всем парам (как прежний sleep 60)
+STATUS_CHECK_SEC = 100      # проверка статуса торгов по символу (lastUpdStatusTrading)
+BROKER_SYNC_SEC = 30        # сверка удерживаемой позиции с брокером
+ERROR_BACKOFF_SEC = 60      # пауза символа после необработанной ошибки
+COUPLES_POLL_SEC = 2.0      # как часто во время простоя проверять couples.txt (только stat)
+
 # окна (МСК)
 _PRE_MID      = _dt.time(13, 57)
 _RESTORE_MID  = _dt.time(14, 5)
@@ -386,7 +407,7 @@ def tp_sell_grid_if_avg_lower(symbol: str, couple: dict):
 
 
 # Получаем информацию о символах (тикерах) и их параметрах с API Tinkoff
-figi = trading_api.get_figi()  # Функция из trading_api, которая запрашивает информацию о всех доступных инструментах
+figi = trading_api.figi  # Общий справочник инструментов из trading_api (кэш на диске, обновляется в фоне)
 # print(figi)  # Выводим данные о символах (например, "SBER", "USD000UTSTOM") для отладки
 
 def start_bot():
@@ -394,8 +415,20 @@ def start_bot():
     Главная функция бота. Здесь осуществляется управление торговлей для каждой пары символов.
     Бот отслеживает ордера, их статусы и цены, а также обновляет статус торговли для каждого символа.
     """
+    Settings.coalesce_saves()  # состояние пишется раз за проход по символу и при выходе
+    misc.import_order_cards()  # старые data/orders/*.json — в журнал до начала торговли, один раз
     settings = Settings.getSettings()  # Загружаем настройки бота из файла с настройками. Используется функция из модуля Settings, который читает настройки из 'data/settings.txt'
 
+    # один get_orders и один get_portfolio на весь цикл: дальше данные по символам берутся из снимков
+    trading_api.orders_snapshot.max_age = ORDERS_SNAPSHOT_TTL
+    trading_api.portfolio_cache.max_age = PORTFOLIO_SNAPSHOT_TTL
+
+    stream = None
+    if STREAMING:
+        stream = trading_api.start_stream()
+        trading_api.price_cache.max_age = STREAM_PRICE_TTL
+        misc.send_msg("потоковый режим: подписки на цены и сделки запущены")
+
     def _qprice(symbol: str, p: float) -> float:
         return misc.ToPriceStep(p, figi[symbol]["step"])
 
@@ -424,39 +457,36 @@ def start_bot():
             misc.send_msg(f"{symbol}: GAP↓ reseed: step_orders<=0 — пропуск")
             return 0
 
+        # headroom по брокеру — один раз на всю сетку
+        _, _, _, headroom = _headroom_from_broker(symbol, couple, limit_val)
+        if headroom <= 0:
+            misc.send_msg(f"{symbol}: GAP↓ reseed: headroom=0 — остановка")
+            return 0
+        size_i = min(int(float(couple["size"])), headroom)
+
+        # план: первый уровень строго НИЖЕ рынка, дальше — вниз лесенкой по свободным уровням
+        planner = GridPlanner(symbol, ticker, settings, step=figi_map[symbol]["step"])
+        step_down = lambda p: misc.WithoutPrice(p, step_val, figi_map[symbol])
+        if step_val.is_integer():
+            levels = planner.plan_ladder(px_now, int(step_val), -1, slots_to_add, size_i)
+        else:
+            levels = planner.plan(step_down(px_now), step_down, slots_to_add, size_i, max_shift=50)
+
+        # пассивные BUY ниже рынка — одной пачкой
         placed = 0
-        # первый уровень строго НИЖЕ рынка, дальше — вниз лесенкой
-        target = misc.WithoutPrice(px_now, step_val, figi_map[symbol])
-
-        for _ in range(slots_to_add):
-            # актуальный headroom перед каждой заявкой
-            _, _, _, headroom = _headroom_from_broker(symbol, couple, limit_val)
-            if headroom <= 0:
-                misc.send_msg(f"{symbol}: GAP↓ reseed: headroom=0 — остановка")
-                break
-            size_i = min(int(float(couple["size"])), headroom)
-
-            # гарантируем уникальность уровня
-            guard = 0
-            while not misc.is_price_level_free_combined(ticker, target, settings):
-                guard += 1
-                target = misc.WithoutPrice(target, step_val, figi_map[symbol])
-                if guard > 50:  # защита от «вечного» сдвига
-                    break
-
-            # пассивный BUY ниже рынка
-            ord_new = trading_api.long_limit(ticker, size_i, target)
-            misc.orderlog_init(str(ord_new["order_id"]), ticker, couple["side"], size_i, target,
+        for target, lots, ord_new, err in planner.place(levels, lambda lots, price: trading_api.long_limit(ticker, lots, price)):
+            if err is not None:
+                misc.send_msg(f"{symbol}: GAP↓ reseed: OPEN {target} не выставлен: {err}")
+                continue
+            misc.orderlog_init(str(ord_new["order_id"]), ticker, couple["side"], lots, target,
                                figi_map[symbol]["step"], "OPEN:GAP_DOWN_RESEED")
 
-            o = {"order_id": str(ord_new["order_id"]), "price": float(target), "size": int(size_i), "type": "open"}
+            o = {"order_id": str(ord_new["order_id"]), "price": float(target), "size": int(lots), "type": "open"}
             settings[symbol].setdefault("orders_open", {})[o["order_id"]] = o
+            misc.level_add(symbol, o["order_id"], o["price"])
             settings[symbol].setdefault("orders", []).append(o)
             placed += 1
 
-            # следующий уровень ещё ниже
-            target = misc.WithoutPrice(target, step_val, figi_map[symbol])
-
         if placed > 0:
             misc.send_msg(f"{symbol}: GAP↓ reseed: выставлено {placed} OPEN ниже рынка (из cap={slots_to_add})")
         return placed
@@ -483,7 +513,7 @@ def start_bot():
                 return True
         return False
 
-    def _sync_live_from_broker(symbol: str, couple: dict, settings: dict, period_sec: int = 30):
+    def _sync_live_from_broker(symbol: str, couple: dict, settings: dict, period_sec: int = BROKER_SYNC_SEC):
         st_sym = settings.setdefault(symbol, {})
         now = time.time()
         if now - float(st_sym.get("_last_sync_broker_held_ts", 0)) < period_sec:
@@ -517,6 +547,7 @@ def start_bot():
                 # фиксируем реальный финал
                 misc.orderlog_finish(oid, status_map[st])
                 settings[symbol][orders_key].pop(oid, None)
+                misc.level_discard(symbol, oid)
                 settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
                 misc.send_msg(f"{symbol}: {oid} уже финальный — {status_map[st]} (локально снят)")
                 return
@@ -526,813 +557,967 @@ def start_bot():
             trading_api.cancel_order(oid)
 
             # считаем успехом и чистим локально
-            misc.orderlog_event(oid, symbol, "CANCELED", "CANCEL", f"Отменён из {orders_key}")
-            misc.orderlog_finish(oid, "CANCELED")
-            settings[symbol][orders_key].pop(oid, None)
-            settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
-            misc.send_msg(f"{symbol} ордер отменён {order}")
+            _forget_canceled(order, orders_key, symbol)
 
         except Exception as e:
             misc.send_msg(f"{symbol}: отмена {order.get('order_id')} не удалась: {e} — повторим позже")
 
-    while True:
+    def _forget_canceled(order, orders_key, symbol):
+        """Локальная зачистка успешно отменённой заявки."""
+        oid = str(order["order_id"])
+        misc.orderlog_event(oid, symbol, "CANCELED", "CANCEL", f"Отменён из {orders_key}")
+        misc.orderlog_finish(oid, "CANCELED")
+        settings[symbol][orders_key].pop(oid, None)
+        misc.level_discard(symbol, oid)
+        settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
+        misc.send_msg(f"{symbol} ордер отменён {order}")
+
+    def cancel_orders_batch(items, symbol):
         """
-        Главный цикл бота, который работает бесконечно. Он проверяет каждую пару символов и выполняет операции с ордерами.
+        Отмена пачки [(order, orders_key), ...] одним параллельным заходом.
+        Неудачные — через cancel_order (проверит финальный статус и оставит на повтор).
         """
-        try:
-            # Загружаем пары символов из настроек
-            couples = Settings.getCouples()  # Использует функцию из Settings.py для загрузки пар из 'data/couples.txt'
-        except Exception as err:
-            # Если произошла ошибка при загрузке, логируем её
-            misc.send_msg([err, extract_tb(exc_info()[2])])
-
-        # Перебираем все символы и выполняем торговые операции для каждого
-        for symbol, couple in couples.items():
-            try:
-                if couple["enable"] == "ON":  # Если для символа торговля включена
-                    time.sleep(3)  # Задержка перед следующим действием
-
-                    ticker = couple["symbol"]  # Получаем тикер (символ) для торговли
-
-                    # Если символ ещё не существует в настройках, создаём его с начальными значениями
-                    if symbol not in settings.keys():
-                        settings[symbol] = get_settings()
-                        settings[symbol].setdefault("positions_no_tp", {})
-
-
-                    # (лимит посчитаем ПОСЛЕ обработки FILLED/REOPEN ниже)
-                    plimit = int(couple.get("portfolio_limit") or 0) or None
-                    settings[symbol]["_plimit_left"] = None
-
-                    now = _now_msk()
-                    t = now.time();
-                    today = now.date().isoformat()
-                    flags = settings[symbol].setdefault("_clearing_flags", {})
-
-                    snap_kind = None
-                    if _PRE_MID <= t < _dt.time(14, 0) and flags.get("mid_snap") != today:
-                        snap_kind = "mid"
-                    elif _PRE_EVE <= t < _dt.time(18, 45) and flags.get("eve_snap") != today:
-                        snap_kind = "eve"
-                    elif _PRE_NIGHT <= t < _NIGHT_START and flags.get("night_snap") != today:
-                        snap_kind = "night"
-
-                    if snap_kind:
-                        snap = {"ts": now.isoformat(), "orders": []}
-                        for key in ("orders_open", "orders_close"):
-                            for o in list(settings[symbol].get(key, {}).values()):
-                                typ = "open" if key == "orders_open" else "tp"
-                                pr = _qprice(symbol, float(o["price"]))
-                                sz = int(float(o["size"]))
-                                uid = str(o.get("order_id") or "")  # сохраняем исходный UID заявки брокера
-                                snap["orders"].append({"type": typ, "price": pr, "size": sz, "uid": uid})
-
-                                # отменяем пока торги идут (до клиринга)
-
-                                try:
-                                    cancel_order(o, key, symbol)
-                                except Exception as e:
-                                    misc.send_msg(f"{symbol}: предклиринг — отмена {o.get('order_id')} не удалась: {e}")
-
-                        settings[symbol]["_clearing_snapshot"] = snap
-                        if snap_kind == "mid":
-                            flags["mid_snap"] = today
-                        elif snap_kind == "eve":
-                            flags["eve_snap"] = today
-                        else:
-                            flags["night_snap"] = today
-
-                        Settings.saveSettings(settings)
-                        misc.send_msg(
-                            f"{symbol}: предклиринг({snap_kind}) — сохранено и отменено заявок: {len(snap['orders'])}")
-                        continue  # в эту итерацию по символу больше ничего не делаем
-
-                    snap = settings[symbol].get("_clearing_snapshot")
-                    yday = (now - _dt.timedelta(days=1)).date().isoformat()
-
-
-
-                        # перед циклом: уже проверяем, что статус = NormalTrading; иначе ждём и выходим из этого прохода
-                        side = (couple.get("side") or "").lower()
-                        restored = 0
-
-                        # --- ГЭП: закрываем КАЖДЫЙ перепрыгнутый TP по рынку,
-                        # но логируем с ИСХОДНОЙ TP-ценой уровня, чтобы REOPEN восстановился корректно
-                        try:
-                            px_now = float(trading_api.get_price(ticker))
-                        except Exception:
-                            px_now = None
-
-                        orders_to_restore = []
-                        tp_hit = []
-
-                        # 1) сначала набираем список восстановления с учётом перепрыгнутых TP
-                        if px_now is not None:
-                            for o in snap["orders"]:
-                                typ, pr, sz = o["type"], float(o["price"]), int(o["size"])
-                                if typ == "tp":
-                                    hit_long = (side == "long" and px_now >= pr)  # гэп вверх для long
-                                    hit_short = (side == "short" and px_now <= pr)  # гэп вниз  для short
-                                    if hit_long or hit_short:
-                                        tp_hit.append((pr, sz))
-                                        continue  # этот TP лимиткой НЕ восстанавливаем
-                                orders_to_restore.append(o)
-                        else:
-                            orders_to_restore = list(snap["orders"])
-
-                        # 2) затем — фильтр гэпа вниз для long: не восстанавливаем маркетабельные BUY
-                        gapdown_skipped_open = []
-                        if side == "long" and px_now is not None:
-                            new_restore = []
-                            for o in orders_to_restore:
-                                if o["type"] == "open" and px_now <= float(o["price"]):
-                                    gapdown_skipped_open.append(o)  # пропускаем эти OPEN
-                                else:
-                                    new_restore.append(o)
-                            orders_to_restore = new_restore
+        results = trading_api.cancel_orders_bulk(str(o["order_id"]) for o, _ in items)
+        for o, key in items:
+            if results.get(str(o["order_id"])) is None:
+                _forget_canceled(o, key, symbol)
+            else:
+                cancel_order(o, key, symbol)
 
-                        # 3) если были пропущенные OPEN — строим новую лестницу ниже рынка
-                        if gapdown_skipped_open:
-                            misc.send_msg(
-                                f"{symbol}: GAP↓ — пропущено {len(gapdown_skipped_open)} OPEN; перестраиваю сетку ниже рынка")
-                            try:
-                                _reseed_open_grid_after_gap_down_long(symbol, ticker, couple, settings, figi, px_now)
-                                broker_open = trading_api.get_orders(ticker) or []
-                                settings[symbol]["_last_broker_open_ids"] = [str(x["order_id"]) for x in broker_open]
-                            except Exception as e:
-                                misc.send_msg(f"{symbol}: GAP↓ reseed ошибка: {e}")
+    def _resolve_gone(symbol, ticker, orders_key, direction, live_ids):
+        """
+        Исходы заявок settings[symbol][orders_key], которых нет среди живых у брокера (live_ids),
+        одним trading_api.resolve_fills: {order_id: {"status", "price", "source"}}.
+        Время создания — из журнала ордеров: операции раньше заявки не её исполнение.
+        """
+        gone = [(str(k), o) for k, o in settings[symbol][orders_key].items() if str(k) not in live_ids]
+        if not gone:
+            return {}
+        created = misc.order_created_ts([k for k, _ in gone])
+        return trading_api.resolve_fills(ticker, [(k, direction, int(o["size"]), float(o["price"]), created.get(k))
+                                                  for k, o in gone])
+
+    def _process_symbol(symbol, couple):
+        """
+        Один проход конечного автомата по символу. Каждый символ за цикл обрабатывается
+        ровно одним воркером, поэтому settings[symbol] принадлежит ему до конца прохода;
+        запись файла настроек сериализована в Settings, темп запросов задаёт trading_api.limiter.
+        """
+        if time.time() < _backoff_until.get(symbol, 0):
+            return  # после ошибки символ отдыхает до своего дедлайна
+        try:
+            if couple["enable"] == "ON":  # Если для символа торговля включена
+                if BOT_WORKERS <= 1:
+                    time.sleep(3)  # Задержка перед следующим действием (последовательный режим)
+
+                ticker = couple["symbol"]  # Получаем тикер (символ) для торговли
+
+                # Если символ ещё не существует в настройках, создаём его с начальными значениями
+                if symbol not in settings.keys():
+                    settings[symbol] = get_settings()
+                    settings[symbol].setdefault("positions_no_tp", {})
+
+
+                # (лимит посчитаем ПОСЛЕ обработки FILLED/REOPEN ниже)
+                plimit = int(couple.get("portfolio_limit") or 0) or None
+                settings[symbol]["_plimit_left"] = None
+
+                now = _now_msk()
+                t = now.time();
+                today = now.date().isoformat()
+                flags = settings[symbol].setdefault("_clearing_flags", {})
+
+                snap_kind = None
+                if _PRE_MID <= t < _dt.time(14, 0) and flags.get("mid_snap") != today:
+                    snap_kind = "mid"
+                elif _PRE_EVE <= t < _dt.time(18, 45) and flags.get("eve_snap") != today:
+                    snap_kind = "eve"
+                elif _PRE_NIGHT <= t < _NIGHT_START and flags.get("night_snap") != today:
+                    snap_kind = "night"
+
+                if snap_kind:
+                    snap = {"ts": now.isoformat(), "orders": []}
+                    to_cancel = []
+                    for key in ("orders_open", "orders_close"):
+                        for o in list(settings[symbol].get(key, {}).values()):
+                            typ = "open" if key == "orders_open" else "tp"
+                            pr = _qprice(symbol, float(o["price"]))
+                            sz = int(float(o["size"]))
+                            uid = str(o.get("order_id") or "")  # сохраняем исходный UID заявки брокера
+                            snap["orders"].append({"type": typ, "price": pr, "size": sz, "uid": uid})
+                            to_cancel.append((o, key))
+
+                    # отменяем пока торги идут (до клиринга) — всей пачкой параллельно
+                    try:
+                        cancel_orders_batch(to_cancel, symbol)
+                    except Exception as e:
+                        misc.send_msg(f"{symbol}: предклиринг — пакетная отмена не удалась: {e}")
+
+                    settings[symbol]["_clearing_snapshot"] = snap
+                    if snap_kind == "mid":
+                        flags["mid_snap"] = today
+                    elif snap_kind == "eve":
+                        flags["eve_snap"] = today
+                    else:
+                        flags["night_snap"] = today
+
+                    Settings.saveSettings(settings)
+                    misc.send_msg(
+                        f"{symbol}: предклиринг({snap_kind}) — сохранено и отменено заявок: {len(snap['orders'])}")
+                    return  # в эту итерацию по символу больше ничего не делаем
 
+                snap = settings[symbol].get("_clearing_snapshot")
+                yday = (now - _dt.timedelta(days=1)).date().isoformat()
 
 
-                        if tp_hit:
-                            # закрываем от "лучшей" цены к "хуже" для наглядности в логах
-                            tp_hit.sort(reverse=(side == "long"))  # long: от более высокой цены вниз
 
-                            h
-                                # ВАЖНО: сохраняем ИСХОДНУЮ TP-цену уровня (pr), а не px_now
-                                misc.orderlog_init(str(r["order_id"]), ticker, couple["side"],
-                                                   lots, pr, figi[symbol]["step"], kind)
-                                o_mkt = {"order_id": r["order_id"], "price": pr, "size": lots, "type": "tp"}
-                                settings[symbol].setdefault("orders_close", {})[str(r["order_id"])] = o_mkt
-                                settings[symbol].setdefault("orders", []).append(o_mkt)
+                    # перед циклом: уже проверяем, что статус = NormalTrading; иначе ждём и выходим из этого прохода
+                    side = (couple.get("side") or "").lower()
+                    restored = 0
 
-                                misc.send_msg(
-                                    f"{symbol}: GAP {arrow} — закрыл по рынку {lots} лот(ов) @ {px_now} (TP {pr})")
-                                restored += 1
+                    # --- ГЭП: закрываем КАЖДЫЙ перепрыгнутый TP по рынку,
+                    # но логируем с ИСХОДНОЙ TP-ценой уровня, чтобы REOPEN восстановился корректно
+                    try:
+                        px_now = float(trading_api.get_price(ticker))
+                    except Exception:
+                        px_now = None
 
+                    orders_to_restore = []
+                    tp_hit = []
 
-                        for o in orders_to_restore:
+                    # 1) сначала набираем список восстановления с учётом перепрыгнутых TP
+                    if px_now is not None:
+                        for o in snap["orders"]:
                             typ, pr, sz = o["type"], float(o["price"]), int(o["size"])
-                            uid = str(o.get("uid") or "")  # берём сохранённый UID
-                            try:
-                                if side == "long":
-                                    if typ == "open":
-                                        r = trading_api.long_limit(ticker, sz, pr, client_order_id=uid if uid else None)
-                                        st = {"order_id": r["order_id"], "price": pr, "size": sz, "type": "open"}
-                                        settings[symbol].setdefault("orders_open", {})[str(r["order_id"])] = st
-                                    else:
-                                        r = trading_api.short_limit(ticker, sz, pr,
-                                                                    client_order_id=uid if uid else None)
-                                        st = {"order_id": r["order_id"], "price": pr, "size": sz, "type": "tp"}
-                                        settings[symbol].setdefault("orders_close", {})[str(r["order_id"])] = st
-
-                                        st = {"order_id": r["order_id"], "price": pr, "size": sz, "type": "tp"}
-                                        settings[symbol].setdefault("orders_close", {})[str(r["order_id"])] = st
-
-                                settings[symbol].setdefault("orders", []).append(st)
-                                restored += 1
-                            except Exception as e:
-                                misc.send_msg(f"{symbol}: постклиринг — ошибка восстановления {typ} {sz}@{pr}: {e}")
-
-                        # --- ПОСЛЕ цикла восстановления: один раз обновим список у брокера и проверим портфельный лимит
+                            if typ == "tp":
+                                hit_long = (side == "long" and px_now >= pr)  # гэп вверх для long
+                                hit_short = (side == "short" and px_now <= pr)  # гэп вниз  для short
+                                if hit_long or hit_short:
+                                    tp_hit.append((pr, sz))
+                                    continue  # этот TP лимиткой НЕ восстанавливаем
+                            orders_to_restore.append(o)
+                    else:
+                        orders_to_restore = list(snap["orders"])
+
+                    # 2) затем — фильтр гэпа вниз для long: не восстанавливаем маркетабельные BUY
+                    gapdown_skipped_open = []
+                    if side == "long" and px_now is not None:
+                        new_restore = []
+                        for o in orders_to_restore:
+                            if o["type"] == "open" and px_now <= float(o["price"]):
+                                gapdown_skipped_open.append(o)  # пропускаем эти OPEN
+                            else:
+                                new_restore.append(o)
+                        orders_to_restore = new_restore
+
+                    # 3) если были пропущенные OPEN — строим новую лестницу ниже рынка
+                    if gapdown_skipped_open:
+                        misc.send_msg(
+                            f"{symbol}: GAP↓ — пропущено {len(gapdown_skipped_open)} OPEN; перестраиваю сетку ниже рынка")
                         try:
-                            broker_open = trading_api.get_orders(ticker)
+                            _reseed_open_grid_after_gap_down_long(symbol, ticker, couple, settings, figi, px_now)
+                            broker_open = trading_api.get_orders(ticker) or []
                             settings[symbol]["_last_broker_open_ids"] = [str(x["order_id"]) for x in broker_open]
-                            ps_restore = trading_api.get_price(ticker)
-                            _enforce_portfolio_limit(symbol, couple, settings, ps_restore)
                         except Exception as e:
-                            misc.send_msg(f"{symbol}: post-RESTORE limit guard — {e}")
-
-
+                            misc.send_msg(f"{symbol}: GAP↓ reseed ошибка: {e}")
 
 
-                        # отметим «восстановлено» именно для того окна, которое сработало
-                        if restored > 0:
-                            if flags.get("mid_snap") == today and t >= _RESTORE_MID:
-                                flags["mid_restore"] = today
-                            if flags.get("eve_snap") == today and t >= _RESTORE_EVE:
-                                flags["eve_restore"] = today
-                            if flags.get("night_snap") == yday and t >= _RESTORE_MORNING:
-                                flags["morning_restore"] = today
-                            # снимок больше не нужен — всё (частично) восстановили
-                            settings[symbol].pop("_clearing_snapshot", None)
-                        else:
-                            misc.send_msg(
-                                f"{symbol}: восстановление отложено — восстановлено 0 заявок, снимок сохраняем")
-
-                        Settings.saveSettings(settings)
 
+                    if tp_hit:
+                        # закрываем от "лучшей" цены к "хуже" для наглядности в логах
+                        tp_hit.sort(reverse=(side == "long"))  # long: от более высокой цены вниз
 
-                    # Проверка времени последнего обновления статуса торговли
-                    if time.time() - settings[symbol]["lastUpdStatusTrading"] >= 100 or settings[symbol]["lastUpdStatusTrading"] == 0:
-                        settings[symbol]["lastUpdStatusTrading"] = time.time()  # Обновляем время последнего обновления
-
-                        # Проверяем статус торговли для этого символа
-                        if settings[symbol]["NormalTrading"]:
-                            status, status_code = trading_api.get_status_ticker(ticker)
-                            if status != "NormalTrading":
-                                # 1) отменяем ТОЛЬКО свои активные заявки через уже существующий helper cancel_order
+                        h
+                            # ВАЖНО: сохраняем ИСХОДНУЮ TP-цену уровня (pr), а не px_now
+                            misc.orderlog_init(str(r["order_id"]), ticker, couple["side"],
+                                               lots, pr, figi[symbol]["step"], kind)
+                            o_mkt = {"order_id": r["order_id"], "price": pr, "size": lots, "type": "tp"}
+                            settings[symbol].setdefault("orders_close", {})[str(r["order_id"])] = o_mkt
+                            misc.level_add(symbol, r["order_id"], o_mkt["price"])
+                            settings[symbol].setdefault("orders", []).append(o_mkt)
 
+                            misc.send_msg(
+                                f"{symbol}: GAP {arrow} — закрыл по рынку {lots} лот(ов) @ {px_now} (TP {pr})")
+                            restored += 1
 
-                                # 2) помечаем состояние клиринга и сбрасываем антидребезг
-                                settings[symbol]["NormalTrading"] = False
-                                settings[symbol]["_in_clearing"] = True
-                                settings[symbol]["_resume_cooldown_till"] = 0
-                                settings[symbol]["_clearing_entered_at"] = _dt.datetime.utcnow().isoformat() + "Z"
 
-                                misc.send_msg(f"{symbol} торговля остановлена (клиринг/перерыв): {status_code}")
-                                Settings.saveSettings(settings)
-                                continue
+                    for o in orders_to_restore:
+                        typ, pr, sz = o["type"], float(o["price"]), int(o["size"])
+                        uid = str(o.get("uid") or "")  # берём сохранённый UID
+                        try:
+                            if side == "long":
+                                if typ == "open":
+                                    r = trading_api.long_limit(ticker, sz, pr, client_order_id=uid if uid else None)
+                                    st = {"order_id": r["order_id"], "price": pr, "size": sz, "type": "open"}
+                                    settings[symbol].setdefault("orders_open", {})[str(r["order_id"])] = st
+                                    misc.level_add(symbol, r["order_id"], st["price"])
+                                else:
+                                    r = trading_api.short_limit(ticker, sz, pr,
+                                                                client_order_id=uid if uid else None)
+                                    st = {"order_id": r["order_id"], "price": pr, "size": sz, "type": "tp"}
+                                    settings[symbol].setdefault("orders_close", {})[str(r["order_id"])] = st
+                                    misc.level_add(symbol, r["order_id"], st["price"])
+
+                                    st = {"order_id": r["order_id"], "price": pr, "size": sz, "type": "tp"}
+                                    settings[symbol].setdefault("orders_close", {})[str(r["order_id"])] = st
+                                    misc.level_add(symbol, r["order_id"], st["price"])
+
+                            settings[symbol].setdefault("orders", []).append(st)
+                            restored += 1
+                        except Exception as e:
+                            misc.send_msg(f"{symbol}: постклиринг — ошибка восстановления {typ} {sz}@{pr}: {e}")
+
+                    # --- ПОСЛЕ цикла восстановления: один раз обновим список у брокера и проверим портфельный лимит
+                    try:
+                        broker_open = trading_api.get_orders(ticker)
+                        settings[symbol]["_last_broker_open_ids"] = [str(x["order_id"]) for x in broker_open]
+                        ps_restore = trading_api.get_price(ticker)
+                        _enforce_portfolio_limit(symbol, couple, settings, ps_restore)
+                    except Exception as e:
+                        misc.send_msg(f"{symbol}: post-RESTORE limit guard — {e}")
+
+
+
+
+                    # отметим «восстановлено» именно для того окна, которое сработало
+                    if restored > 0:
+                        if flags.get("mid_snap") == today and t >= _RESTORE_MID:
+                            flags["mid_restore"] = today
+                        if flags.get("eve_snap") == today and t >= _RESTORE_EVE:
+                            flags["eve_restore"] = today
+                        if flags.get("night_snap") == yday and t >= _RESTORE_MORNING:
+                            flags["morning_restore"] = today
+                        # снимок больше не нужен — всё (частично) восстановили
+                        settings[symbol].pop("_clearing_snapshot", None)
+                    else:
+                        misc.send_msg(
+                            f"{symbol}: восстановление отложено — восстановлено 0 заявок, снимок сохраняем")
 
+                    Settings.saveSettings(settings)
 
 
+                # Проверка времени последнего обновления статуса торговли
+                if time.time() - settings[symbol]["lastUpdStatusTrading"] >= STATUS_CHECK_SEC or settings[symbol]["lastUpdStatusTrading"] == 0:
+                    settings[symbol]["lastUpdStatusTrading"] = time.time()  # Обновляем время последнего обновления
 
-                        else:
+                    # Проверяем статус торговли для этого символа
+                    if settings[symbol]["NormalTrading"]:
+                        status, status_code = trading_api.get_status_ticker(ticker)
+                        if status != "NormalTrading":
+                            # 1) отменяем ТОЛЬКО свои активные заявки через уже существующий helper cancel_order
 
-                            status, status_code = trading_api.get_status_ticker(ticker)
 
-                            if status == "NormalTrading":
-                                settings[symbol]["NormalTrading"] = True
-                                settings[symbol]["_resume_cooldown_till"] = time.time() + 5
-                                settings[symbol]["_in_clearing"] = False
-                                Settings.saveSettings(settings)
-                                misc.send_msg(f"{symbol}: торговля возобновлена {status_code}")
+                            # 2) помечаем состояние клиринга и сбрасываем антидребезг
+                            settings[symbol]["NormalTrading"] = False
+                            settings[symbol]["_in_clearing"] = True
+                            settings[symbol]["_resume_cooldown_till"] = 0
+                            settings[symbol]["_clearing_entered_at"] = _dt.datetime.utcnow().isoformat() + "Z"
 
-                                continue
+                            misc.send_msg(f"{symbol} торговля остановлена (клиринг/перерыв): {status_code}")
+                            Settings.saveSettings(settings)
+                            return
 
 
-                    # --- брокерская защита лимита (истина у брокера)
-                    limit = int(couple.get("portfolio_limit") or 0)
 
-                    # 1) если ушли сверх лимита — режем «дальние» OPEN (включая вручную поставленные)
 
-                    ticker = couple.get("symbol") or symbol
-                    _cut_far_open_to_limit(symbol, couple, limit)
+                    else:
 
-                    # 2) свежий headroom — только лог! никаких size/ break здесь
-                    held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
-                    misc.send_msg(
-                        f"{symbol}: лимит={limit}, held={held_ss}, pending={pob}, headroom={headroom} "
-                        f"(ticker={couple.get('symbol') or symbol})"
-                    )
+                        status, status_code = trading_api.get_status_ticker(ticker)
 
+                        if status == "NormalTrading":
+                            settings[symbol]["NormalTrading"] = True
+                            settings[symbol]["_resume_cooldown_till"] = time.time() + 5
+                            settings[symbol]["_in_clearing"] = False
+                            Settings.saveSettings(settings)
+                            misc.send_msg(f"{symbol}: торговля возобновлена {status_code}")
 
-                    # Получаем цену для тикера
-                    price_s = trading_api.get_price(ticker)
+                            return
 
 
+                # --- брокерская защита лимита (истина у брокера)
+                limit = int(couple.get("portfolio_limit") or 0)
 
-                    check_and_build_sell_grid(symbol, ticker, couple, settings, price_s, figi)
+                # 1) если ушли сверх лимита — режем «дальние» OPEN (включая вручную поставленные)
 
-                    if settings[symbol]["status"] == "OFF":
-                        misc.send_msg(f"{symbol}: статус OFF, начинаем открытие позиции")
+                ticker = couple.get("symbol") or symbol
+                _cut_far_open_to_limit(symbol, couple, limit)
 
-                        # Округляем цену
-                        price = misc.ToPriceStep(price_s, figi[symbol]["step"])
+                # 2) свежий headroom — только лог! никаких size/ break здесь
+                held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
+                misc.send_msg(
+                    f"{symbol}: лимит={limit}, held={held_ss}, pending={pob}, headroom={headroom} "
+                    f"(ticker={couple.get('symbol') or symbol})"
+                )
 
-                        req = int(float(couple["size"]))
-                        held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
 
+                # Получаем цену для тикера
+                price_s = trading_api.get_price(ticker)
 
-                        if couple["side"] == "long":  # Открываем ордер на покупку
-                            misc.send_msg(f"{symbol}: отправка MARKET ордера на ПОКУПКУ (long) — объем: {size_open}")
-                            order = trading_api.long_market(ticker, size_open)
-                        else:  # "short"
-                            misc.send_msg(f"{symbol}: отправка MARKET ордера на ПРОДАЖУ (short) — объем: {size_open}")
-                            order = trading_api.short_market(ticker, size_open)
 
-                        misc.orderlog_init(str(order["order_id"]), ticker, couple["side"], size_open, price, figi[symbol]["step"], "OPEN:MARKET")
-                        o = {"order_id": order["order_id"], "price": price, "size": size_open, "type": "open"}
 
-                        settings[symbol]["orders_open"][str(order["order_id"])] = o
-                        settings[symbol]["orders"] = [o]
+                check_and_build_sell_grid(symbol, ticker, couple, settings, price_s, figi)
 
+                if settings[symbol]["status"] == "OFF":
+                    misc.send_msg(f"{symbol}: статус OFF, начинаем открытие позиции")
 
+                    # Округляем цену
+                    price = misc.ToPriceStep(price_s, figi[symbol]["step"])
 
-                        misc.send_msg(f"{symbol}: базовый ордер открыт, начинаем построение сетки")
+                    req = int(float(couple["size"]))
+                    held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
 
-                        price_open = price
 
+                    if couple["side"] == "long":  # Открываем ордер на покупку
+                        misc.send_msg(f"{symbol}: отправка MARKET ордера на ПОКУПКУ (long) — объем: {size_open}")
+                        order = trading_api.long_market(ticker, size_open)
+                    else:  # "short"
+                        misc.send_msg(f"{symbol}: отправка MARKET ордера на ПРОДАЖУ (short) — объем: {size_open}")
+                        order = trading_api.short_market(ticker, size_open)
 
-                        for i in range(slots_to_add):
-                            try:
-                                # актуальный headroom перед каждой заявкой
-                                _, _, _, headroom = _headroom_from_broker(symbol, couple, limit_val)
-                                if headroom <= 0:
-                                    misc.send_msg(f"{symbol}: headroom=0 — останавливаю построение сетки")
-                                    break
+                    misc.orderlog_init(str(order["order_id"]), ticker, couple["side"], size_open, price, figi[symbol]["step"], "OPEN:MARKET")
+                    o = {"order_id": order["order_id"], "price": price, "size": size_open, "type": "open"}
 
-                                size_i = min(int(float(couple["size"])), headroom)
+                    settings[symbol]["orders_open"][str(order["order_id"])] = o
+                    misc.level_add(symbol, order["order_id"], o["price"])
+                    settings[symbol]["orders"] = [o]
 
-                                # шаг цены
-                                if (couple.get("side") or "long").lower() == "long":
-                                    price_open = misc.WithoutPrice(price_open, couple["step_orders"], figi[symbol])
-                                else:
-                                    price_open = misc.WithPrice(price_open, couple["step_orders"], figi[symbol])
 
-                                # запрет дубликата уровня
-                                if not misc.is_price_level_free_combined(ticker, price_open, settings):
-                                    misc.send_msg(f"{symbol}: пропуск {price_open} — уровень уже занят")
-                                    continue
 
-                                # размещаем лимит
-                                order = (trading_api.long_limit if (couple.get("side") or "long").lower() == "long"
-                                         else trading_api.short_limit)(ticker, size_i, price_open)
+                    misc.send_msg(f"{symbol}: базовый ордер открыт, начинаем построение сетки")
 
+                    price_open = price
 
-                                else:
-                                    misc.send_msg([err, extract_tb(exc_info()[2])])
-                                    raise
 
-                        # после батча — подхватить id живых ордеров у брокера (для корректного pending в логах)
+                    for i in range(slots_to_add):
                         try:
-                            broker_open = trading_api.get_orders(ticker) or []
-                            settings[symbol]["_last_broker_open_ids"] = [str(x["order_id"]) for x in broker_open]
-                        except Exception:
-                            pass
+                            # актуальный headroom перед каждой заявкой
+                            _, _, _, headroom = _headroom_from_broker(symbol, couple, limit_val)
+                            if headroom <= 0:
+                                misc.send_msg(f"{symbol}: headroom=0 — останавливаю построение сетки")
+                                break
 
-                        settings[symbol]["status"] = "ON"
+                            size_i = min(int(float(couple["size"])), headroom)
 
+                            # шаг цены
+                            if (couple.get("side") or "long").lower() == "long":
+                                price_open = misc.WithoutPrice(price_open, couple["step_orders"], figi[symbol])
+                            else:
+                                price_open = misc.WithPrice(price_open, couple["step_orders"], figi[symbol])
 
-                        # 1) Текущие активные заявки у брокера
+                            # запрет дубликата уровня
+                            if not misc.is_price_level_free_combined(ticker, price_open, settings):
+                                misc.send_msg(f"{symbol}: пропуск {price_open} — уровень уже занят")
+                                continue
 
+                            # размещаем лимит
+                            order = (trading_api.long_limit if (couple.get("side") or "long").lower() == "long"
+                                     else trading_api.short_limit)(ticker, size_i, price_open)
 
-                    elif settings[symbol]["status"] == "ON":
 
-                        # 1) Какие заявки сейчас активны у брокера
+                            else:
+                                misc.send_msg([err, extract_tb(exc_info()[2])])
+                                raise
 
-                        open_orders = trading_api.get_orders(ticker)
+                    # после батча — подхватить id живых ордеров у брокера (для корректного pending в логах)
+                    try:
+                        broker_open = trading_api.get_orders(ticker) or []
+                        settings[symbol]["_last_broker_open_ids"] = [str(x["order_id"]) for x in broker_open]
+                    except Exception:
+                        pass
 
-                        open_orders_id = [str(oo["order_id"]) for oo in open_orders]  # строго строки
+                    settings[symbol]["status"] = "ON"
 
-                        settings[symbol]["_last_broker_open_ids"] = open_orders_id
 
-                        # копим только-что исполненные OPEN этого прохода, чтобы единым пакетом
-                        # поставить по ним TP-сетку от текущего рынка
-                        just_filled_open = []
+                    # 1) Текущие активные заявки у брокера
 
-                        # 2) OPEN -> FILLED => копим исполненные; TP-сетку ставим одним пакетом ОТ ТЕКУЩЕГО РЫНКА ниже
-                        for order_id, order in settings[symbol]["orders_open"].copy().items():
-                            oid = str(order_id)
 
-                            # если у брокера ордер ещё живой — пропускаем
-                            if oid in open_orders_id:
-                                continue
+                elif settings[symbol]["status"] == "ON":
+
+                    # 1) Какие заявки сейчас активны у брокера
 
-                            state = trading_api.get_orders_state(oid)
+                    open_orders = trading_api.get_orders(ticker)
 
-                            if state == 1:  # ===== FILLED =====
-                                misc.send_msg(f"{symbol} ордер на открытие исполнен {order['price']}")
-                                misc.orderlog_event(oid, ticker, "FILLED", "OPEN->FILLED",
-                                                    f"Исполнен по цене {order['price']}",
-                                                    extra={"fill_price": order["price"]})
-                                misc.orderlog_finish(oid, "FILLED")
+                    open_orders_id = [str(oo["order_id"]) for oo in open_orders]  # строго строки
 
-                                # нарастим живую позицию по стороне стратегии
-                                try:
-                                    st_sym = settings.setdefault(symbol, {})
-                                    st_sym["live_held_same_side"] = int(st_sym.get("live_held_same_side", 0)) + int(
-                                        order["size"])
-                                except Exception:
-                                    pass
+                    settings[symbol]["_last_broker_open_ids"] = open_orders_id
 
-                                # НЕ ставим TP сразу. Копим, чтобы одним блоком расставить от рынка.
-                                just_filled_open.append({"size": int(order["size"])})
+                    # копим только-что исполненные OPEN этого прохода, чтобы единым пакетом
+                    # поставить по ним TP-сетку от текущего рынка
+                    just_filled_open = []
 
-                                # убираем исполненный OPEN из локальных структур
-                                settings[symbol]["orders_open"].pop(oid, None)
-                                settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
+                    # направления заявок стратегии: OPEN по стороне, TP — обратно
+                    open_dir = 1 if (couple.get("side") or "").lower() == "long" else 2
+                    close_dir = 3 - open_dir
 
-                                # метка времени FILLED — пригодится для cooldown’ов
-                                settings[symbol]["_last_filled_ts"] = time.time()
+                    fills = _resolve_gone(symbol, ticker, "orders_open", open_dir, open_orders_id)
 
+                    # 2) OPEN -> FILLED => копим исполненные; TP-сетку ставим одним пакетом ОТ ТЕКУЩЕГО РЫНКА ниже
+                    for order_id, order in settings[symbol]["orders_open"].copy().items():
+                        oid = str(order_id)
 
-                            elif state in (2, 3, 6):  # ===== REJECTED / CANCELED / EXPIRED =====
-                                status_map = {2: "REJECTED", 3: "CANCELED", 6: "EXPIRED"}
-                                misc.orderlog_finish(oid, status_map[state])
-                                settings[symbol]["orders_open"].pop(oid, None)
-                                settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
-                                misc.send_msg(f"{symbol}: OPEN {oid} -> {status_map[state]} (удалён локально)")
+                        # если у брокера ордер ещё живой — пропускаем
+                        if oid in open_orders_id:
+                            continue
 
-                            # иначе — ничего, ждём следующего прохода
+                        fill = fills.get(oid) or {}
+                        state = fill.get("status")
 
+                        if state == 1:  # ===== FILLED =====
+                            trading_api.invalidate_portfolio()  # позиция изменилась
+                            fill_price = fill.get("price") or order["price"]
+                            misc.send_msg(f"{symbol} ордер на открытие исполнен {order['price']} (факт {fill_price})")
+                            misc.orderlog_event(oid, ticker, "FILLED", "OPEN->FILLED",
+                                                f"Исполнен по цене {fill_price}",
+                                                extra={"fill_price": fill_price, "limit_price": order["price"]})
+                            misc.orderlog_finish(oid, "FILLED")
 
-                        # если в этом проходе были исполнены OPEN — ставим TP-сетку от текущего рынка
-                        if just_filled_open:
+                            # нарастим живую позицию по стороне стратегии
                             try:
-                                last = float(trading_api.get_price(ticker))
+                                st_sym = settings.setdefault(symbol, {})
+                                st_sym["live_held_same_side"] = int(st_sym.get("live_held_same_side", 0)) + int(
+                                    order["size"])
                             except Exception:
-                                last = None
+                                pass
 
-                            if last is not None:
-                                side = (couple.get("side") or "").lower()
+                            # НЕ ставим TP сразу. Копим, чтобы одним блоком расставить от рынка.
+                            just_filled_open.append({"size": int(order["size"])})
 
-                                # --- здесь переводим TP и step_orders из "шагов" в "деньги"
-                                step_size = float(figi[symbol]["step"])  # минимальный шаг цены инструмента
-                                tp_val = float(couple.get("TP") or 0) * step_size
-                                step_val = float(couple.get("step_orders") or 0) * step_size
+                            # убираем исполненный OPEN из локальных структур
+                            settings[symbol]["orders_open"].pop(oid, None)
+                            misc.level_discard(symbol, oid)
+                            settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
 
-                                # БАЗОВЫЙ уровень: рынок ± TP (в деньгах)
-                                if side == "long":
-                                    # long: продаём выше рынка
-                                    base = misc.WithPrice(last, tp_val, figi[symbol])  # рынок + TP
-                                    step_move = lambda p, k: misc.WithPrice(p, k * step_val, figi[symbol])
+                            # метка времени FILLED — пригодится для cooldown’ов
+                            settings[symbol]["_last_filled_ts"] = time.time()
 
-                                else:
-                                    # short: выкупаем ниже рынка
-                                    base = misc.WithoutPrice(last, tp_val, figi[symbol])  # рынок − TP
 
+                        elif state in (2, 3, 6):  # ===== REJECTED / CANCELED / EXPIRED =====
+                            status_map = {2: "REJECTED", 3: "CANCELED", 6: "EXPIRED"}
+                            misc.orderlog_finish(oid, status_map[state])
+                            settings[symbol]["orders_open"].pop(oid, None)
+                            misc.level_discard(symbol, oid)
+                            settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
+                            misc.send_msg(f"{symbol}: OPEN {oid} -> {status_map[state]} (удалён локально)")
 
-                                # сетка: первый TP — base, далее base ± step * i
-                                for i, f in enumerate(just_filled_open):
-                                    target = base if i == 0 else step_move(base, i)
+                        # иначе — ничего, ждём следующего прохода
 
-                                    # если уровень занят — сдвигаемся ещё на шаги, чтобы не конфликтовать
-                                    guard = 0
-                                    while not misc.is_price_level_free_combined(ticker, target, settings):
-                                        guard += 1
 
-
-                                    ord_tp = place_tp(int(f["size"]), float(target))
-                                    misc.orderlog_init(
-                                        str(ord_tp["order_id"]), ticker, couple["side"],
-                                        int(f["size"]), float(target), figi[symbol]["step"], "TP:MARKET_GRID"
-                                    )
-                                    o_tp = {
-                                        "order_id": str(ord_tp["order_id"]),
-                                        "price": float(target),
-                                        "size": int(f["size"]),
-                                        "type": "tp"
-                                    }
-
-                                    settings[symbol].setdefault("orders", []).append(o_tp)
-
-                                misc.send_msg(
-                                    f"{symbol}: TP-сетка от рынка выставлена: base={base}, шаг={step_val}, пакетов={len(just_filled_open)}"
-                                )
-                            else:
-                                misc.send_msg(f"{symbol}: не удалось получить last для TP-сетки — пропуск")
-
-                        # --- AUTO TOP-UP OPEN: если headroom вырос (в т.ч. из-за ручной продажи) — докладываем недостающие OPEN
+                    # если в этом проходе были исполнены OPEN — ставим TP-сетку от текущего рынка
+                    if just_filled_open:
                         try:
-                            limit_val = int(couple.get("portfolio_limit") or 0)
+                            last = float(trading_api.get_price(ticker))
                         except Exception:
-                            limit_val = 0
-
-
-                        to_place = max(0, slots_needed - cur_open_slots)
+                            last = None
 
-                        if to_place > 0:
-                            side = (couple.get("side") or "long").lower()
-                            size_lot = max(1, int(float(couple.get("size") or 1)))
+                        if last is not None:
+                            side = (couple.get("side") or "").lower()
 
-                            opens = list(settings[symbol].get("orders_open", {}).values())
-                            closes = list(settings[symbol].get("orders_close", {}).values())
+                            # --- здесь переводим TP и step_orders из "шагов" в "деньги"
+                            step_size = float(figi[symbol]["step"])  # минимальный шаг цены инструмента
+                            tp_val = float(couple.get("TP") or 0) * step_size
+                            step_val = float(couple.get("step_orders") or 0) * step_size
 
+                            # БАЗОВЫЙ уровень: рынок ± TP (в деньгах)
                             if side == "long":
-                                # стартовая база: ниже самой дальней нашей лимитки; если нет — от самого низкого TP − TP; иначе — от рынка вниз
-                                if opens:
-                                    base = min(float(o["price"]) for o in opens)
-                                elif closes:
-                                    base = float(misc.WithoutPrice(min(float(o["price"]) for o in closes), couple["TP"],
-                                                                   figi[symbol]))
+                                # long: продаём выше рынка
+                                base = misc.WithPrice(last, tp_val, figi[symbol])  # рынок + TP
+                                step_move = lambda p, k: misc.WithPrice(p, k * step_val, figi[symbol])
 
                             else:
-                                # short: выше самой дальней лимитки; если нет — от самого высокого TP + TP; иначе — от рынка вверх
-                                if opens:
-                                    base = max(float(o["price"]) for o in opens)
-                                elif closes:
-                                    base = float(misc.WithPrice(max(float(o["price"]) for o in closes), couple["TP"],
-                                                                figi[symbol]))
-                                else:
-                                    base = float(misc.WithPrice(float(price_s), couple["step_orders"], figi[symbol]))
-                                step_fn = lambda p: misc.WithPrice(p, couple["step_orders"], figi[symbol])
-                                place_fn = lambda lots, price: trading_api.short_limit(ticker, lots, price)
+                                # short: выкупаем ниже рынка
+                                base = misc.WithoutPrice(last, tp_val, figi[symbol])  # рынок − TP
 
-                            placed = 0
-                            for _ in range(to_place):
-                                # актуализируем headroom каждый раз
-                                _, _, _, headroom_now = _headroom_from_broker(symbol, couple, limit_val)
-                                if headroom_now <= 0:
-                                    break
-                                lots_i = min(size_lot, headroom_now)
-
-                                target = base
+
+                            # сетка: первый TP — base, далее base ± step * i
+                            for i, f in enumerate(just_filled_open):
+                                target = base if i == 0 else step_move(base, i)
+
+                                # если уровень занят — сдвигаемся ещё на шаги, чтобы не конфликтовать
                                 guard = 0
                                 while not misc.is_price_level_free_combined(ticker, target, settings):
-                                    base = step_fn(base)
-                                    target = base
                                     guard += 1
-                                    if guard > 100:
-                                        break
-                                if guard > 100:
-                                    misc.send_msg(f"{symbol}: AUTO TOP-UP — не нашли свободный уровень, остановка")
-                                    break
 
-                                ord_new = place_fn(int(lots_i), float(target))
+
+                                ord_tp = place_tp(int(f["size"]), float(target))
                                 misc.orderlog_init(
-                                    str(ord_new["order_id"]), ticker, couple["side"],
-                                    int(lots_i), float(target), figi[symbol]["step"], "OPEN:AUTOTOPUP"
+                                    str(ord_tp["order_id"]), ticker, couple["side"],
+                                    int(f["size"]), float(target), figi[symbol]["step"], "TP:MARKET_GRID"
                                 )
-                                o = {"order_id": str(ord_new["order_id"]), "price": float(target), "size": int(lots_i),
-                                     "type": "open"}
-                                settings[symbol].setdefault("orders_open", {})[o["order_id"]] = o
-                                settings[symbol].setdefault("orders", []).append(o)
-                                placed += 1
+                                o_tp = {
+                                    "order_id": str(ord_tp["order_id"]),
+                                    "price": float(target),
+                                    "size": int(f["size"]),
+                                    "type": "tp"
+                                }
 
-                                # следующий уровень для следующего слота
-                                base = step_fn(base)
+                                settings[symbol].setdefault("orders", []).append(o_tp)
 
-                            if placed:
-                                misc.send_msg(
-                                    f"{symbol}: AUTO TOP-UP — добавлено OPEN: {placed} шт (slots_needed={slots_needed}, было={cur_open_slots})")
+                            misc.send_msg(
+                                f"{symbol}: TP-сетка от рынка выставлена: base={base}, шаг={step_val}, пакетов={len(just_filled_open)}"
+                            )
+                        else:
+                            misc.send_msg(f"{symbol}: не удалось получить last для TP-сетки — пропуск")
 
+                    # --- AUTO TOP-UP OPEN: если headroom вырос (в т.ч. из-за ручной продажи) — докладываем недостающие OPEN
+                    try:
+                        limit_val = int(couple.get("portfolio_limit") or 0)
+                    except Exception:
+                        limit_val = 0
 
-                        # 3) TP -> FILLED => ставим новый OPEN (уровень уникален)
 
-                        # 3) TP -> FILLED / REJECTED / CANCELED / EXPIRED
-                        for order_id, order in settings[symbol]["orders_close"].copy().items():
-                            oid = str(order_id)
+                    to_place = max(0, slots_needed - cur_open_slots)
 
-                            # TP ещё жив у брокера — ждём
-                            if oid in open_orders_id:
-                                continue
+                    if to_place > 0:
+                        side = (couple.get("side") or "long").lower()
+                        size_lot = max(1, int(float(couple.get("size") or 1)))
 
-                            state = trading_api.get_orders_state(oid)
+                        opens = list(settings[symbol].get("orders_open", {}).values())
+                        closes = list(settings[symbol].get("orders_close", {}).values())
 
-                            if state == 1:  # ===== TP FILLED =====
-                                misc.send_msg(f"{symbol} ордер на закрытие исполнен {order['price']}")
-                                misc.orderlog_event(oid, ticker, "FILLED", "TP->FILLED",
-                                                    f"TP исполнен по цене {order['price']}")
-                                misc.orderlog_finish(oid, "FILLED")
+                        if side == "long":
+                            # стартовая база: ниже самой дальней нашей лимитки; если нет — от самого низкого TP − TP; иначе — от рынка вниз
+                            if opens:
+                                base = min(float(o["price"]) for o in opens)
+                            elif closes:
+                                base = float(misc.WithoutPrice(min(float(o["price"]) for o in closes), couple["TP"],
+                                                               figi[symbol]))
 
-                                # уменьшаем живую позицию
-                                st_sym = settings.setdefault(symbol, {})
-                                try:
-                                    st_sym["live_held_same_side"] = max(
-                                        0, int(st_sym.get("live_held_same_side", 0)) - int(order["size"])
-                                    )
-                                except Exception:
-                                    pass
-
-                                # считаем REOPEN-уровень относительно цены TP
-                                side = (couple.get("side") or "").lower()
-
-                                step_size = float(figi[symbol]["step"])
-                                tp_val = float(couple.get("TP") or 0) * step_size  # TP в деньгах
-
-                                if side == "long":
-                                    price = misc.WithoutPrice(order["price"], tp_val, figi[symbol])
-                                    place = lambda sz: trading_api.long_limit(ticker, sz, price)
-                                else:
-                                    price = misc.WithPrice(order["price"], tp_val, figi[symbol])
-                                    place = lambda sz: trading_api.short_limit(ticker, sz, price)
-
-                                # уровень свободен?
-                                if not misc.is_price_level_free_combined(ticker, price, settings):
-                                    cur = trading_api.get_price(ticker)
-                                    misc.send_msg(
-                                        f"{symbol}: OPEN {price} пропущен — уровень занят (REOPEN; рынок {cur})")
-                                else:
-                                    # headroom по брокеру
-                                    held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
-                                    if headroom > 0:
-                                        size_reopen = min(int(order["size"]), headroom)
-                                        if size_reopen > 0:
-                                            ord_new = place(size_reopen)
-                                            misc.orderlog_init(str(ord_new["order_id"]), ticker, couple["side"],
-                                                               size_reopen, price, figi[symbol]["step"], "OPEN:LIMIT")
-                                            o = {"order_id": str(ord_new["order_id"]), "price": price,
-                                                 "size": size_reopen, "type": "open"}
-                                            settings[symbol]["orders_open"][o["order_id"]] = o
-                                            settings[symbol]["orders"].append(o)
-                                            misc.send_msg(f"{symbol} выставлен ордер на открытие {price} {size_reopen}")
-                                            open_orders_id.append(str(ord_new["order_id"]))  # только str!
-
-                                # TP удаляем из локальных структур
-                                settings[symbol]["orders_close"].pop(oid, None)
-                                settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
-
-                            elif state in (2, 3, 6):  # ===== TP REJECTED/CANCELED/EXPIRED =====
-                                status_map = {2: "REJECTED", 3: "CANCELED", 6: "EXPIRED"}
-                                misc.orderlog_finish(oid, status_map[state])
-                                settings[symbol]["orders_close"].pop(oid, None)
-                                settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
-                                misc.send_msg(f"{symbol}: TP {oid} -> {status_map[state]} (удалён локально)")
-                                # иначе — ничего, ждём
-
-
-                        # если есть сохранённый снимок клиринга — ничего с сеткой не делаем
-                        if settings[symbol].get("_clearing_snapshot"):
+                        else:
+                            # short: выше самой дальней лимитки; если нет — от самого высокого TP + TP; иначе — от рынка вверх
+                            if opens:
+                                base = max(float(o["price"]) for o in opens)
+                            elif closes:
+                                base = float(misc.WithPrice(max(float(o["price"]) for o in closes), couple["TP"],
+                                                            figi[symbol]))
+                            else:
+                                base = float(misc.WithPrice(float(price_s), couple["step_orders"], figi[symbol]))
+                            step_fn = lambda p: misc.WithPrice(p, couple["step_orders"], figi[symbol])
+                            place_fn = lambda lots, price: trading_api.short_limit(ticker, lots, price)
+
+                        placed = 0
+                        # один снимок: headroom и занятые уровни; план целиком, затем пачка заявок
+                        _, _, _, headroom_now = _headroom_from_broker(symbol, couple, limit_val)
+                        levels = []
+                        if headroom_now > 0:
+                            planner = GridPlanner(symbol, ticker, settings, step=figi[symbol]["step"])
+                            levels = planner.plan(base, step_fn, to_place, min(size_lot, headroom_now))
+                            if planner.exhausted:
+                                misc.send_msg(f"{symbol}: AUTO TOP-UP — не нашли свободный уровень, остановка")
+
+                        for target, lots_i, ord_new, err in (planner.place(levels, place_fn) if levels else []):
+                            if err is not None:
+                                misc.send_msg(f"{symbol}: AUTO TOP-UP — OPEN {target} не выставлен: {err}")
+                                continue
+                            misc.orderlog_init(
+                                str(ord_new["order_id"]), ticker, couple["side"],
+                                int(lots_i), float(target), figi[symbol]["step"], "OPEN:AUTOTOPUP"
+                            )
+                            o = {"order_id": str(ord_new["order_id"]), "price": float(target), "size": int(lots_i),
+                                 "type": "open"}
+                            settings[symbol].setdefault("orders_open", {})[o["order_id"]] = o
+                            misc.level_add(symbol, o["order_id"], o["price"])
+                            settings[symbol].setdefault("orders", []).append(o)
+                            placed += 1
+
+                        if placed:
                             misc.send_msg(
-                                f"{symbol}: клиринг — пропускаем regrid/перезапуск до восстановления по снимку")
-                            continue
+                                f"{symbol}: AUTO TOP-UP — добавлено OPEN: {placed} шт (slots_needed={slots_needed}, было={cur_open_slots})")
 
-                        # 4) Если остались только OPEN — перезапуск сетки
-                        if not settings[symbol]["orders_close"]:
-                            # если только что были FILLED — даём системе стабилизироваться
-                            if time.time() - settings[symbol].get("_last_filled_ts", 0) < 10:
-                                misc.send_msg(f"{symbol}: FILLED недавно — пропускаем regrid в течение 10с")
-                                continue
 
-                            misc.send_msg(
-                                f"{symbol}: в сетке остались только ордера на открытие — отменяем и пересоздаём")
-                            cancel_only_own_orders_local(symbol, ticker)
+                    # 3) TP -> FILLED => ставим новый OPEN (уровень уникален)
 
-                            # Сохраняем важные поля перед сбросом
-                            _no_tp = settings[symbol].get("positions_no_tp", {})
-                            _held_ss = int(settings[symbol].get("live_held_same_side", 0))
+                    # 3) TP -> FILLED / REJECTED / CANCELED / EXPIRED
+                    fills = _resolve_gone(symbol, ticker, "orders_close", close_dir, open_orders_id)
 
-                            # Сбрасываем, но восстанавливаем сохранённое
-                            settings[symbol] = get_settings()
-                            settings[symbol]["positions_no_tp"] = _no_tp
-                            settings[symbol]["live_held_same_side"] = _held_ss
+                    for order_id, order in settings[symbol]["orders_close"].copy().items():
+                        oid = str(order_id)
 
-                            misc.send_msg(
-                                f"{symbol}: перезапуск сетки. Позиции без TP сохранены: {list(_no_tp.keys()) or '-'}; "
-                                f"held_same_side={_held_ss}")
+                        # TP ещё жив у брокера — ждём
+                        if oid in open_orders_id:
                             continue
 
-                        # 5) Если остались только TP — перестраиваем сетку
-                        if not settings[symbol]["orders_open"]:
-                            # --- REGRID cooldown: не дёргаем перестройку слишком часто
-                            now_ts = time.time()
-                            next_try_at = settings[symbol].get("_regrid_next_try_at", 0)
-                            if now_ts < next_try_at:
-                                continue  # ждём окончание кулдауна
-
-                            # --- REGRID gate: пробуем перестраивать только если рынок сдвинулся хотя бы на step_orders
-                            price_s = trading_api.get_price(ticker)
-                            move_step = float(couple.get("step_orders") or 0)
-                            last_mkt = settings[symbol].get("_regrid_last_mkt")
-                            if last_mkt is not None and move_step > 0:
-                                if abs(float(price_s) - float(last_mkt)) < move_step:
-                                    settings[symbol]["_regrid_next_try_at"] = now_ts + 10  # короткий кулдаун
-                                    continue
+                        fill = fills.get(oid) or {}
+                        state = fill.get("status")
 
-                            # фиксируем «рынок на момент попытки»
-                            settings[symbol]["_regrid_last_mkt"] = float(price_s)
+                        if state == 1:  # ===== TP FILLED =====
+                            trading_api.invalidate_portfolio()  # позиция изменилась
+                            fill_price = fill.get("price") or order["price"]
+                            misc.send_msg(f"{symbol} ордер на закрытие исполнен {order['price']} (факт {fill_price})")
+                            misc.orderlog_event(oid, ticker, "FILLED", "TP->FILLED",
+                                                f"TP исполнен по цене {fill_price}",
+                                                extra={"fill_price": fill_price, "limit_price": order["price"]})
+                            misc.orderlog_finish(oid, "FILLED")
 
-                            # --- считаем, можем ли поставить ЕЩЁ ОДНУ сетку с учётом лимита портфеля
-                            portfolio_lim = int(
-                                (couple.get("portfolio_limit") or 0) or (settings[symbol].get("portfolio_limit") or 0)
-                            )
-                            slots_to_add = _grid_slots_for_new_layer(symbol, couple, portfolio_lim)
-                            if slots_to_add <= 0:
-                                settings[symbol]["_regrid_next_try_at"] = time.time() + 10
-                                misc.send_msg(
-                                    f"{symbol}: GRID_CAP=0 — перестроение пропущено (нет места для новой сетки относительно лимита портфеля)"
+                            # уменьшаем живую позицию
+                            st_sym = settings.setdefault(symbol, {})
+                            try:
+                                st_sym["live_held_same_side"] = max(
+                                    0, int(st_sym.get("live_held_same_side", 0)) - int(order["size"])
                                 )
-                                continue
-
-                            # Базовые ордера в TP-части
-                            max_order = misc.get_max_order(settings[symbol]["orders"])
-                            min_order = misc.get_min_order(settings[symbol]["orders"])
+                            except Exception:
+                                pass
 
-                            # Универсальный расчёт цены нового OPEN:
-                            #   long  -> ставим BUY ниже минимума TP на TP (фактически ниже последнего проданного)
-                            #   short -> ставим SELL выше максимума TP на TP
+                            # считаем REOPEN-уровень относительно цены TP
                             side = (couple.get("side") or "").lower()
 
                             step_size = float(figi[symbol]["step"])
-                            tp_val = float(couple.get("TP") or 0) * step_size
-                            step_val = float(couple.get("step_orders") or 0) * step_size
+                            tp_val = float(couple.get("TP") or 0) * step_size  # TP в деньгах
 
                             if side == "long":
-                                target_price = misc.WithoutPrice(min_order["price"], tp_val, figi[symbol])
-                                place_ok = (price_s > target_price)
-                                base_step_fn = lambda p: misc.WithoutPrice(p, step_val, figi[symbol])
+                                price = misc.WithoutPrice(order["price"], tp_val, figi[symbol])
+                                place = lambda sz: trading_api.long_limit(ticker, sz, price)
                             else:
-                                target_price = misc.WithPrice(max_order["price"], tp_val, figi[symbol])
-                                place_ok = (price_s < target_price)
-                                base_step_fn = lambda p: misc.WithPrice(p, step_val, figi[symbol])
+                                price = misc.WithPrice(order["price"], tp_val, figi[symbol])
+                                place = lambda sz: trading_api.short_limit(ticker, sz, price)
 
-                            # headroom по брокеру (на всякий случай ещё раз перед самой постановкой)
-                            held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, portfolio_lim)
-                            if headroom <= 0:
-                                misc.send_msg(f"{symbol}: REGRID отменён — headroom=0")
-                                settings[symbol]["_regrid_next_try_at"] = time.time() + 10
-                                continue
+                            # уровень свободен?
+                            if not misc.is_price_level_free_combined(ticker, price, settings):
+                                cur = trading_api.get_price(ticker)
+                                misc.send_msg(
+                                    f"{symbol}: OPEN {price} пропущен — уровень занят (REOPEN; рынок {cur})")
+                            else:
+                                # headroom по брокеру
+                                held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
+                                if headroom > 0:
+                                    size_reopen = min(int(order["size"]), headroom)
+                                    if size_reopen > 0:
+                                        ord_new = place(size_reopen)
+                                        misc.orderlog_init(str(ord_new["order_id"]), ticker, couple["side"],
+                                                           size_reopen, price, figi[symbol]["step"], "OPEN:LIMIT")
+                                        o = {"order_id": str(ord_new["order_id"]), "price": price,
+                                             "size": size_reopen, "type": "open"}
+                                        settings[symbol]["orders_open"][o["order_id"]] = o
+                                        misc.level_add(symbol, o["order_id"], o["price"])
+                                        settings[symbol]["orders"].append(o)
+                                        misc.send_msg(f"{symbol} выставлен ордер на открытие {price} {size_reopen}")
+                                        open_orders_id.append(str(ord_new["order_id"]))  # только str!
+
+                            # TP удаляем из локальных структур
+                            settings[symbol]["orders_close"].pop(oid, None)
+                            misc.level_discard(symbol, oid)
+                            settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
+
+                        elif state in (2, 3, 6):  # ===== TP REJECTED/CANCELED/EXPIRED =====
+                            status_map = {2: "REJECTED", 3: "CANCELED", 6: "EXPIRED"}
+                            misc.orderlog_finish(oid, status_map[state])
+                            settings[symbol]["orders_close"].pop(oid, None)
+                            misc.level_discard(symbol, oid)
+                            settings[symbol]["orders"] = misc.del_order_list(settings[symbol]["orders"], oid)
+                            misc.send_msg(f"{symbol}: TP {oid} -> {status_map[state]} (удалён локально)")
+                            # иначе — ничего, ждём
+
+
+                    # если есть сохранённый снимок клиринга — ничего с сеткой не делаем
+                    if settings[symbol].get("_clearing_snapshot"):
+                        misc.send_msg(
+                            f"{symbol}: клиринг — пропускаем regrid/перезапуск до восстановления по снимку")
+                        return
 
-                            size_lot = max(1, int(float(couple.get("size") or 1)))
+                    # 4) Если остались только OPEN — перезапуск сетки
+                    if not settings[symbol]["orders_close"]:
+                        # если только что были FILLED — даём системе стабилизироваться
+                        if time.time() - settings[symbol].get("_last_filled_ts", 0) < 10:
+                            misc.send_msg(f"{symbol}: FILLED недавно — пропускаем regrid в течение 10с")
+                            return
 
+                        misc.send_msg(
+                            f"{symbol}: в сетке остались только ордера на открытие — отменяем и пересоздаём")
+                        cancel_only_own_orders_local(symbol, ticker)
 
-                            if side == "long":
-                                place_fn = lambda lots, price: trading_api.long_limit(
-                                    ticker, lots, price, client_order_id=str(uuid4())
-                                )
-                            else:
-                                place_fn = lambda lots, price: trading_api.short_limit(
-                                    ticker, lots, price, client_order_id=str(uuid4())
+                        # Сохраняем важные поля перед сбросом
+                        _no_tp = settings[symbol].get("positions_no_tp", {})
+                        _held_ss = int(settings[symbol].get("live_held_same_side", 0))
+
+                        # Сбрасываем, но восстанавливаем сохранённое
+                        settings[symbol] = get_settings()
+                        settings[symbol]["positions_no_tp"] = _no_tp
+                        settings[symbol]["live_held_same_side"] = _held_ss
+
+                        misc.send_msg(
+                            f"{symbol}: перезапуск сетки. Позиции без TP сохранены: {list(_no_tp.keys()) or '-'}; "
+                            f"held_same_side={_held_ss}")
+                        return
+
+                    # 5) Если остались только TP — перестраиваем сетку
+                    if not settings[symbol]["orders_open"]:
+                        # --- REGRID cooldown: не дёргаем перестройку слишком часто
+                        now_ts = time.time()
+                        next_try_at = settings[symbol].get("_regrid_next_try_at", 0)
+                        if now_ts < next_try_at:
+                            return  # ждём окончание кулдауна
+
+                        # --- REGRID gate: пробуем перестраивать только если рынок сдвинулся хотя бы на step_orders
+                        price_s = trading_api.get_price(ticker)
+                        move_step = float(couple.get("step_orders") or 0)
+                        last_mkt = settings[symbol].get("_regrid_last_mkt")
+                        if last_mkt is not None and move_step > 0:
+                            if abs(float(price_s) - float(last_mkt)) < move_step:
+                                settings[symbol]["_regrid_next_try_at"] = now_ts + 10  # короткий кулдаун
+                                return
+
+                        # фиксируем «рынок на момент попытки»
+                        settings[symbol]["_regrid_last_mkt"] = float(price_s)
+
+                        # --- считаем, можем ли поставить ЕЩЁ ОДНУ сетку с учётом лимита портфеля
+                        portfolio_lim = int(
+                            (couple.get("portfolio_limit") or 0) or (settings[symbol].get("portfolio_limit") or 0)
+                        )
+                        slots_to_add = _grid_slots_for_new_layer(symbol, couple, portfolio_lim)
+                        if slots_to_add <= 0:
+                            settings[symbol]["_regrid_next_try_at"] = time.time() + 10
+                            misc.send_msg(
+                                f"{symbol}: GRID_CAP=0 — перестроение пропущено (нет места для новой сетки относительно лимита портфеля)"
+                            )
+                            return
+
+                        # Базовые ордера в TP-части
+                        max_order = misc.get_max_order(settings[symbol]["orders"])
+                        min_order = misc.get_min_order(settings[symbol]["orders"])
+
+                        # Универсальный расчёт цены нового OPEN:
+                        #   long  -> ставим BUY ниже минимума TP на TP (фактически ниже последнего проданного)
+                        #   short -> ставим SELL выше максимума TP на TP
+                        side = (couple.get("side") or "").lower()
+
+                        step_size = float(figi[symbol]["step"])
+                        tp_val = float(couple.get("TP") or 0) * step_size
+                        step_val = float(couple.get("step_orders") or 0) * step_size
+
+                        if side == "long":
+                            target_price = misc.WithoutPrice(min_order["price"], tp_val, figi[symbol])
+                            place_ok = (price_s > target_price)
+                            base_step_fn = lambda p: misc.WithoutPrice(p, step_val, figi[symbol])
+                        else:
+                            target_price = misc.WithPrice(max_order["price"], tp_val, figi[symbol])
+                            place_ok = (price_s < target_price)
+                            base_step_fn = lambda p: misc.WithPrice(p, step_val, figi[symbol])
+
+                        # headroom по брокеру (на всякий случай ещё раз перед самой постановкой)
+                        held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, portfolio_lim)
+                        if headroom <= 0:
+                            misc.send_msg(f"{symbol}: REGRID отменён — headroom=0")
+                            settings[symbol]["_regrid_next_try_at"] = time.time() + 10
+                            return
+
+                        size_lot = max(1, int(float(couple.get("size") or 1)))
+
+
+                        if side == "long":
+                            place_fn = lambda lots, price: trading_api.long_limit(
+                                ticker, lots, price, client_order_id=str(uuid4())
+                            )
+                        else:
+                            place_fn = lambda lots, price: trading_api.short_limit(
+                                ticker, lots, price, client_order_id=str(uuid4())
+                            )
+
+                        if place_ok:
+                            placed = 0
+                            cur_target = float(target_price)
+
+                            # план от target_price по свободным уровням (headroom уже снят выше), затем пачка
+                            planner = GridPlanner(symbol, ticker, settings, step=figi[symbol]["step"])
+                            levels = planner.plan(cur_target, lambda p: float(base_step_fn(p)), slots_to_add,
+                                                  min(size_lot, headroom))
+                            if planner.exhausted:
+                                misc.send_msg(f"{symbol}: REGRID — не нашли свободный уровень, остановка")
+
+                            for cur_target, lots_i, ord_new, err in planner.place(levels, place_fn):
+                                if err is not None:
+                                    misc.send_msg(f"{symbol}: REGRID — OPEN {cur_target} не выставлен: {err}")
+                                    continue
+                                misc.orderlog_init(
+                                    str(ord_new["order_id"]), ticker, couple["side"], int(lots_i),
+                                    float(cur_target), figi[symbol]["step"], "OPEN:REGRID"
                                 )
+                                o = {
+                                    "order_id": ord_new["order_id"],
+                                    "price": float(cur_target),
+                                    "size": int(lots_i),
+                                    "type": "open",
+                                }
+                                settings[symbol].setdefault("orders_open", {})[str(ord_new["order_id"])] = o
+                                misc.level_add(symbol, ord_new["order_id"], o["price"])
+                                settings[symbol].setdefault("orders", []).append(o)
+                                placed += 1
 
-                            if place_ok:
-                                placed = 0
-                                cur_target = float(target_price)
-
-                                for _ in range(slots_to_add):
-                                    # актуальный headroom перед каждой заявкой
-                                    _, _, _, headroom_now = _headroom_from_broker(symbol, couple, portfolio_lim)
-                                    if headroom_now <= 0:
-                                        break
-
-                                    lots_i = min(size_lot, headroom_now)
-
-                                    # уровень должен быть свободен
-                                    guard = 0
-                                    while not misc.is_price_level_free_combined(ticker, cur_target, settings):
-                                        cur_target = float(base_step_fn(cur_target))
-                                        guard += 1
-                                        if guard > 100:
-                                            break
-
-                                    if guard > 100:
-                                        misc.send_msg(f"{symbol}: REGRID — не нашли свободный уровень, остановка")
-                                        break
-
-                                    ord_new = place_fn(int(lots_i), float(cur_target))
-                                    misc.orderlog_init(
-                                        str(ord_new["order_id"]), ticker, couple["side"], int(lots_i),
-                                        float(cur_target), figi[symbol]["step"], "OPEN:REGRID"
-                                    )
-                                    o = {
-                                        "order_id": ord_new["order_id"],
-                                        "price": float(cur_target),
-                                        "size": int(lots_i),
-                                        "type": "open",
-                                    }
-                                    settings[symbol].setdefault("orders_open", {})[str(ord_new["order_id"])] = o
-                                    settings[symbol].setdefault("orders", []).append(o)
-                                    placed += 1
-
-                                    # следующий уровень для следующего слота
-                                    cur_target = float(base_step_fn(cur_target))
-
-                                if placed == 0:
-                                    settings[symbol]["_regrid_next_try_at"] = time.time() + 25
-                                    settings[symbol]["_regrid_last_price"] = float(cur_target)
-                                else:
-                                    # успех REGRID: чистим кулдаун/маркеры
-                                    settings[symbol].pop("_regrid_next_try_at", None)
-                                    settings[symbol]["_regrid_last_mkt"] = float(price_s)
+                            if placed == 0:
+                                settings[symbol]["_regrid_next_try_at"] = time.time() + 25
+                                settings[symbol]["_regrid_last_price"] = float(cur_target)
                             else:
-                                # лимит был бы активным — ждём
-                                settings[symbol]["_regrid_next_try_at"] = time.time() + 5
+                                # успех REGRID: чистим кулдаун/маркеры
+                                settings[symbol].pop("_regrid_next_try_at", None)
+                                settings[symbol]["_regrid_last_mkt"] = float(price_s)
+                        else:
+                            # лимит был бы активным — ждём
+                            settings[symbol]["_regrid_next_try_at"] = time.time() + 5
 
-                    # --- ПОРТФЕЛЬНЫЙ ЛИМИТ: финальный срез ПОСЛЕ обновления состояний
+                # --- ПОРТФЕЛЬНЫЙ ЛИМИТ: финальный срез ПОСЛЕ обновления состояний
 
-                    held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
-                    if limit > 0:
-                        misc.send_msg(
-                            f"{symbol}: лимит={limit}, held={held_ss}, pending={pob}, осталось(headroom)={headroom} "
-                            f"(ticker={couple.get('symbol') or symbol})"
-                        )
-                        _plog(symbol, limit, used, headroom, settings, min_interval=120)
+                held_ss, pob, used, headroom = _headroom_from_broker(symbol, couple, limit)
+                if limit > 0:
+                    misc.send_msg(
+                        f"{symbol}: лимит={limit}, held={held_ss}, pending={pob}, осталось(headroom)={headroom} "
+                        f"(ticker={couple.get('symbol') or symbol})"
+                    )
+                    _plog(symbol, limit, used, headroom, settings, min_interval=120)
 
 
 
-                elif couple["enable"] == "OFF":  # Если торговля отключена
+            elif couple["enable"] == "OFF":  # Если торговля отключена
 
-                    if symbol in settings.keys():
-                        # отчёт перед удалением состояния
+                if symbol in settings.keys():
+                    # отчёт перед удалением состояния
 
-                        no_tp = settings[symbol].get("positions_no_tp", {})
+                    no_tp = settings[symbol].get("positions_no_tp", {})
 
-                        msg = misc.format_no_tp_report(symbol, no_tp)
+                    msg = misc.format_no_tp_report(symbol, no_tp)
 
-                        misc.send_msg(msg)
+                    misc.send_msg(msg)
 
-                        misc.log_operation({
+                    misc.log_operation({
 
-                            "symbol": symbol,
+                        "symbol": symbol,
 
-                            "kind": "STOP_REPORT",
+                        "kind": "STOP_REPORT",
 
-                            "count": len(no_tp),
+                        "count": len(no_tp),
 
-                            "orders": list(no_tp.keys())
+                        "orders": list(no_tp.keys())
 
-                        }, op_name="STOP_REPORT")
+                    }, op_name="STOP_REPORT")
 
-                        # теперь можно очищать состояние символа
+                    # теперь можно очищать состояние символа
 
-                        del settings[symbol]
+                    del settings[symbol]
 
-                        Settings.saveSettings(settings)
+                    Settings.saveSettings(settings)
+        except Exception as err:
+            # Логируем ошибку
+            misc.send_msg([err, extract_tb(exc_info()[2])])
+            _backoff_until[symbol] = time.time() + ERROR_BACKOFF_SEC
+
+    def _run_symbol(symbol, couple):
+        # все saveSettings за проход по символу сливаются в одну запись его строк на выходе
+        with Settings.symbol_scope(symbol):
+            _process_symbol(symbol, couple)
+
+    def run_cycle(couples):
+        """Прогоняет все пары: последовательно (BOT_WORKERS=1) или пулом воркеров."""
+        items = list(couples.items())
+        if BOT_WORKERS <= 1 or len(items) <= 1:
+            for symbol, couple in items:
+                _run_symbol(symbol, couple)
+            return
+        futures = [workers.submit(_run_symbol, symbol, couple) for symbol, couple in items]
+        for fut in futures:
+            try:
+                fut.result()
             except Exception as err:
-                # Логируем ошибку
                 misc.send_msg([err, extract_tb(exc_info()[2])])
-                time.sleep(60)
+
+    workers = ThreadPoolExecutor(max_workers=BOT_WORKERS, thread_name_prefix="symbol") if BOT_WORKERS > 1 else None
+
+    _backoff_until = {}  # symbol -> epoch, до которого символ пропускается после ошибки
+
+    # расписание: бот просыпается ровно к ближайшему дедлайну, а не по фиксированным паузам
+    sched = DeadlineScheduler()
+    sched.every("cycle", STREAM_IDLE_SEC if stream is not None else BOT_CYCLE_SEC)
+    sched.daily("clearing", [_PRE_MID, _RESTORE_MID, _PRE_EVE, _RESTORE_EVE, _PRE_NIGHT, _RESTORE_MORNING],
+                _now_msk)
+
+    def _plan_symbol_duties(couples):
+        """Дедлайны по символам: проверка статуса, сверка с брокером, граница сессии, конец паузы после ошибки."""
+        status_at, sync_at, session_at = [], [], []
+        for symbol, couple in couples.items():
+            st = settings.get(symbol)
+            if couple.get("enable") != "ON" or not st:
+                continue
+            status_at.append(float(st.get("lastUpdStatusTrading") or 0) + STATUS_CHECK_SEC)
+            try:
+                change = trading_api.next_session_change(couple.get("symbol") or symbol)
+            except Exception:
+                change = None
+            if change:
+                session_at.append(change + 1.0)  # граница сессии по расписанию площадки
+            if "_last_sync_broker_held_ts" in st:
+                sync_at.append(float(st["_last_sync_broker_held_ts"]) + BROKER_SYNC_SEC)
+        for name, points in (("status", status_at), ("sync", sync_at), ("session", session_at),
+                             ("retry", [ts for ts in _backoff_until.values() if ts > time.time()])):
+            if points:
+                sched.schedule(name, max(min(points), time.time() + 1.0))  # не чаще раза в секунду
+            else:
+                sched.cancel(name)
+
+    # couples.txt перечитывается только при изменении файла; бот получает diff пар
+    watcher = Settings.CouplesWatcher()
+    woke_for = set()
+
+    def _wake(timeout):
+        """Простой до дедлайна: будят сделка из потока или правка couples.txt."""
+        end = time.time() + timeout
+        while True:
+            left = end - time.time()
+            if left <= 0:
+                return False
+            if stream is not None:
+                if stream.wait_for_trades(min(left, COUPLES_POLL_SEC)):
+                    woke_for.add("trades")
+                    return True
+            else:
+                time.sleep(min(left, COUPLES_POLL_SEC))
+            if watcher.changed():
+                woke_for.add("couples")
+                return True
+
+    couples = {}
+    while True:
+        """
+        Главный цикл бота, который работает бесконечно. Он проверяет каждую пару символов и выполняет операции с ордерами.
+        """
+        trading_api.begin_cycle()  # свежий снимок активных заявок на этот проход
+
+        diff = None
+        try:
+            # Пары символов из 'data/couples.txt' (разбор и проверка — только если файл изменился)
+            couples, diff = watcher.poll()
+        except Exception as err:
+            # Если произошла ошибка при загрузке, логируем её
+            misc.send_msg([err, extract_tb(exc_info()[2])])
+
+        # разбудила только правка файла — проходим лишь затронутые пары
+        couples_only = woke_for == {"couples"}
+        woke_for.clear()
+        targets = {} if couples_only else couples
+        if diff and (diff.added or diff.removed or diff.changed):
+            misc.send_msg(f"пары обновлены: +{sorted(diff.added)} -{sorted(diff.removed)} ~{sorted(diff.changed)}")
+            for sym in diff.added | diff.changed:
+                _backoff_until.pop(sym, None)  # изменённую пару не держим в паузе после ошибки
+            if couples_only:
+                targets = {sym: couples[sym] for sym in diff.added | diff.changed}
+
+        # цены всех включённых тикеров — одним запросом на цикл, дальше из кэша
+        try:
+            enabled = [c["symbol"] for c in couples.values() if c.get("enable") == "ON"]
+            if stream is not None:
+                stream.set_instruments(trading_api.figis_for(enabled))
+            # с потоком unary-запрос уходит только за ценами, которые поток давно не обновлял
+            trading_api.refresh_prices(enabled, only_stale=stream is not None)
+        except Exception as err:
+            misc.send_msg(f"не удалось обновить цены пакетом: {err}")
+
+        # Перебираем все символы и выполняем торговые операции для каждого (параллельно по воркерам)
+        run_cycle(targets)
+        Settings.flushSettings()  # то, что не удалось записать на выходе из прохода по символу
+
+        # ждём ближайший дедлайн; сделка по счёту или правка couples.txt будят раньше срока
+        _plan_symbol_duties(couples)
+        due = sched.wait(wake=_wake)
+        if "trades" in woke_for:
+            misc.send_msg("поток: событие исполнения — внеочередной проход")
+        if due == ["wake"] and woke_for == {"couples"}:
+            continue  # дедлайнов нет — следующий проход только по изменённым парам
+        woke_for.discard("couples")
 
     misc.send_msg(f"бот остановлен!")  # Сообщение о завершении работы бота
 
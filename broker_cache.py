@@ -0,0 +1,145 @@
+import threading
+import time
+
+
+class CycleSnapshot:
+    """
+    Снимок данных брокера, общий для всех символов в пределах цикла.
+
+    get() делает один запрос fetch() и дальше отдаёт значение из памяти, пока
+    снимок не инвалидирован (invalidate()) и не старше max_age секунд.
+    max_age = 0 — кэш выключен, каждый get() идёт к брокеру (поведение по умолчанию
+    для UI и разовых скриптов; бот включает кэш на время своего цикла).
+    Параллельные get() во время загрузки ждут один и тот же запрос.
+    """
+
+    def __init__(self, fetch, max_age: float = 0.0):
+        self._fetch = fetch
+        self.max_age = float(max_age)
+        self._lock = threading.RLock()
+        self._value = None
+        self._ts = 0.0
+        self._stale = True
+        self.hits = 0
+        self.fetches = 0
+
+    def _fresh(self) -> bool:
+        return (not self._stale) and self.max_age > 0 and (time.time() - self._ts) < self.max_age
+
+    def get(self):
+        with self._lock:
+            if self._fresh():
+                self.hits += 1
+                return self._value
+            value = self._fetch()
+            self._value = value
+            self._ts = time.time()
+            self._stale = False
+            self.fetches += 1
+            return value
+
+    def invalidate(self):
+        with self._lock:
+            self._stale = True
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "fetches": self.fetches, "age": time.time() - self._ts if self._ts else None}
+
+
+class OrdersSnapshot(CycleSnapshot):
+    """
+    Активные заявки всего счёта одним get_orders, разложенные по figi:
+        {figi: [order_const(...), ...]}
+    Свои post/cancel вносим в снимок сразу (add/discard), чтобы не перекачивать его.
+    """
+
+    def for_figi(self, figi: str) -> list:
+        return [dict(o) for o in self.get().get(figi, [])]
+
+    def add(self, figi: str, order: dict):
+        with self._lock:
+            if not self._fresh():
+                return  # снимка нет/устарел — следующий get() и так скачает актуальный
+            bucket = self._value.setdefault(figi, [])
+            oid = str(order.get("order_id"))
+            if all(str(o.get("order_id")) != oid for o in bucket):
+                bucket.append(dict(order))
+
+    def discard(self, order_id: str):
+        with self._lock:
+            if not self._fresh():
+                return
+            oid = str(order_id)
+            for figi, bucket in self._value.items():
+                self._value[figi] = [o for o in bucket if str(o.get("order_id")) != oid]
+
+
+class PriceCache:
+    """
+    Последние цены (Quotation) по figi с бюджетом «свежести» max_age секунд.
+
+    Все отслеживаемые инструменты (watch) обновляются ОДНИМ запросом fetch_many(figis):
+    как только запрошенная цена устарела — перекачиваем сразу весь список.
+    """
+
+    def __init__(self, fetch_many, max_age: float = 3.0):
+        self._fetch_many = fetch_many  # list[figi] -> {figi: Quotation}
+        self.max_age = float(max_age)
+        self._lock = threading.RLock()
+        self._prices = {}       # figi -> (Quotation, ts)
+        self._watch = set()
+        self.hits = 0
+        self.fetches = 0
+
+    def watch(self, figis):
+        """Задаёт набор инструментов, которые обновляются одним пакетом."""
+        with self._lock:
+            self._watch = set(f for f in figis if f)
+
+    def put(self, figi: str, quotation, ts: float | None = None):
+        with self._lock:
+            self._prices[figi] = (quotation, ts if ts is not None else time.time())
+
+    def refresh(self, figis=None) -> dict:
+        with self._lock:
+            batch = sorted(self._watch | set(figis or ()))
+            if not batch:
+                return {}
+            res = self._fetch_many(batch)
+            now = time.time()
+            for figi, q in res.items():
+                self._prices[figi] = (q, now)
+            self.fetches += 1
+            return res
+
+    def stale(self, figis=None) -> list:
+        """Инструменты (по умолчанию — отслеживаемые), цена которых старше max_age."""
+        with self._lock:
+            now = time.time()
+            return sorted(f for f in (self._watch if figis is None else figis)
+                          if f not in self._prices or now - self._prices[f][1] >= self.max_age)
+
+    def refresh_stale(self) -> dict:
+        """Докачивает одним запросом только устаревшие цены (свежие, например из потока, не трогает)."""
+        with self._lock:
+            batch = self.stale()
+            if not batch:
+                return {}
+            res = self._fetch_many(batch)
+            now = time.time()
+            for figi, q in res.items():
+                self._prices[figi] = (q, now)
+            self.fetches += 1
+            return res
+
+    def get(self, figi: str):
+        with self._lock:
+            item = self._prices.get(figi)
+            if item and time.time() - item[1] < self.max_age:
+                self.hits += 1
+                return item[0]
+            self.refresh([figi])
+            item = self._prices.get(figi)
+            if not item:
+                raise KeyError(f"нет цены для {figi}")
+            return item[0]
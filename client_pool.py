@@ -0,0 +1,166 @@
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from grpc import StatusCode
+from tinkoff.invest import Client
+from tinkoff.invest.exceptions import RequestError
+
+from rate_limit import reset_after
+
+
+# Коды, после которых канал считаем «сломанным» и пересоздаём при следующей выдаче
+_RECONNECT_CODES = {
+    StatusCode.UNAVAILABLE,
+    StatusCode.CANCELLED,
+}
+
+
+class _Session:
+    """Одна открытая сессия Client(...) — gRPC-канал + набор сервисов SDK."""
+
+    def __init__(self, cm):
+        self.cm = cm
+        self.services = cm.__enter__()  # TLS/HTTP2 handshake — один раз на сессию
+        self.opened_at = time.time()
+        self.last_ok = self.opened_at
+
+    def close(self):
+        try:
+            self.cm.__exit__(None, None, None)
+        except Exception:
+            pass
+
+
+class ClientPool:
+    """
+    Пул долгоживущих сессий Tinkoff Invest API (потокобезопасный).
+
+    Вместо `with Client(TOKEN) as client:` на каждый вызов:
+
+        limiter.acquire("orders")
+        with client_pool.client("orders") as client:
+            client.orders.get_orders(account_id=...)
+
+    - size — сколько каналов держим одновременно (по одному на параллельный вызов);
+    - сессия, простоявшая дольше health_interval, перед выдачей проверяется пингом
+      (пинг — обычный запрос users, поэтому сначала берём токен limiter.acquire("users"));
+    - после сетевой ошибки (UNAVAILABLE и т.п.) сессия закрывается и открывается заново;
+    - client(service): RESOURCE_EXHAUSTED от любого вызова блокирует bucket этого сервиса
+      до сброса окна брокера, поэтому притормаживают все вызовы сервиса, а не только повторы.
+    """
+
+    def __init__(self, token: str, size: int = 4, health_interval: float = 60.0, limiter=None,
+                 **client_kwargs):
+        self._token = token
+        self._limiter = limiter
+        self._size = max(1, int(size))
+        self._health_interval = float(health_interval)
+        self._client_kwargs = client_kwargs
+        self._idle = queue.LifoQueue()      # LIFO — чаще переиспользуем «тёплые» каналы
+        self._slots = threading.BoundedSemaphore(self._size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._reconnects = 0
+        self._closed = False
+
+    # --- внутреннее ---
+
+    def _open(self) -> _Session:
+        sess = _Session(Client(self._token, **self._client_kwargs))
+        with self._lock:
+            self._opened += 1
+        return sess
+
+    def _healthy(self, sess: _Session) -> bool:
+        if time.time() - sess.last_ok < self._health_interval:
+            return True
+        try:
+            if self._limiter is not None:
+                self._limiter.acquire("users")  # пинг расходует ту же квоту, что и остальные вызовы
+            sess.services.users.get_info()  # самый дешёвый unary-вызов
+            sess.last_ok = time.time()
+            return True
+        except Exception:
+            return False
+
+    def _acquire(self) -> _Session:
+        if self._closed:
+            raise RuntimeError("ClientPool закрыт")
+        self._slots.acquire()
+        try:
+            try:
+                sess = self._idle.get_nowait()
+            except queue.Empty:
+                return self._open()
+            if self._healthy(sess):
+                return sess
+            sess.close()
+            with self._lock:
+                self._reconnects += 1
+            return self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, sess: _Session, broken: bool):
+        try:
+            if broken or self._closed:
+                sess.close()
+                if broken:
+                    with self._lock:
+                        self._reconnects += 1
+            else:
+                sess.last_ok = time.time()
+                self._idle.put(sess)
+        finally:
+            self._slots.release()
+
+    # --- публичное ---
+
+    @contextmanager
+    def client(self, service: str | None = None):
+        """
+        Выдаёт сервисы SDK из пула; после выхода из блока сессия возвращается в пул.
+        service — квота limiter, на которую списывать RESOURCE_EXHAUSTED (токен берёт вызывающий).
+        """
+        sess = self._acquire()
+        broken = False
+        try:
+            yield sess.services
+        except RequestError as e:
+            code = getattr(e, "code", None)
+            broken = code in _RECONNECT_CODES
+            if code == StatusCode.RESOURCE_EXHAUSTED and service and self._limiter is not None:
+                self._limiter.penalize(service, reset_after(e))
+            raise
+        except (ConnectionError, OSError):
+            broken = True
+            raise
+        finally:
+            self._release(sess, broken)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self._size,
+                "idle": self._idle.qsize(),
+                "opened": self._opened,
+                "reconnects": self._reconnects,
+            }
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def make_pool(token: str, size: int = 4, limiter=None, **client_kwargs) -> ClientPool:
+    pool = ClientPool(token, size=size, limiter=limiter, **client_kwargs)
+    atexit.register(pool.close)
+    return pool
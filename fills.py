@@ -0,0 +1,167 @@
+import threading
+import time
+
+
+FILLED = 1
+
+
+class FillResolver:
+    """
+    Разрешение «пропавших» у брокера заявок пачкой.
+
+    Источники:
+      1) сделки из потока (order_id известен точно) — note_trade(): такое исполнение засчитываем сразу;
+      2) остальное — order_state(order_id) -> (status, price|None, lots_executed) по одной:
+         FILLED засчитываем, только если брокер показывает исполненные лоты. Пропажа заявки
+         сама по себе ничего не доказывает (её могли снять из панели), поэтому похожая операция
+         в ленте без подтверждения статуса исполнением не считается;
+      3) лента операций счёта: fetch_ops(since_ts) -> [{id, figi, direction, qty, price, ts, trade_ids}]
+         (qty — в бумагах, direction 1 BUY / 2 SELL, price — в пунктах цены), один запрос на цикл
+         (invalidate() в начале цикла) — только источник цены, если статус пришёл без неё.
+         Кандидаты — операции по figi/направлению/количеству с ценой не хуже лимитной и не раньше
+         создания заявки.
+
+    Каждое найденное исполнение «съедает» свою операцию: сделки из потока — по trade_id,
+    остальные — ближайшую по цене операцию-кандидата. Съеденные операции пишутся в store()
+    (журнал ордеров), поэтому и после перезапуска одна операция не закроет две заявки.
+
+    resolve() возвращает {order_id: {"status": int|None, "price": float|None, "source": str}}.
+    """
+
+    def __init__(self, fetch_ops, order_state, store=None, lookback: float = 24 * 3600, overlap: float = 300):
+        self._fetch_ops = fetch_ops
+        self._order_state = order_state
+        self._store = store       # () -> OrderJournal (consume_op / consumed_ops) или None
+        self.lookback = float(lookback)
+        self.overlap = float(overlap)
+        self._lock = threading.RLock()
+        self._ops = {}            # op id -> op
+        self._used = set()        # op id, уже сопоставленные с заявками
+        self._stream = {}         # order_id -> [(price, qty), ...]
+        self._seen_trades = set() # trade_id из потока (любой заявки, включая ручные)
+        self._since = 0.0
+        self._stale = True
+        self.fetches = 0
+        self.fallbacks = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._stale = True
+
+    def note_trade(self, order_id: str, trades, trade_ids=()):
+        """Сделки из trades_stream: [(price, qty), ...] по конкретной заявке и их trade_id."""
+        with self._lock:
+            self._stream.setdefault(str(order_id), []).extend((float(p), int(q)) for p, q in trades)
+            self._seen_trades.update(str(t) for t in trade_ids if t)
+
+    def _refresh(self):
+        now = time.time()
+        since = max(self._since - self.overlap, now - self.lookback) if self._since else now - self.lookback
+        fresh = [op for op in self._fetch_ops(since) if op["id"] not in self._ops]
+        for op in fresh:
+            self._ops[op["id"]] = op
+        if fresh and self._store is not None:
+            try:
+                self._used.update(self._store().consumed_ops([op["id"] for op in fresh]))
+            except Exception as e:
+                print(f"[fills] журнал использованных операций недоступен: {e}")
+        cutoff = now - self.lookback
+        for op_id in [k for k, op in self._ops.items() if op["ts"] < cutoff]:
+            self._ops.pop(op_id, None)
+            self._used.discard(op_id)
+        self._since = now
+        self._stale = False
+        self.fetches += 1
+
+    def _claimed(self, op_id, op) -> bool:
+        return op_id in self._used or any(str(t) in self._seen_trades for t in op.get("trade_ids") or ())
+
+    def _candidates(self, figi, direction, qty, limit_price, tol, created_ts) -> list:
+        """Свободные операции, которые могли бы быть исполнением заявки (ближайшие по цене — первыми)."""
+        found = []
+        for op_id, op in self._ops.items():
+            if op["figi"] != figi or op["direction"] != direction or op["qty"] != qty:
+                continue
+            if created_ts is not None and op["ts"] < created_ts:
+                continue  # операция раньше заявки — не её исполнение
+            if self._claimed(op_id, op):
+                continue
+            # лимитная заявка исполняется по своей цене или лучше
+            gap = (limit_price - op["price"]) if direction == 1 else (op["price"] - limit_price)
+            if gap < -tol:
+                continue
+            found.append((gap, op_id))
+        return [op_id for _, op_id in sorted(found)]
+
+    def _mark_used(self, op_id, order_id):
+        self._used.add(op_id)
+        if self._store is not None:
+            try:
+                self._store().consume_op(op_id, order_id)
+            except Exception as e:
+                print(f"[fills] операция {op_id} не записана в журнал: {e}")
+
+    def _consume(self, order_id, candidates, price=None):
+        """Помечает использованной операцию-кандидата, ближайшую к price (без trade_id — те уже учтены)."""
+        pool = [c for c in candidates if c not in self._used and not self._ops[c].get("trade_ids")] \
+            or [c for c in candidates if c not in self._used]
+        if not pool:
+            return
+        if price is not None:
+            pool.sort(key=lambda c: abs(self._ops[c]["price"] - price))
+        self._mark_used(pool[0], order_id)
+
+    def resolve(self, figi: str, lot: int, orders, tol: float = 0.0) -> dict:
+        """
+        orders — [(order_id, direction, lots, limit_price, created_ts), ...] заявки, которых больше нет
+        у брокера; created_ts — время создания заявки (epoch) или None, если неизвестно.
+        tol — допуск по цене (обычно полшага цены).
+        """
+        out, rest = {}, []
+        with self._lock:
+            pending = []
+            for oid, direction, lots, limit_price, created_ts in orders:
+                oid, qty = str(oid), int(lots) * int(lot or 1)
+                trades = self._stream.get(oid)
+                if trades and sum(q for _, q in trades) >= qty:
+                    vwap = sum(p * q for p, q in trades) / max(1, sum(q for _, q in trades))
+                    out[oid] = {"status": FILLED, "price": vwap, "source": "stream"}
+                    self._stream.pop(oid, None)
+                    pending.append((oid, int(direction), qty, float(limit_price), created_ts, vwap))
+                else:
+                    pending.append((oid, int(direction), qty, float(limit_price), created_ts, None))
+                    rest.append((oid, int(lots)))
+            if pending and self._stale:
+                try:
+                    self._refresh()
+                except Exception as e:
+                    print(f"[fills] лента операций недоступна: {e} — цена только из статуса заявки")
+
+            cands = {}
+            for oid, direction, qty, limit_price, created_ts, vwap in pending:
+                cands[oid] = self._candidates(figi, direction, qty, limit_price, tol, created_ts)
+                if vwap is not None:
+                    # сделки из потока: их операцию (по trade_id или ближайшую по цене) больше никому не отдаём
+                    self._consume(oid, cands[oid], vwap)
+
+        for oid, lots in rest:
+            self.fallbacks += 1
+            try:
+                status, price, executed = self._order_state(oid)
+            except Exception as e:
+                print(f"[fills] {oid}: статус не получен: {e}")
+                status, price, executed = None, None, 0
+            if status == FILLED and int(executed or 0) < lots:
+                print(f"[fills] {oid}: статус FILLED без исполненных лотов ({executed}/{lots}) — ждём")
+                status, price = None, None
+            if status == FILLED:
+                with self._lock:
+                    ops = [c for c in cands[oid] if c not in self._used]
+                    if price is None and ops:
+                        price = self._ops[ops[0]]["price"]  # лента — только источник цены
+                    self._consume(oid, ops, price)
+            out[oid] = {"status": status, "price": price, "source": "state"}
+        return out
+
+    def stats(self) -> dict:
+        return {"fetches": self.fetches, "fallbacks": self.fallbacks, "ops": len(self._ops)}
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import ladder
+import trading_api
+from level_index import LevelIndex
+
+
+class GridPlanner:
+    """
+    Построение сетки «сначала план, потом постановка».
+
+    - занятые уровни снимаются один раз: локальные orders_open/orders_close + активные заявки
+      брокера по тикеру (как misc.is_price_level_free_combined, но без запроса на каждый уровень);
+    - plan() подбирает свободные уровни локально (уровень занят, если в пределах ± шаг цены уже есть заявка);
+    - place() отправляет весь план параллельной пачкой (темп задаёт trading_api.limiter).
+    """
+
+    def __init__(self, symbol: str, ticker: str, settings: dict, step: float | None = None):
+        self.symbol = symbol
+        self.ticker = ticker
+        self.step = float(step or trading_api.registry[ticker].step)
+        self.exhausted = False  # план оборвался: не нашли свободный уровень за max_shift шагов
+
+        sym = settings.get(symbol, {})
+        self._index = LevelIndex(self.step)
+        self._index.sync(sym.get("orders_open", {}), sym.get("orders_close", {}))
+        try:
+            for o in trading_api.get_orders(ticker):
+                self._index.add(o["order_id"], o["price"])  # свои заявки совпадут по order_id
+        except Exception as e:
+            print(f"[grid] {ticker}: активные заявки не получены ({e}) — проверяем только локальные уровни")
+        self._planned = 0
+
+    def is_free(self, price) -> bool:
+        return self._index.is_free(price)
+
+    def occupy(self, price):
+        self._planned += 1
+        self._index.add(f"plan:{self._planned}", price)
+
+    def plan(self, start, next_fn, slots: int, lots: int, max_shift: int = 100) -> list:
+        """
+        Уровни от start с шагом next_fn, пропуская занятые: [(price, lots), ...] длиной до slots.
+        """
+        levels, target = [], start
+        for _ in range(max(0, int(slots))):
+            guard = 0
+            while not self.is_free(target):
+                target = next_fn(target)
+                guard += 1
+                if guard > max_shift:
+                    self.exhausted = True
+                    return levels
+            levels.append((float(target), int(lots)))
+            self.occupy(target)
+            target = next_fn(target)
+        return levels
+
+    def plan_ladder(self, start, step_ticks: int, direction: int, slots: int, lots: int) -> list:
+        """
+        То же, что plan(), для равномерной лестницы в тиках (start ± step_ticks * k):
+        все уровни с пропуском занятых считаются одним вызовом ladder.build_ladder.
+        """
+        res = ladder.build_ladder(self._index.tick(start), int(step_ticks), slots, lots, direction,
+                                  occupied=self._index.occupied_ticks(), radius=self._index.radius)
+        levels = [(self._index.price(int(t)), int(sz)) for t, sz in zip(res["ticks"], res["sizes"])]
+        for price, _ in levels:
+            self.occupy(price)
+        self.exhausted = len(levels) < int(slots)
+        return levels
+
+    def place(self, levels, place_fn, max_workers: int | None = None) -> list:
+        """
+        place_fn(lots, price) -> order. Возвращает [(price, lots, order | None, error | None), ...]
+        в порядке плана; сбой одной заявки не мешает остальным.
+        """
+        if not levels:
+            return []
+
+        def _one(level):
+            price, lots = level
+            try:
+                return price, lots, place_fn(lots, price), None
+            except Exception as e:
+                return price, lots, None, e
+
+        workers = max(1, min(int(max_workers or trading_api.API_POOL_SIZE), len(levels)))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            return list(ex.map(_one, levels))
@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+from decimal import Decimal
+
+
+CATALOG_PATH = "data/instruments.json"
+CATALOG_TTL = float(os.environ.get("TINKOFF_CATALOG_TTL", str(12 * 3600)))  # сек
+# версия формата записи; меняется вместе с набором полей — файл другой версии не читаем, а качаем заново
+CATALOG_SCHEMA = 2
+
+
+class InstrumentCatalog:
+    """
+    Справочник инструментов {ticker: {figi, lot, min_price, step, nano, exchange, step_amount}} с кэшем на диске.
+
+    - при старте читается data/instruments.json (миллисекунды вместо полной выгрузки),
+    - если файла нет или он другой версии формата (CATALOG_SCHEMA) — синхронно качаем справочник через fetch(),
+    - если файл старше ttl — отдаём его сразу и обновляемся в фоне,
+    - обновление «дельтой»: в общем словаре меняем только изменившиеся записи,
+      поэтому все модули, держащие ссылку на catalog.data, видят свежие данные.
+    """
+
+    def __init__(self, fetch, path: str = CATALOG_PATH, ttl: float = CATALOG_TTL):
+        self._fetch = fetch
+        self.path = path
+        self.ttl = float(ttl)
+        self.data = {}
+        self.updated_at = 0.0
+        self.version = 0  # растёт при каждом изменении data (для перестройки индексов)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                raw = json.load(f)
+            if raw.get("schema") != CATALOG_SCHEMA:
+                return False  # записан до появления нужных полей (uid, units, exchange, step_amount)
+            self.data.update(raw.get("instruments") or {})
+            self.updated_at = float(raw.get("updated_at") or 0)
+            self.version += 1
+            return bool(self.data)
+        except Exception:
+            return False
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"schema": CATALOG_SCHEMA, "updated_at": self.updated_at, "instruments": self.data},
+                      f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def is_stale(self) -> bool:
+        return time.time() - self.updated_at >= self.ttl
+
+    def refresh(self) -> tuple[int, int, int]:
+        """Полная выгрузка у брокера + применение дельты. Возвращает (added, changed, removed)."""
+        fresh = self._fetch()
+        with self._lock:
+            changed = {k: v for k, v in fresh.items() if self.data.get(k) != v}
+            removed = [k for k in self.data.keys() if k not in fresh]
+            added = sum(1 for k in changed if k not in self.data)
+            self.data.update(changed)
+            for k in removed:
+                self.data.pop(k, None)
+            if changed or removed:
+                self.version += 1
+            self.updated_at = time.time()
+            self.save()
+        return added, len(changed) - added, len(removed)
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                wait = self.updated_at + self.ttl - time.time()
+                if wait > 0:
+                    time.sleep(min(wait, 600))
+                    continue
+                added, changed, removed = self.refresh()
+                print(f"[instruments] справочник обновлён: +{added} ~{changed} -{removed}")
+            except Exception as e:
+                print(f"[instruments] ошибка фонового обновления: {e}")
+                time.sleep(60)
+
+    def start_background(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._thread.start()
+
+    def ensure(self) -> dict:
+        """Гарантирует, что справочник загружен, и запускает фоновое обновление."""
+        if not self.data and not self.load():
+            self.refresh()
+        self.start_background()
+        return self.data
+
+
+class Instrument:
+    """Компактная запись инструмента с целочисленными параметрами шага цены."""
+
+    __slots__ = ("ticker", "figi", "uid", "exchange", "lot", "decimals", "inc_units", "inc_nano", "step", "quant",
+                 "step_amount")
+
+    def __init__(self, ticker: str, rec: dict):
+        self.ticker = ticker
+        self.figi = rec.get("figi")
+        self.uid = rec.get("uid")
+        self.exchange = rec.get("exchange") or ""
+        self.lot = int(rec.get("lot") or 1)
+        self.decimals = int(rec.get("min_price") or 0)   # знаков после запятой
+        self.step = float(rec.get("step") or 1)           # шаг цены (деньги)
+        nano = int(rec.get("nano") or 0)
+        units = int(rec["units"]) if rec.get("units") is not None else int(self.step)
+        if units == 0 and nano == 0:
+            units = 1  # как и в справочнике: нулевой шаг трактуем как 1
+        self.inc_units = units
+        self.inc_nano = nano
+        self.quant = Decimal(1).scaleb(-self.decimals)     # 0.01 для 2 знаков и т.д.
+        # стоимость шага цены в валюте (фьючерсы: min_price_increment_amount); None — пункт = деньги
+        self.step_amount = float(rec["step_amount"]) if rec.get("step_amount") else None
+
+    def points(self, money: float) -> float:
+        """
+        Цена в деньгах (MoneyValue из операций и статусов заявок) -> в пунктах, как лимитные цены.
+        Для фьючерсов шаг step пунктов стоит step_amount денег; для остального пункт и есть деньги.
+        """
+        if not self.step_amount:
+            return float(money)
+        return round(float(money) * self.step / self.step_amount, 9)
+
+
+class InstrumentRegistry:
+    """
+    Индексы поверх InstrumentCatalog: ticker -> запись, figi -> ticker, uid -> ticker.
+    Индексы строятся один раз и перестраиваются только при смене catalog.version.
+    """
+
+    def __init__(self, catalog: InstrumentCatalog):
+        self._catalog = catalog
+        self._version = -1
+        self._lock = threading.Lock()
+        self._by_ticker = {}
+        self._by_figi = {}
+        self._by_uid = {}
+        self._tickers_sorted = []
+
+    def _index(self):
+        if self._version == self._catalog.version:
+            return
+        with self._lock:
+            if self._version == self._catalog.version:
+                return
+            version = self._catalog.version
+            by_ticker, by_figi, by_uid = {}, {}, {}
+            for ticker, rec in list(self._catalog.data.items()):
+                try:
+                    ins = Instrument(ticker, rec)
+                except Exception:
+                    continue
+                by_ticker[ticker] = ins
+                if ins.figi:
+                    by_figi[ins.figi] = ins
+                if ins.uid:
+                    by_uid[ins.uid] = ins
+            self._by_ticker, self._by_figi, self._by_uid = by_ticker, by_figi, by_uid
+            self._tickers_sorted = sorted(by_ticker)
+            self._version = version
+
+    def get(self, key: str) -> Instrument | None:
+        """Поиск по тикеру, figi или uid."""
+        self._index()
+        return self._by_ticker.get(key) or self._by_figi.get(key) or self._by_uid.get(key)
+
+    def __getitem__(self, ticker: str) -> Instrument:
+        self._index()
+        return self._by_ticker[ticker]
+
+    def __contains__(self, ticker: str) -> bool:
+        self._index()
+        return ticker in self._by_ticker
+
+    def ticker_by_figi(self, figi: str, default=None):
+        self._index()
+        ins = self._by_figi.get(figi)
+        return ins.ticker if ins else default
+
+    def ticker_by_uid(self, uid: str, default=None):
+        self._index()
+        ins = self._by_uid.get(uid)
+        return ins.ticker if ins else default
+
+    def figi(self, ticker: str) -> str:
+        return self[ticker].figi
+
+    def lot(self, ticker: str, default: int = 1) -> int:
+        ins = self.get(ticker)
+        return ins.lot if ins else default
+
+    def tickers(self) -> list:
+        """Отсортированный список тикеров (готовый, без сортировки на каждый вызов)."""
+        self._index()
+        return self._tickers_sorted
@@ -0,0 +1,99 @@
+import bisect
+
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен: одиночная лестница строится и без него
+    np = None
+
+
+BUY, SELL = 1, 2
+
+
+def _headroom(limit: int, held: int) -> int | None:
+    return max(0, int(limit) - int(held)) if limit and limit > 0 else None
+
+
+def build_ladder(start_tick: int, step_ticks: int, count: int, size: int, direction: int,
+                 side: int = BUY, total_lots: int | None = None, limit: int = 0, held: int = 0,
+                 occupied=(), radius: int = 1) -> dict:
+    """
+    Лестница уровней в тиках одним проходом:
+        tick_k = start_tick + direction * step_ticks * k,  k = 1, 2, ...
+    - занятые уровни (occupied — тики, ± radius) пропускаются, лестница продолжается дальше;
+    - объём: по size лотов на уровень, всего не больше total_lots (если задан) и
+      не больше лимита портфеля limit - held (если limit > 0);
+    - уровней не больше count.
+    Возвращает {"ticks": [...], "sizes": [...], "side": side} (массивы numpy, если он установлен).
+    """
+    size = max(1, int(size))
+    budget = total_lots
+    cap = _headroom(limit, held)
+    if cap is not None:
+        budget = cap if budget is None else min(budget, cap)
+    if budget is not None:
+        count = min(int(count), -(-int(budget) // size))  # уровней нужно не больше ceil(budget/size)
+    count = max(0, int(count))
+    occ = sorted(set(int(t) for t in occupied))
+    # запас кандидатов: каждый занятый тик может «съесть» не больше (2*radius+1)/step уровней
+    n_cand = count + len(occ) * (2 * radius // max(1, step_ticks) + 1)
+
+    if np is not None:
+        k = np.arange(1, n_cand + 1, dtype=np.int64)
+        cand = start_tick + direction * step_ticks * k
+        if occ:
+            occ_arr = np.asarray(occ, dtype=np.int64)
+            i = np.searchsorted(occ_arr, cand - radius, side="left")
+            hit = (i < len(occ_arr)) & (occ_arr[np.minimum(i, len(occ_arr) - 1)] <= cand + radius)
+            cand = cand[~hit]
+        ticks = cand[:count]
+        sizes = np.full(len(ticks), size, dtype=np.int64)
+        if budget is not None and len(sizes):
+            before = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+            sizes = np.clip(budget - before, 0, size)
+            ticks, sizes = ticks[sizes > 0], sizes[sizes > 0]
+        return {"ticks": ticks, "sizes": sizes, "side": side}
+
+    ticks, sizes, left = [], [], budget
+    k = 0
+    while len(ticks) < count and k < n_cand:
+        k += 1
+        t = start_tick + direction * step_ticks * k
+        i = bisect.bisect_left(occ, t - radius)
+        if i < len(occ) and occ[i] <= t + radius:
+            continue
+        lots = size if left is None else min(size, left)
+        if lots <= 0:
+            break
+        ticks.append(t)
+        sizes.append(lots)
+        if left is not None:
+            left -= lots
+    return {"ticks": ticks, "sizes": sizes, "side": side}
+
+
+def build_ladders(start_ticks, step_ticks, counts, sizes, directions, limits=None, helds=None):
+    """
+    Пакетная версия для бэктестов: P наборов параметров -> матрицы (P, K), K = max(counts).
+    Возвращает (ticks, lots, valid): valid[p, k] — уровень k есть в наборе p
+    (k < counts[p] и лимит портфеля ещё не исчерпан). Без занятых уровней; нужен numpy.
+    """
+    if np is None:
+        raise ImportError("build_ladders требует numpy (pip install numpy)")
+    start = np.asarray(start_ticks, dtype=np.int64)[:, None]
+    step = np.asarray(step_ticks, dtype=np.int64)[:, None]
+    direc = np.asarray(directions, dtype=np.int64)[:, None]
+    counts = np.asarray(counts, dtype=np.int64)
+    size = np.asarray(sizes, dtype=np.int64)[:, None]
+    K = int(counts.max()) if len(counts) else 0
+    k = np.arange(1, K + 1, dtype=np.int64)[None, :]
+    ticks = start + direc * step * k
+    valid = k <= counts[:, None]
+    lots = np.where(valid, size, 0)
+    if limits is not None:
+        limits = np.asarray(limits, dtype=np.int64)[:, None]
+        helds = np.zeros_like(limits) if helds is None else np.asarray(helds, dtype=np.int64)[:, None]
+        budget = np.where(limits > 0, np.maximum(0, limits - helds), np.iinfo(np.int64).max)
+        before = np.cumsum(lots, axis=1) - lots
+        lots = np.clip(budget - before, 0, lots)
+        valid &= lots > 0
+    return ticks, lots, valid
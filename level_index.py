@@ -0,0 +1,88 @@
+import bisect
+
+import ticks
+
+
+class LevelIndex:
+    """
+    Занятые ценовые уровни символа в целых тиках (price / step), отсортированным списком.
+
+    sync() сверяет индекс со словарями заявок {order_id: {"price": ...}} по множеству order_id
+    (разность ключей — в C), поэтому пересчитываются только появившиеся/исчезнувшие заявки;
+    is_free() и nearest_free() — бинарный поиск вместо прохода по всем заявкам.
+    """
+
+    def __init__(self, step: float, radius: int = 1):
+        self.step = float(step)
+        self._inc = ticks.to_nano(step) or ticks.NANO   # шаг в нано: тики считаем целочисленно
+        self.radius = int(radius)   # уровень занят, если ближе radius тиков есть заявка
+        self._by_id = {}            # order_id -> tick
+        self._ticks = []            # отсортированные тики (с повторами)
+
+    def tick(self, price) -> int:
+        return ticks.round_to(ticks.to_nano(price), self._inc) // self._inc
+
+    def price(self, tick: int) -> float:
+        return ticks.from_nano(tick * self._inc)
+
+    def __len__(self):
+        return len(self._ticks)
+
+    # --- синхронизация ---
+
+    def add(self, order_id, price):
+        oid = str(order_id)
+        if oid in self._by_id:
+            return
+        t = self.tick(price)
+        self._by_id[oid] = t
+        bisect.insort(self._ticks, t)
+
+    def discard(self, order_id):
+        t = self._by_id.pop(str(order_id), None)
+        if t is not None:
+            i = bisect.bisect_left(self._ticks, t)
+            if i < len(self._ticks) and self._ticks[i] == t:
+                del self._ticks[i]
+
+    def sync(self, *order_maps):
+        """Приводит индекс к текущему содержимому словарей заявок (ключи — order_id)."""
+        current = {}
+        for m in order_maps:
+            current.update(m)
+        if len(current) == len(self._by_id) and current.keys() == self._by_id.keys():
+            return
+        for oid in self._by_id.keys() - current.keys():
+            self.discard(oid)
+        for oid in current.keys() - self._by_id.keys():
+            self.add(oid, current[oid]["price"])
+
+    # --- запросы ---
+
+    def _blocked(self, t: int) -> bool:
+        i = bisect.bisect_left(self._ticks, t - self.radius)
+        return i < len(self._ticks) and self._ticks[i] <= t + self.radius
+
+    def occupied_ticks(self) -> list:
+        """Отсортированные занятые тики (только для чтения)."""
+        return self._ticks
+
+    def is_free(self, price) -> bool:
+        return not self._blocked(self.tick(price))
+
+    def nearest_free(self, price, direction: int = -1, max_jumps: int = 1000) -> float | None:
+        """
+        Ближайший свободный уровень от price вниз (direction=-1) или вверх (+1), с точностью до тика.
+        Перепрыгивает сразу через весь занятый кластер.
+        """
+        t = self.tick(price)
+        for _ in range(max_jumps):
+            if not self._blocked(t):
+                return self.price(t)
+            if direction < 0:
+                i = bisect.bisect_left(self._ticks, t - self.radius)
+                t = self._ticks[i] - self.radius - 1      # ниже самой нижней блокирующей заявки
+            else:
+                j = bisect.bisect_right(self._ticks, t + self.radius) - 1
+                t = self._ticks[j] + self.radius + 1      # выше самой верхней блокирующей заявки
+        return None
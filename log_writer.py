@@ -0,0 +1,145 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+
+LOG_FLUSH_SEC = float(os.getenv("LOG_FLUSH_SEC", "0.5"))      # строка попадает на диск не позже
+LOG_BATCH_LINES = int(os.getenv("LOG_BATCH_LINES", "500"))    # или раньше, если набралась пачка
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "20000"))
+
+
+class LogWriter:
+    """
+    Фоновая запись логов: торговые потоки только кладут строку в очередь,
+    отдельный поток пишет пачками — один open/write/close на файл за сброс.
+
+    Сброс — по LOG_FLUSH_SEC, по LOG_BATCH_LINES строк и при выходе (atexit).
+    Если очередь переполнена (диск не успевает), строка пишется синхронно в вызывающем потоке —
+    логи не теряются (порядок строк при этом может сместиться), а счётчик sync_writes показывает давление.
+    """
+
+    def __init__(self, flush_sec: float = LOG_FLUSH_SEC, batch_lines: int = LOG_BATCH_LINES,
+                 queue_max: int = LOG_QUEUE_MAX):
+        self.flush_sec = float(flush_sec)
+        self.batch_lines = max(1, int(batch_lines))
+        self._q = queue.Queue(maxsize=max(1, int(queue_max)))
+        self._io_lock = threading.Lock()   # фоновый сброс и синхронная запись не пересекаются
+        self._stats_lock = threading.Lock()
+        self._stats = {"lines": 0, "written": 0, "batches": 0, "sync_writes": 0,
+                       "errors": 0, "max_queue": 0, "max_batch_ms": 0.0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _count(self, **kw):
+        with self._stats_lock:
+            for k, v in kw.items():
+                self._stats[k] += v
+
+    def write(self, path: str, line: str):
+        """Добавляет строку (без \\n) в конец файла path."""
+        self._count(lines=1)
+        if self._stop.is_set():
+            self._write_batch({path: [line]})
+            return
+        try:
+            self._q.put_nowait((path, line))
+        except queue.Full:
+            self._count(sync_writes=1)
+            self._write_batch({path: [line]})
+            return
+        qsize = self._q.qsize()
+        with self._stats_lock:
+            if qsize > self._stats["max_queue"]:
+                self._stats["max_queue"] = qsize
+
+    def _write_batch(self, batch: dict):
+        t = time.perf_counter()
+        with self._io_lock:
+            for path, lines in batch.items():
+                try:
+                    with open(path, "a", encoding="utf-8") as f:
+                        f.write("\n".join(lines) + "\n")
+                    self._count(written=len(lines))
+                except Exception as e:
+                    self._count(errors=1)
+                    print(f"Ошибка при записи лога {path}: {e}")
+        ms = (time.perf_counter() - t) * 1000
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["max_batch_ms"] = max(self._stats["max_batch_ms"], ms)
+
+    def _drain(self, first=None) -> dict:
+        batch, n = {}, 0
+        if first is not None:
+            batch.setdefault(first[0], []).append(first[1])
+            n = 1
+        while n < self.batch_lines:
+            try:
+                path, line = self._q.get_nowait()
+            except queue.Empty:
+                break
+            batch.setdefault(path, []).append(line)
+            n += 1
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = self._q.get(timeout=self.flush_sec)
+            except queue.Empty:
+                continue
+            # копим пачку до batch_lines строк или до конца интервала
+            deadline = time.time() + self.flush_sec
+            batch = self._drain(item)
+            n = sum(len(v) for v in batch.values())
+            while n < self.batch_lines and time.time() < deadline and not self._stop.is_set():
+                try:
+                    path, line = self._q.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                batch.setdefault(path, []).append(line)
+                n += 1
+            self._write_batch(batch)
+
+    def flush(self):
+        """Синхронно дописывает всё, что сейчас в очереди."""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self._write_batch(batch)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=max(1.0, self.flush_sec * 2))
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["queued"] = self._q.qsize()
+        return out
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer() -> LogWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter()
+        return _writer
+
+
+def write(path: str, line: str):
+    writer().write(path, line)
+
+
+def stats() -> dict:
+    return writer().stats()
@@ -4,12 +4,19 @@ import time
 import Settings
 import json
 import os
-from tinkoff.invest import Client, OperationType, OperationState            # ← нужен для чтения портфеля
-from config import TOKEN                   # ← твой токен (уже есть в config.py)
+import threading
+import log_writer
+from grid_planner import GridPlanner
+import order_journal
+from order_journal import OrderJournal
+from level_index import LevelIndex
+import ticks
+import ladder
+from tinkoff.invest import OperationType, OperationState
 
 
-# --- Информация об инструментах (как и было) ---
-figi = trading_api.get_figi()
+# --- Информация об инструментах (общий кэшированный справочник trading_api) ---
+figi = trading_api.figi
 
 # --- Директории логов ---
 log_dir = "data/logs"
@@ -36,8 +43,7 @@ def log_error(details):
         "details": details
     }
     try:
-        with open(error_log_file_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+        log_writer.write(error_log_file_path, json.dumps(log_entry, ensure_ascii=False))
     except Exception as e:
         print(f"Ошибка при записи error-лога: {str(e)}")
 
@@ -55,8 +61,7 @@ def log_operation(details, op_name: str | None = None):
         "details": payload
     }
     try:
-        with open(operation_log_file_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+        log_writer.write(operation_log_file_path, json.dumps(log_entry, ensure_ascii=False))
     except Exception as e:
         print(f"Ошибка при записи operation-лога: {str(e)}")
 
@@ -66,11 +71,7 @@ def log_operation(details, op_name: str | None = None):
 # ======================
 
 def getSymbols():
-    res = []
-    for s in figi.keys():
-        res.append(s)
-    res.sort()
-    return ["-"] + res
+    return ["-"] + trading_api.registry.tickers()
 
 
 def send_msg(*msgs):
@@ -134,20 +135,17 @@ def make_instant_report() -> str:
 
 
 def ToPriceStep(price, step):
-    return round(round(price / step) * step, 5)
+    return ticks.snap_to_step(price, step)
 
 
 def WithPrice(price, TP, fi):
-    x = fi["min_price"]
-    step = fi["step"]
-    return float(round(price + TP, x))
+    # price + TP (в деньгах) с точностью инструмента — целочисленно, без дрейфа float
+    return ticks.grid_for(fi).plus_money(price, TP)
 
 
 def WithoutPrice(price, prec, fi):
-    x = fi["min_price"]
-    step = fi["step"]
-    return float(round(price - step * prec, x))
-    # return price - step * prec
+    # price - prec шагов цены
+    return ticks.grid_for(fi).minus_steps(price, prec)
 
 
 def del_order_of_orders(orders, order_id):
@@ -248,6 +246,49 @@ def get_min_order(orders):
 
 # ====== Вырезано ======
 
+def orders_journal() -> OrderJournal:
+    """Журнал карточек ордеров (data/orders.db)."""
+    return order_journal.journal()
+
+
+def import_order_cards() -> int:
+    """
+    Однократный перенос старых data/orders/*.json в журнал.
+    Вызывается из start_bot() до начала торговли, чтобы перенос не шёл посреди цикла.
+    """
+    j = orders_journal()
+    if j.imported():
+        return 0
+    n = j.import_json_dir(ORDERS_DIR, log=send_msg)
+    if n:
+        send_msg(f"[orders] перенесено карточек из {ORDERS_DIR}: {n}")
+    return n
+
+
+def orderlog_init(order_id: str, symbol: str, side: str, size, order_price, step, op_name: str,
+                  message: str = ""):
+    """Заводим карточку ордера сразу после постановки."""
+    ts = datetime.datetime.utcnow().isoformat()
+    card = {
+        "order_id": str(order_id),
+        "symbol": symbol,
+        "side": side,
+        "size": size,
+        "order_price": order_price,
+        "step": step,
+        "created_at": ts,
+        "finished_at": None,
+        "status": "WORKING",
+    }
+    orders_journal().open(card, {
+        "ts": ts,
+        "status": "WORKING",
+        "op_name": op_name,
+        "current_price": read_price(symbol),
+        "message": message
+    })
+
+
 def orderlog_event(order_id: str, symbol: str,
                    status: str, op_name: str,
                    message: str = "", extra: dict | None = None):
@@ -255,19 +296,6 @@ def orderlog_event(order_id: str, symbol: str,
     Добавляет произвольное событие в историю ордера.
     status: например WORKING / FILLED / CANCELED / REPOSTED и т.д.
     """
-    path = orderlog_path(order_id)
-    data = _json_read(path, {})
-    if not data:
-        # если карточки нет — создадим заготовку, чтобы ничего не потерять
-        data = {
-            "order_id": str(order_id),
-            "symbol": symbol,
-            "created_at": datetime.datetime.utcnow().isoformat(),
-            "finished_at": None,
-            "status": status,
-            "events": []
-        }
-
     evt = {
         "ts": datetime.datetime.utcnow().isoformat(),
         "status": status,
@@ -277,65 +305,89 @@ def orderlog_event(order_id: str, symbol: str,
     }
     if extra:
         evt["extra"] = extra
-
-    data["status"] = status
-    data["events"].append(evt)
-    _json_write_atomic(path, data)
+    # одна вставка события вместо перечитывания и перезаписи всей карточки
+    orders_journal().event(order_id, symbol, evt)
 
 
 def orderlog_finish(order_id: str, final_status: str):
     """Фиксируем момент окончания жизни ордера (исполнен/отменён)."""
-    path = orderlog_path(order_id)
-    data = _json_read(path, {})
-    if not data:
-        return
-    finished = datetime.datetime.utcnow().isoformat()
-    data["status"] = final_status
-    data["finished_at"] = finished
-    data["events"].append({
-        "ts": finished,
-        "status": final_status,
-        "op_name": "FINALIZE",
-        "message": f"Завершение ордера ({final_status})"
-    })
-    _json_write_atomic(path, data)
+    orders_journal().finish(order_id, final_status)
+
+
+def order_created_ts(order_ids) -> dict:
+    """{order_id: epoch создания} по карточкам журнала (created_at пишется в UTC)."""
+    out = {}
+    for oid, iso in orders_journal().created_at(order_ids).items():
+        try:
+            out[oid] = datetime.datetime.fromisoformat(iso).replace(tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            pass
+    return out
 
 
-# ==== Хелперы для TP и уникальности цен ====
+def orderlog_card(order_id: str) -> dict:
+    """Карточка ордера целиком (в формате прежнего data/orders/<id>.json)."""
+    return orders_journal().card(order_id)
+
 
 def _quant(price: float, step: float) -> float:
-    return round(round(float(price) / float(step)) * float(step), 10)
+    return ticks.snap_to_step(price, step)
 
 
 def _lot_mult(ticker: str) -> int:
     """Множитель лота инструмента (штук в лоте). Для акций на MOEX часто 10, для фьючерсов – контрактный множитель.
     Если данных нет — считаем 1."""
     try:
-        return int(trading_api.get_figi()[ticker].get("lot") or 1)
+        return trading_api.registry.lot(ticker)
     except Exception:
-        try:
-            return int(figi[ticker].get("lot") or 1)
-        except Exception:
-            return 1
+        return 1
 
 
 
 
-def is_price_level_free(symbol: str, price: float, settings: dict) -> bool:
+_level_indexes = {}  # symbol -> LevelIndex занятых уровней (open + close)
+
+
+def level_index(symbol: str, settings: dict) -> LevelIndex:
     """
-    True — если на уровне 'price' (± 1 шаг) НЕТ активных open/close ордеров.
-    Проверяем локальные структуры settings[symbol]["orders_open"/"orders_close"].
+    Индекс занятых уровней символа по settings[symbol]["orders_open"/"orders_close"].
+    Ведётся инкрементально (level_add / level_discard в местах постановки, отмены и исполнения);
+    полная сверка sync() — только при создании и если число заявок в индексе и в settings разошлось
+    (например, книги сбросили целиком или их поменяли в панели).
     """
     step = get_step(symbol)
-    p_new = _quant(price, step)
+    idx = _level_indexes.get(symbol)
     sym = settings.get(symbol, {})
-    for dct_name in ("orders_open", "orders_close"):
-        for o in sym.get(dct_name, {}).values():
-            p_old = _quant(o["price"], step)
-            # один и тот же уровень для BUY/SELL — запрещаем
-            if abs(p_new - p_old) <= step + 1e-12:
-                return False
-    return True
+    books = (sym.get("orders_open", {}), sym.get("orders_close", {}))
+    if idx is None or idx.step != float(step):
+        idx = _level_indexes[symbol] = LevelIndex(step)
+        idx.sync(*books)
+    elif len(idx) != len(books[0]) + len(books[1]):
+        idx.sync(*books)
+    return idx
+
+
+def level_add(symbol: str, order_id, price):
+    """Заявка поставлена в orders_open/orders_close — её уровень занят."""
+    idx = _level_indexes.get(symbol)
+    if idx is not None:
+        idx.add(order_id, price)
+
+
+def level_discard(symbol: str, order_id):
+    """Заявка снята из orders_open/orders_close (отменена, исполнена, отклонена)."""
+    idx = _level_indexes.get(symbol)
+    if idx is not None:
+        idx.discard(order_id)
+
+
+def is_price_level_free(symbol: str, price: float, settings: dict) -> bool:
+    """
+    True — если на уровне 'price' (± 1 шаг) НЕТ активных open/close ордеров.
+    Проверяем локальные структуры settings[symbol]["orders_open"/"orders_close"]
+    (через индекс тиков: один и тот же уровень для BUY/SELL — запрещаем).
+    """
+    return level_index(symbol, settings).is_free(price)
 
 
 def is_price_level_free_broker(symbol: str, price: float) -> bool:
@@ -370,27 +422,12 @@ def is_price_level_free_combined(symbol: str, price: float, settings: dict) -> b
 
 def get_entry_price_from_json(order_id: str, fallback: float | None = None) -> float | None:
     """
-    Ищем вход (fill) конкретного OPEN-ордера по его order_id в data/orders/<id>.json.
+    Ищем вход (fill) конкретного OPEN-ордера по его order_id в журнале ордеров.
     Предпочтительно берём extra.fill_price из события FILLED,
-    иначе берём order_price из корня.
+    иначе берём order_price карточки.
     """
-    path = orderlog_path(order_id)
-    data = _json_read(path, {})
-    if not data:
-        return fallback
-    # 1) попробуем найти событие FILLED c extra.fill_price
-    for evt in reversed(data.get("events", [])):
-        if evt.get("status") == "FILLED":
-            extra = evt.get("extra") or {}
-            fp = extra.get("fill_price")
-            if fp is not None:
-                try:
-                    return float(fp)
-                except Exception:
-                    pass
-    # 2) иначе fallback на исходную цену ордера
     try:
-        return float(data.get("order_price"))
+        return orders_journal().entry_price(order_id, fallback)
     except Exception:
         return fallback
 
@@ -424,14 +461,12 @@ def check_and_build_sell_grid(symbol, ticker, couple, settings, price_s, figi):
     """
     try:
         # 0) позиция в портфеле и средняя
-        with Client(TOKEN) as client:
-            pf = client.operations.get_portfolio(account_id=trading_api.account_id)
-        pos = next((p for p in pf.positions if p.figi == figi[ticker]["figi"]), None)
+        pos = trading_api.get_position(ticker)
         if not pos:
             return
 
-        avg_price = trading_api.convert_float(pos.average_position_price)
-        lots_portfolio = int(trading_api.convert_float(pos.quantity_lots))
+        avg_price = pos["avg_price"]
+        lots_portfolio = int(pos["lots"])
         if lots_portfolio <= 0:
             return  # нечего продавать (для long); для short логика SELL-grid не применяется
 
@@ -492,20 +527,19 @@ def check_and_build_sell_grid(symbol, ticker, couple, settings, price_s, figi):
         # иначе — стартуем от текущей рыночной цены.
         start_price = max(sg_prices) if sg_prices else _quant(price_s)
 
-        # 6) строим уровни вверх: + step_orders * step инструмента каждый раз
+        # 6) строим уровни вверх сразу всей лестницей (в тиках инструмента):
+        #    шаг — WithPrice(+step_mult) с привязкой к шагу цены, т.е. round(step_mult / step) тиков;
+        #    не дублируем ТОЛЬКО собственные SELL-grid уровни (точное совпадение)
+        grid = ticks.grid_for(figi[symbol])
+        step_ticks = max(1, grid.to_ticks(step_mult))
+        plan = ladder.build_ladder(grid.to_ticks(start_price), step_ticks, lots_to_cover, pack_size, +1,
+                                   side=ladder.SELL, total_lots=lots_to_cover,
+                                   occupied=[grid.to_ticks(p) for p in sg_prices], radius=0)
         remaining = lots_to_cover
-        level_price = start_price
-
-        while remaining > 0:
-            # следующий уровень
-            level_price = _quant(WithPrice(level_price, step_mult, figi[symbol]))
-
-            # не дублируем ТОЛЬКО собственные SELL-grid уровни
-            if _quant(level_price) in sg_prices:
-                continue
-
-            size_here = pack_size if remaining >= pack_size else remaining
 
+        for t, size_here in zip(plan["ticks"], plan["sizes"]):
+            level_price = grid.from_ticks(int(t))
+            size_here = int(size_here)
             try:
                 ord_res = trading_api.short_limit(ticker, size_here, level_price)
                 orderlog_init(str(ord_res["order_id"]), ticker, "short",
@@ -514,14 +548,14 @@ def check_and_build_sell_grid(symbol, ticker, couple, settings, price_s, figi):
                      "size": size_here, "type": "tp", "tag": "sell_grid"}
                 settings.setdefault(symbol, {})
                 settings[symbol].setdefault("orders_close", {})[o["order_id"]] = o
+                level_add(symbol, o["order_id"], level_price)
                 settings[symbol].setdefault("orders", []).append(o)
                 sg_prices.add(_quant(level_price))
                 remaining -= size_here
                 send_msg(f"{symbol}: SELL-grid {size_here} @ {level_price} (осталось {remaining})")
             except Exception as e:
-                # Не останавливаем построение всей сетки; просто лог и идём дальше по уровням
+                # Не останавливаем построение всей сетки; недоставленный объём доставим в следующий проход
                 send_msg(f"{symbol}: предупреждение при постановке SELL {size_here} @ {level_price}: {e}")
-                # пробуем следующий уровень, не уменьшая remaining
                 continue
 
         Settings.saveSettings(settings)
@@ -572,59 +606,39 @@ MOSCOW_UTC_OFFSET = 3  # МСК = UTC+3
 def _utc_today_str():
     return datetime.datetime.utcnow().date().isoformat()
 
-def _is_ts_on_day(ts_iso: str, day_utc: str) -> bool:
-    # ожидаем ts вида 'YYYY-MM-DDThh:mm:ss' (как мы пишем в orderlog_* и log_operation)
-    return str(ts_iso).startswith(day_utc)
-
 def _iter_day_filled_events(day_utc: str):
     """
-    Бежим по data/orders/*.json и собираем события FILLED за указанный день (UTC).
+    Собираем события FILLED за указанный день (UTC) по индексу журнала (день, символ) —
+    читаются только строки этого дня, а не вся история ордеров.
     На основании side + op_name определяем BUY/SELL и сумму сделки.
     """
-    if not os.path.isdir(ORDERS_DIR):
-        return
-    for fname in os.listdir(ORDERS_DIR):
-        if not fname.endswith(".json"):
-            continue
-        path = os.path.join(ORDERS_DIR, fname)
+    for row in orders_journal().filled_events(day_utc):
         try:
-            data = _json_read(path, {})
-            symbol = data.get("symbol")
-            side   = (data.get("side") or "").lower()   # 'long' | 'short'
-            size   = float(data.get("size") or 0)
-            order_price_root = float(data.get("order_price") or 0)
-            events = data.get("events", [])
-            for evt in events:
-                if evt.get("status") != "FILLED":
-                    continue
-                ts  = evt.get("ts", "")
-                if not _is_ts_on_day(ts, day_utc):
-                    continue
-                opn = (evt.get("op_name") or "").upper()  # 'OPEN->FILLED' | 'TP->FILLED'
-                # цена исполнения: при OPEN мы писали extra.fill_price; иначе fallback на order_price
-                fill = evt.get("extra", {}).get("fill_price")
-                try:
-                    price = float(fill if fill is not None else evt.get("order_price", order_price_root))
-                except Exception:
-                    price = order_price_root
-                # Классификация сделки на BUY/SELL:
-                if "OPEN" in opn:
-                    trade = "BUY" if side == "long" else "SELL"
-                elif "TP" in opn:
-                    trade = "SELL" if side == "long" else "BUY"
-                else:
-                    # На всякий случай – если придёт другой тег.
-                    # Считаем OPEN как выше.
-                    trade = "BUY" if side == "long" else "SELL"
-                yield {
-                    "symbol": symbol,
-                    "trade": trade,      # 'BUY'|'SELL'
-                    "side": side,        # 'long'|'short'
-                    "size": float(size),
-                    "price": float(price),
-                    "ts": ts,
-                    "op_name": opn,
-                }
+            symbol = row["symbol"]
+            side   = (row["side"] or "").lower()   # 'long' | 'short'
+            size   = float(row["size"] or 0)
+            ts  = row["ts"] or ""
+            opn = (row["op_name"] or "").upper()  # 'OPEN->FILLED' | 'TP->FILLED'
+            # цена исполнения: extra.fill_price события, иначе order_price (подставлена при записи)
+            price = float(row["price"] or 0)
+            # Классификация сделки на BUY/SELL:
+            if "OPEN" in opn:
+                trade = "BUY" if side == "long" else "SELL"
+            elif "TP" in opn:
+                trade = "SELL" if side == "long" else "BUY"
+            else:
+                # На всякий случай – если придёт другой тег.
+                # Считаем OPEN как выше.
+                trade = "BUY" if side == "long" else "SELL"
+            yield {
+                "symbol": symbol,
+                "trade": trade,      # 'BUY'|'SELL'
+                "side": side,        # 'long'|'short'
+                "size": float(size),
+                "price": float(price),
+                "ts": ts,
+                "op_name": opn,
+            }
         except Exception:
             continue
 
@@ -646,47 +660,38 @@ def _get_portfolio_snapshot():
     """
     pf_positions = {}
     try:
-        with Client(TOKEN) as client:
-            pf = client.operations.get_portfolio(account_id=trading_api.account_id)
+        positions = trading_api.get_portfolio_positions()  # {figi: {...}} из кэша портфеля
 
-        fmap = {v["figi"]: k for k, v in figi.items()}  # figi -> тикер
+        # цены всех позиций — одним запросом, дальше get_price берёт их из кэша
+        try:
+            trading_api.price_cache.refresh(list(positions.keys()))
+        except Exception as e:
+            send_msg(f"(portfolio snapshot prices) {e}")
 
-        for p in pf.positions:
-            ticker = fmap.get(p.figi, p.figi)
+        for pfigi, p in positions.items():
+            ticker = trading_api.registry.ticker_by_figi(pfigi, pfigi)  # figi -> тикер
 
-            lots = float(trading_api.convert_float(getattr(p, "quantity_lots", 0)) or 0)
+            lots = float(p["lots"])
             if abs(lots) < 1e-9:
                 continue
 
-            avgp = float(trading_api.convert_float(getattr(p, "average_position_price", 0)) or 0)
+            avgp = float(p["avg_price"])
             last = float(trading_api.get_price(ticker))
 
             lot_mult = _lot_mult(ticker)
             mtm = (last - avgp) * lots * lot_mult
             mv  = last * lots * lot_mult
 
-            exp_yield = getattr(p, "expected_yield", None)
-            try:
-                exp_yield = float(trading_api.convert_float(exp_yield)) if exp_yield is not None else None
-            except Exception:
-                exp_yield = None
-
-            # для фьючерсов у позиции есть var_margin
-            try:
-                varm = float(trading_api.convert_float(getattr(p, "var_margin", 0)) or 0)
-            except Exception:
-                varm = 0.0
-
             pf_positions[str(ticker)] = {
                 "lots": lots,
                 "avg_price": avgp,
                 "last_price": last,
                 "market_value": mv,
                 "mtm": mtm,
-                "expected_yield": exp_yield,
-                "instrument_type": str(getattr(p, "instrument_type", "")).lower(),
+                "expected_yield": p["expected_yield"],
+                "instrument_type": p["instrument_type"],
                 "lot_mult": lot_mult,
-                "var_margin": varm,  # ← новое поле
+                "var_margin": p["var_margin"],  # для фьючерсов у позиции есть var_margin
             }
     except Exception as e:
         send_msg(f"(portfolio snapshot error) {e}")
@@ -979,6 +984,7 @@ def mirror_broker_active_to_settings(active: list, couple: dict, settings: dict,
             settings[symbol]["orders_open"][str(st["order_id"])] = st
         else:
             settings[symbol]["orders_close"][str(st["order_id"])] = st
+        level_add(symbol, st["order_id"], st["price"])
         settings[symbol]["orders"].append(st)
     side = str(couple.get("side","")).lower()
     for o in active or []:
@@ -1023,23 +1029,22 @@ def refill_missing_opens(symbol: str, ticker: str, couple: dict, settings: dict)
     try: decimals = int(figi[symbol]["min_price"])
     except Exception: decimals = 2
     placed = 0
-    price_next = _next(anchor)
-    while len(open_list) + placed < desired:
-        price_cand = round(float(price_next), decimals)
-        # не дублируем ни локально, ни у брокера
-        if is_price_level_free_combined(ticker, price_cand, settings):
-            try:
-                ord_res = place(ticker, lot_size, price_cand)
-                orderlog_init(str(ord_res["order_id"]), ticker, side, lot_size,
-                              price_cand, figi[symbol]["step"], "OPEN:REFILL")
-                o = {"order_id": ord_res["order_id"], "price": price_cand, "size": lot_size, "type": "open"}
-                settings[symbol].setdefault("orders_open", {})[str(ord_res["order_id"])] = o
-                settings[symbol].setdefault("orders", []).append(o)
-                send_msg(f"{symbol}: дозаполнен OPEN {lot_size} @ {price_cand}")
-                placed += 1
-            except Exception as e:
-                send_msg(f"{symbol}: не удалось дозаполнить OPEN {lot_size} @ {price_cand}: {e}")
-        price_next = _next(price_next)
+    # не дублируем ни локально, ни у брокера: занятые уровни снимаем один раз, план — локально
+    planner = GridPlanner(symbol, ticker, settings, step=figi[symbol]["step"])
+    levels = planner.plan(round(float(_next(anchor)), decimals), lambda p: round(float(_next(p)), decimals),
+                          desired - len(open_list), lot_size)
+    for price_cand, lots, ord_res, err in planner.place(levels, lambda lots, price: place(ticker, lots, price)):
+        if err is not None:
+            send_msg(f"{symbol}: не удалось дозаполнить OPEN {lots} @ {price_cand}: {err}")
+            continue
+        orderlog_init(str(ord_res["order_id"]), ticker, side, lots,
+                      price_cand, figi[symbol]["step"], "OPEN:REFILL")
+        o = {"order_id": ord_res["order_id"], "price": price_cand, "size": lots, "type": "open"}
+        settings[symbol].setdefault("orders_open", {})[str(ord_res["order_id"])] = o
+        level_add(symbol, ord_res["order_id"], price_cand)
+        settings[symbol].setdefault("orders", []).append(o)
+        send_msg(f"{symbol}: дозаполнен OPEN {lots} @ {price_cand}")
+        placed += 1
     Settings.saveSettings(settings)
     return placed
 
@@ -0,0 +1,335 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+
+ORDERS_DB_PATH = "data/orders.db"
+
+# поля карточки, которые лежат отдельными колонками; остальное — JSON в orders.data
+_CARD_COLUMNS = ("order_id", "symbol", "side", "size", "order_price", "status", "created_at", "finished_at")
+_EVENT_COLUMNS = ("ts", "status", "op_name", "current_price", "message")
+
+
+def _utcnow() -> str:
+    return datetime.datetime.utcnow().isoformat()
+
+
+def _num(x):
+    try:
+        return float(x) if x is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class OrderJournal:
+    """
+    Карточки ордеров и их события в SQLite (WAL) вместо data/orders/<id>.json.
+
+    Событие — одна вставка в order_events плюс обновление статуса карточки в той же транзакции;
+    карточка целиком собирается только по запросу (card()).
+    """
+
+    def __init__(self, path: str = ORDERS_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id    TEXT PRIMARY KEY,
+                symbol      TEXT,
+                side        TEXT,
+                size        REAL,
+                order_price REAL,
+                status      TEXT,
+                created_at  TEXT,
+                finished_at TEXT,
+                ts          TEXT,
+                data        TEXT
+            );
+            CREATE INDEX IF NOT EXISTS orders_symbol_status ON orders (symbol, status);
+            CREATE INDEX IF NOT EXISTS orders_ts ON orders (ts);
+            CREATE TABLE IF NOT EXISTS order_events (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id      TEXT NOT NULL,
+                ts            TEXT,
+                status        TEXT,
+                op_name       TEXT,
+                current_price REAL,
+                message       TEXT,
+                extra         TEXT
+            );
+            CREATE INDEX IF NOT EXISTS order_events_order ON order_events (order_id);
+            CREATE TABLE IF NOT EXISTS fill_events (
+                event_id INTEGER PRIMARY KEY,
+                day      TEXT NOT NULL,
+                ts       TEXT,
+                symbol   TEXT,
+                side     TEXT,
+                size     REAL,
+                price    REAL,
+                op_name  TEXT
+            );
+            CREATE INDEX IF NOT EXISTS fill_events_day_symbol ON fill_events (day, symbol);
+            CREATE TABLE IF NOT EXISTS consumed_ops (
+                op_id    TEXT PRIMARY KEY,
+                order_id TEXT,
+                ts       TEXT
+            );
+            CREATE TABLE IF NOT EXISTS journal_meta (k TEXT PRIMARY KEY, v TEXT);
+        """)
+        self._backfill_fills()
+
+    def _backfill_fills(self):
+        """Индекс исполнений для базы, созданной до появления fill_events (один раз)."""
+        if self._conn.execute("SELECT 1 FROM journal_meta WHERE k='fills_indexed'").fetchone():
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("""
+                INSERT OR IGNORE INTO fill_events (event_id, day, ts, symbol, side, size, price, op_name)
+                SELECT e.id, substr(e.ts, 1, 10), e.ts, o.symbol, o.side, o.size,
+                       COALESCE(json_extract(e.extra, '$.fill_price'), o.order_price), e.op_name
+                FROM order_events e JOIN orders o ON o.order_id = e.order_id
+                WHERE e.status = 'FILLED'""")
+            self._conn.execute("INSERT OR REPLACE INTO journal_meta (k, v) VALUES ('fills_indexed', ?)", (_utcnow(),))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    # --- запись ---
+
+    def _insert_card(self, card: dict) -> bool:
+        rest = {k: v for k, v in card.items() if k not in _CARD_COLUMNS and k != "events"}
+        cur = self._conn.execute(
+            "INSERT OR IGNORE INTO orders (order_id, symbol, side, size, order_price, status, "
+            "created_at, finished_at, ts, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(card["order_id"]), card.get("symbol"), card.get("side"), _num(card.get("size")),
+             _num(card.get("order_price")), card.get("status"), card.get("created_at"),
+             card.get("finished_at"), card.get("finished_at") or card.get("created_at"),
+             json.dumps(rest, ensure_ascii=False) if rest else None))
+        return cur.rowcount > 0
+
+    def _insert_event(self, order_id: str, evt: dict):
+        extra = evt.get("extra")
+        cur = self._conn.execute(
+            "INSERT INTO order_events (order_id, ts, status, op_name, current_price, message, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(order_id), evt.get("ts"), evt.get("status"), evt.get("op_name"),
+             _num(evt.get("current_price")), evt.get("message"),
+             json.dumps(extra, ensure_ascii=False) if extra else None))
+        if evt.get("status") == "FILLED":
+            # исполнение сразу попадает в индекс по (день, символ) — отчёт не трогает остальную историю
+            ts = str(evt.get("ts") or "")
+            fill = _num((extra or {}).get("fill_price"))
+            if fill is None:
+                fill = _num(evt.get("order_price"))
+            self._conn.execute(
+                "INSERT INTO fill_events (event_id, day, ts, symbol, side, size, price, op_name) "
+                "SELECT ?, ?, ?, symbol, side, size, COALESCE(?, order_price), ? FROM orders WHERE order_id=?",
+                (cur.lastrowid, ts[:10], ts, fill, evt.get("op_name"), str(order_id)))
+
+    def _tx(self, fn, *args):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                res = fn(*args)
+                self._conn.execute("COMMIT")
+                return res
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def open(self, card: dict, event: dict | None = None):
+        """Новая карточка (если такой ещё нет) и, при наличии, её первое событие."""
+        def _do():
+            self._insert_card(card)
+            if event:
+                self._insert_event(card["order_id"], event)
+        self._tx(_do)
+
+    def event(self, order_id: str, symbol: str, evt: dict, finished_at: str | None = None):
+        """
+        Добавляет событие и выставляет статус карточки; карточку-заготовку создаёт, если её нет.
+        finished_at — заодно отметить окончание жизни ордера.
+        """
+        oid = str(order_id)
+
+        def _do():
+            self._insert_card({"order_id": oid, "symbol": symbol, "created_at": evt.get("ts"),
+                               "finished_at": None, "status": evt.get("status")})
+            self._insert_event(oid, evt)
+            self._conn.execute(
+                "UPDATE orders SET status=?, ts=?, finished_at=COALESCE(?, finished_at) WHERE order_id=?",
+                (evt.get("status"), evt.get("ts"), finished_at, oid))
+        self._tx(_do)
+
+    def finish(self, order_id: str, final_status: str) -> bool:
+        """Как orderlog_finish: только для существующей карточки."""
+        oid = str(order_id)
+        with self._lock:
+            row = self._conn.execute("SELECT symbol FROM orders WHERE order_id=?", (oid,)).fetchone()
+        if row is None:
+            return False
+        ts = _utcnow()
+        self.event(oid, row[0], {"ts": ts, "status": final_status, "op_name": "FINALIZE",
+                                 "message": f"Завершение ордера ({final_status})"}, finished_at=ts)
+        return True
+
+    def consume_op(self, op_id: str, order_id: str):
+        """Операция ленты счёта сопоставлена заявке — другой заявке её больше не отдаём (и после перезапуска)."""
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO consumed_ops (op_id, order_id, ts) VALUES (?, ?, ?)",
+                               (str(op_id), str(order_id), _utcnow()))
+
+    # --- чтение ---
+
+    def card(self, order_id: str) -> dict:
+        """Карточка в прежнем формате JSON-файла ({} — если нет)."""
+        oid = str(order_id)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT order_id, symbol, side, size, order_price, status, created_at, finished_at, data "
+                "FROM orders WHERE order_id=?", (oid,)).fetchone()
+            if row is None:
+                return {}
+            events = self._conn.execute(
+                "SELECT ts, status, op_name, current_price, message, extra FROM order_events "
+                "WHERE order_id=? ORDER BY id", (oid,)).fetchall()
+        card = json.loads(row[8]) if row[8] else {}
+        card.update({k: v for k, v in zip(_CARD_COLUMNS, row[:8])})
+        card["events"] = []
+        for e in events:
+            evt = {k: v for k, v in zip(_EVENT_COLUMNS, e[:5]) if v is not None or k == "message"}
+            if e[5]:
+                evt["extra"] = json.loads(e[5])
+            card["events"].append(evt)
+        return card
+
+    def created_at(self, order_ids) -> dict:
+        """{order_id: created_at (ISO UTC)} для известных журналу заявок."""
+        ids = [str(o) for o in order_ids]
+        out = {}
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT order_id, created_at FROM orders WHERE order_id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                out.update({oid: ts for oid, ts in rows if ts})
+        return out
+
+    def consumed_ops(self, op_ids) -> set:
+        """Какие из op_ids уже сопоставлены заявкам."""
+        ids = [str(o) for o in op_ids]
+        out = set()
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT op_id FROM consumed_ops WHERE op_id IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                out.update(r[0] for r in rows)
+        return out
+
+    def entry_price(self, order_id: str, fallback: float | None = None) -> float | None:
+        """extra.fill_price последнего FILLED, иначе цена заявки из карточки."""
+        oid = str(order_id)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT extra FROM order_events WHERE order_id=? AND status='FILLED' AND extra IS NOT NULL "
+                "ORDER BY id DESC", (oid,)).fetchall()
+            price = self._conn.execute("SELECT order_price FROM orders WHERE order_id=?", (oid,)).fetchone()
+        for (extra,) in rows:
+            fp = _num(json.loads(extra).get("fill_price"))
+            if fp is not None:
+                return fp
+        if price is None or price[0] is None:
+            return fallback
+        return float(price[0])
+
+    def filled_events(self, day_from: str, day_to: str | None = None, symbol: str | None = None):
+        """
+        Исполнения за день UTC 'YYYY-MM-DD' (или за дни [day_from; day_to]), по индексу (day, symbol).
+        price — extra.fill_price события, иначе цена заявки из карточки.
+        """
+        sql = ("SELECT symbol, side, size, price, ts, op_name FROM fill_events "
+               "WHERE day >= ? AND day <= ?")
+        args = [day_from, day_to or day_from]
+        if symbol is not None:
+            sql += " AND symbol = ?"
+            args.append(symbol)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY event_id", args).fetchall()
+        for symbol, side, size, price, ts, op_name in rows:
+            yield {"symbol": symbol, "side": side, "size": size, "price": price, "ts": ts, "op_name": op_name}
+
+    # --- перенос старых карточек ---
+
+    def import_json_dir(self, orders_dir: str, log=print) -> int:
+        """
+        Однократно переносит data/orders/*.json (повторный запуск пропускает уже перенесённые).
+        Возвращает число перенесённых карточек; файлы не трогает. log — куда писать о пропущенных файлах.
+        """
+        if not os.path.isdir(orders_dir):
+            return 0
+        done = 0
+        batch = []
+
+        def _flush():
+            nonlocal done
+            for card in batch:
+                if self._insert_card(card):
+                    for evt in card.get("events") or []:
+                        self._insert_event(card["order_id"], evt)
+                    done += 1
+
+        for fname in os.listdir(orders_dir):
+            if not fname.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(orders_dir, fname), encoding="utf-8") as f:
+                    card = json.load(f)
+            except (OSError, ValueError) as e:
+                log(f"[orders] {fname} пропущен: {e}")
+                continue
+            if not isinstance(card, dict):
+                continue
+            card.setdefault("order_id", fname[:-len(".json")])
+            batch.append(card)
+            if len(batch) >= 1000:
+                self._tx(_flush)
+                batch.clear()
+        if batch:
+            self._tx(_flush)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO journal_meta (k, v) VALUES ('imported', ?)", (_utcnow(),))
+        return done
+
+    def imported(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM journal_meta WHERE k='imported'").fetchone() is not None
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def journal() -> OrderJournal:
+    """Общий на процесс журнал data/orders.db (бот и FillResolver пишут через одно соединение)."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = OrderJournal()
+        return _journal
+
+
+if __name__ == '__main__':
+    import sys
+    src = sys.argv[1] if len(sys.argv) > 1 else "data/orders"
+    print(f"перенесено карточек: {OrderJournal().import_json_dir(src)}")
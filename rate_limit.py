@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+
+
+# Лимиты брокера на unary-запросы в минуту по сервисам (переопределяются через TINKOFF_RPM_<SERVICE>)
+DEFAULT_QUOTAS = {
+    "users": 100,
+    "instruments": 200,
+    "market_data": 600,
+    "operations": 200,
+    "orders": 300,
+}
+
+
+# Доля минутной квоты, которую можно потратить залпом (остальное — равномерно)
+BURST_SHARE = float(os.environ.get("TINKOFF_RPM_BURST_SHARE", "0.1"))
+
+
+def reset_after(e, default: float = 1.0) -> float:
+    """Сколько секунд до сброса окна лимита (из метаданных ответа брокера на RESOURCE_EXHAUSTED)."""
+    try:
+        return float(getattr(getattr(e, "metadata", None), "ratelimit_reset", None) or default)
+    except Exception:
+        return default
+
+
+class TokenBucket:
+    """
+    Token bucket под минутную квоту брокера quota_per_min: ёмкость burst, пополнение (quota - burst) / 60
+    в секунду. Тогда за любые 60 с проходит не больше burst + rate * 60 = quota запросов.
+    reserve() сразу списывает токен и возвращает, сколько секунд нужно подождать,
+    поэтому одинаково годится и для time.sleep, и для asyncio.sleep.
+    """
+
+    def __init__(self, quota_per_min: float, burst: float | None = None):
+        quota = float(quota_per_min)
+        if burst is None:
+            burst = quota * BURST_SHARE
+        self.capacity = min(max(1.0, float(burst)), quota - 1.0) if quota > 1 else 1.0
+        self.rate = max(quota - self.capacity, 1.0) / 60.0   # токенов в секунду
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def reserve(self, n: float = 1.0) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= n
+            wait = max(0.0, -self._tokens / self.rate, self._blocked_until - now)
+            self.acquired += 1
+            self.waited += wait
+            return wait
+
+    def acquire(self, n: float = 1.0) -> float:
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, seconds: float):
+        """Брокер ответил RESOURCE_EXHAUSTED — обнуляем запас и ждём сброса окна."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+            self._blocked_until = max(self._blocked_until, now + max(0.0, float(seconds)))
+
+
+class RateLimiter:
+    """Набор TokenBucket по сервисам API: limiter.acquire("orders") перед каждым запросом."""
+
+    def __init__(self, quotas: dict):
+        self._buckets = {name: TokenBucket(rpm) for name, rpm in quotas.items()}
+
+    @classmethod
+    def from_env(cls, defaults: dict = DEFAULT_QUOTAS) -> "RateLimiter":
+        quotas = {}
+        for name, rpm in defaults.items():
+            quotas[name] = float(os.environ.get(f"TINKOFF_RPM_{name.upper()}", str(rpm)))
+        return cls(quotas)
+
+    def bucket(self, service: str) -> TokenBucket:
+        return self._buckets[service]
+
+    def reserve(self, service: str) -> float:
+        return self._buckets[service].reserve()
+
+    def acquire(self, service: str) -> float:
+        return self._buckets[service].acquire()
+
+    def penalize(self, service: str, seconds: float):
+        self._buckets[service].penalize(seconds)
+
+    def stats(self) -> dict:
+        return {name: {"acquired": b.acquired, "waited_sec": round(b.waited, 3)}
+                for name, b in self._buckets.items()}
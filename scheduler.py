@@ -0,0 +1,117 @@
+import datetime as _dt
+import heapq
+import itertools
+import threading
+import time
+
+
+class DeadlineScheduler:
+    """
+    Очередь с приоритетом по дедлайнам: каждая обязанность бота (цикл, проверка статуса торгов,
+    синхронизация с брокером, окна клиринга) объявляет, когда ей нужно проснуться.
+
+        sched.every("cycle", 10)                    # периодическая
+        sched.daily("clearing", [time(13, 57)], now_msk)  # по часам МСК
+        sched.schedule("status", ts)                # разовый дедлайн (перезаписывает прежний)
+        due = sched.wait(wake=stream.wait_for_trades)
+
+    Перепланирование — «ленивое»: старые записи в куче не удаляются, а пропускаются по токену.
+    """
+
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self._heap = []               # (deadline, seq, name, token)
+        self._tokens = {}             # name -> актуальный token
+        self._periods = {}            # name -> период, сек
+        self._daily = {}              # name -> (sorted times, now_fn)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    # --- объявление обязанностей ---
+
+    def schedule(self, name: str, deadline: float):
+        """Ставит (или переносит) дедлайн обязанности name на момент deadline (epoch)."""
+        with self._lock:
+            token = next(self._seq)
+            self._tokens[name] = token
+            heapq.heappush(self._heap, (float(deadline), token, name, token))
+
+    def cancel(self, name: str):
+        with self._lock:
+            self._tokens.pop(name, None)
+            self._periods.pop(name, None)
+            self._daily.pop(name, None)
+
+    def every(self, name: str, period: float, first: float | None = None):
+        self._periods[name] = float(period)
+        self.schedule(name, first if first is not None else self._clock() + float(period))
+
+    def daily(self, name: str, times, now_fn):
+        """Будит в каждый из моментов times (datetime.time) по часам now_fn() (например, МСК)."""
+        self._daily[name] = (sorted(times), now_fn)
+        self.schedule(name, self._next_daily(name))
+
+    def _next_daily(self, name: str) -> float:
+        times, now_fn = self._daily[name]
+        now = now_fn()
+        for day in (0, 1):
+            date = now.date() + _dt.timedelta(days=day)
+            for t in times:
+                at = _dt.datetime.combine(date, t, tzinfo=now.tzinfo)
+                if at > now:
+                    return self._clock() + (at - now).total_seconds()
+        return self._clock() + 86400.0
+
+    # --- выборка ---
+
+    def _peek(self):
+        while self._heap:
+            deadline, _, name, token = self._heap[0]
+            if self._tokens.get(name) == token:
+                return deadline, name
+            heapq.heappop(self._heap)  # устаревшая запись
+        return None
+
+    def next_deadline(self) -> float | None:
+        with self._lock:
+            top = self._peek()
+            return top[0] if top else None
+
+    def pop_due(self, now: float | None = None) -> list:
+        """Забирает все наступившие обязанности и перепланирует периодические/ежедневные."""
+        now = self._clock() if now is None else now
+        due = []
+        with self._lock:
+            while True:
+                top = self._peek()
+                if not top or top[0] > now:
+                    break
+                heapq.heappop(self._heap)
+                self._tokens.pop(top[1], None)
+                due.append(top[1])
+        for name in due:
+            if name in self._periods:
+                self.schedule(name, now + self._periods[name])
+            elif name in self._daily:
+                self.schedule(name, self._next_daily(name))
+        return due
+
+    def wait(self, wake=None, max_wait: float | None = None) -> list:
+        """
+        Спит до ближайшего дедлайна и возвращает список наступивших обязанностей.
+        wake(timeout) — необязательный «будильник» (например, ожидание сделки из потока):
+        если он вернул непустой результат раньше срока, в списке будет "wake".
+        """
+        nxt = self.next_deadline()
+        timeout = max(0.0, nxt - self._clock()) if nxt is not None else (max_wait or 60.0)
+        if max_wait is not None:
+            timeout = min(timeout, max_wait)
+        woke = False
+        if timeout > 0:
+            if wake is not None:
+                woke = bool(wake(timeout))
+            else:
+                self._sleep(timeout)
+        due = self.pop_due()
+        return (["wake"] + due) if woke else due
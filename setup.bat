@@ -3,6 +3,7 @@ pip install threading
 pip install PyQt5
 pip install apscheduler
 pip install websocket-client
+pip install numpy
 pip install -i https://test.pypi.org/simple/ --extra-index-url=https://pypi.org/simple/ tinkoff-invest-openapi-client
 pip install tinkoff-investments
 pip install openapi_client
@@ -0,0 +1,212 @@
+import ast
+import os
+import sqlite3
+import threading
+
+
+STATE_DB_PATH = "data/state.db"
+
+# Большие словари заявок символа храним построчно, остальное — одной строкой на символ
+SPLIT_BOOKS = ("orders_open", "orders_close", "positions_no_tp", "orders")
+
+
+def _split_symbol(st) -> dict:
+    """
+    Состояние символа -> {(book, key): text} в порядке элементов коллекций.
+    book "" — всё, кроме крупных коллекций; "#" — какие коллекции и какого типа разнесены по строкам.
+    """
+    rows = {}
+    if not isinstance(st, dict):
+        rows[("=", "")] = repr(st)
+        return rows
+    scalar, spec = {}, {}
+    for name, val in st.items():
+        if name in SPLIT_BOOKS and isinstance(val, dict) \
+                and all(isinstance(k, str) and isinstance(v, dict) for k, v in val.items()):
+            spec[name] = "dict"
+            for k, v in val.items():
+                rows[(name, k)] = repr(v)
+        elif name in SPLIT_BOOKS and isinstance(val, list) \
+                and all(isinstance(v, dict) and "order_id" in v for v in val) \
+                and len({str(v["order_id"]) for v in val}) == len(val):
+            spec[name] = "list"
+            for v in val:
+                rows[(name, str(v["order_id"]))] = repr(v)
+        else:
+            scalar[name] = val
+    rows[("", "")] = repr(scalar)
+    rows[("#", "")] = repr(spec)
+    return rows
+
+
+def _assign_seq(old: dict, rows: dict) -> dict:
+    """
+    {(book, key): text} -> {(book, key): (seq, text)}.
+    seq хранит порядок элементов и стабилен: у уже сохранённой заявки он прежний, новая получает
+    следующий номер книги, поэтому удаление или добавление заявки не переписывает соседние строки.
+    Только если порядок поменялся (перестановка в списке), книга нумеруется заново.
+    """
+    top = {}
+    for (b, _), (seq, _) in old.items():
+        if seq > top.get(b, -1):
+            top[b] = seq
+    books = {}
+    for (b, k), text in rows.items():
+        books.setdefault(b, []).append((k, text))
+    out = {}
+    for b, items in books.items():
+        seqs, last, nxt = [], -1, top.get(b, -1)
+        for k, _ in items:
+            prev = old.get((b, k))
+            if prev is None:
+                nxt += 1
+                seq = nxt
+            else:
+                seq = prev[0]
+            if seq <= last:
+                seqs = list(range(len(items)))
+                break
+            seqs.append(seq)
+            last = seq
+        for (k, text), seq in zip(items, seqs):
+            out[(b, k)] = (seq, text)
+    return out
+
+
+def _join_symbol(rows: dict):
+    """Обратно к _split_symbol."""
+    if ("=", "") in rows:
+        return ast.literal_eval(rows[("=", "")][1])
+    st = ast.literal_eval(rows.get(("", ""), (0, "{}"))[1])
+    spec = ast.literal_eval(rows.get(("#", ""), (0, "{}"))[1])
+    books = {name: [] for name in spec}
+    for (book, key), (seq, text) in rows.items():
+        if book not in ("", "#"):
+            books.setdefault(book, []).append((seq, key, text))
+    for name, items in books.items():
+        items.sort()
+        if spec.get(name) == "list":
+            st[name] = [ast.literal_eval(t) for _, _, t in items]
+        else:
+            st[name] = {k: ast.literal_eval(t) for _, k, t in items}
+    return st
+
+
+class StateStore:
+    """
+    Состояние бота в SQLite (WAL): строки (symbol, book, key) вместо одного большого settings.txt.
+
+    save(settings) сравнивает новое состояние с последним сохранённым и пишет в одной транзакции
+    только изменившиеся строки; если базу менял другой процесс (панель), внутри той же транзакции
+    сначала перечитывает текущие строки, чтобы дифф был честным.
+    """
+
+    def __init__(self, path: str = STATE_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS state_rows (
+                symbol TEXT NOT NULL,
+                book   TEXT NOT NULL,
+                key    TEXT NOT NULL,
+                seq    INTEGER NOT NULL,
+                data   TEXT NOT NULL,
+                PRIMARY KEY (symbol, book, key)
+            )""")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS state_meta (k TEXT PRIMARY KEY, v TEXT)")
+        self._cache = {}      # symbol -> {(book, key): (seq, text)} — как сейчас лежит в базе
+        self._gen = None      # номер последней известной нам записи
+        self.rows_written = 0
+
+    # --- meta ---
+
+    def meta(self, k: str, default=None):
+        row = self._conn.execute("SELECT v FROM state_meta WHERE k=?", (k,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, k: str, v):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO state_meta (k, v) VALUES (?, ?)", (k, str(v)))
+
+    def _db_gen(self):
+        return self.meta("gen", "0")
+
+    # --- чтение ---
+
+    def _read_rows(self) -> dict:
+        rows = {}
+        cur = self._conn.execute("SELECT symbol, book, key, seq, data FROM state_rows")
+        for s, b, k, seq, data in cur:
+            rows.setdefault(s, {})[(b, k)] = (seq, data)
+        return rows
+
+    def load(self) -> dict:
+        with self._lock:
+            self._conn.execute("BEGIN")  # строки и номер записи — из одного снимка базы
+            try:
+                self._cache = self._read_rows()
+                self._gen = self._db_gen()
+            finally:
+                self._conn.execute("COMMIT")
+            return {symbol: _join_symbol(rows) for symbol, rows in self._cache.items()}
+
+    def is_empty(self) -> bool:
+        return self._conn.execute("SELECT 1 FROM state_rows LIMIT 1").fetchone() is None
+
+    # --- запись ---
+
+    def save(self, settings: dict, symbols=None) -> int:
+        """
+        Пишет изменившиеся строки одной транзакцией; возвращает их количество.
+        symbols — сверять только эти символы (остальные считаются неизменными).
+        """
+        full = symbols is None
+        new = {}
+        for symbol in list(settings) if full else list(symbols):
+            if symbol in settings:
+                new[symbol] = _split_symbol(settings[symbol])
+        with self._lock:
+            # проверка номера записи, дифф и его увеличение — внутри одной IMMEDIATE-транзакции:
+            # бот и панель не могут закоммитить один и тот же номер поверх чужих строк
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                gen = self._db_gen()
+                if self._gen != gen:
+                    self._cache = self._read_rows()  # базу менял другой процесс
+                    self._gen = gen
+                if full:
+                    symbols = set(new) | set(self._cache)
+                upserts, deletes = [], []
+                for symbol in symbols:
+                    old = self._cache.get(symbol, {})
+                    rows = _assign_seq(old, new[symbol]) if symbol in new else {}
+                    upserts += [(symbol, b, k, seq, text) for (b, k), (seq, text) in rows.items()
+                                if old.get((b, k)) != (seq, text)]
+                    deletes += [(symbol, b, k) for (b, k) in old if (b, k) not in rows]
+                if not upserts and not deletes:
+                    self._conn.execute("COMMIT")
+                    return 0
+                gen = str(int(gen or 0) + 1)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO state_rows (symbol, book, key, seq, data) VALUES (?, ?, ?, ?, ?)",
+                    upserts)
+                self._conn.executemany("DELETE FROM state_rows WHERE symbol=? AND book=? AND key=?", deletes)
+                self._conn.execute("INSERT OR REPLACE INTO state_meta (k, v) VALUES ('gen', ?)", (gen,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                self._gen = None  # кэш мог разойтись с базой — перечитаем при следующей записи
+                raise
+            for s, b, k, seq, text in upserts:
+                self._cache.setdefault(s, {})[(b, k)] = (seq, text)
+            for s, b, k in deletes:
+                self._cache[s].pop((b, k), None)
+                if not self._cache[s]:
+                    del self._cache[s]
+            self._gen = gen
+            self.rows_written += len(upserts) + len(deletes)
+            return len(upserts) + len(deletes)
@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+
+from tinkoff.invest import (
+    Client,
+    LastPriceInstrument,
+    MarketDataRequest,
+    SubscribeLastPriceRequest,
+    SubscriptionAction,
+)
+
+
+class MarketStream:
+    """
+    Потоковый режим: подписка на последние цены и сделки по счёту.
+
+    - last price -> сразу в price_cache (get_price перестаёт ходить в unary API);
+    - сделки (trades_stream) -> событие в очередь, сбрасываем снимки заявок/портфеля
+      и будим главный цикл бота, не дожидаясь конца паузы.
+
+    client_factory — как открыть Client (по умолчанию Client(token, target=target));
+    через него же поток подключается к локальному фейковому серверу в тестах.
+    """
+
+    def __init__(self, token: str, account_id: str, price_cache=None,
+                 on_trade=None, target: str | None = None, client_factory=None):
+        self._token = token
+        self._account_id = account_id
+        self._price_cache = price_cache
+        self._on_trade = on_trade
+        if client_factory is None:
+            kwargs = {"target": target} if target else {}
+            client_factory = lambda: Client(token, **kwargs)
+        self._client_factory = client_factory
+        self._figis = set()
+        self._lock = threading.Lock()    # _figis и очередь текущего соединения меняются вместе
+        self._conn_requests = None       # очередь запросов подписки текущего соединения (или None)
+        self.events = queue.Queue()      # события сделок для бота
+        self._stop = threading.Event()
+        self._threads = []
+        self.last_event_ts = 0.0
+        self.reconnects = 0
+
+    # --- подписки ---
+
+    def _subscribe_request(self, figis, action):
+        return MarketDataRequest(
+            subscribe_last_price_request=SubscribeLastPriceRequest(
+                subscription_action=action,
+                instruments=[LastPriceInstrument(figi=f) for f in sorted(figis)],
+            )
+        )
+
+    def _open_requests(self):
+        """
+        Новое соединение: снимок текущих _figis для первой подписки и своя очередь дельт.
+        Дельты set_instruments попадают только в очередь живого соединения, поэтому старый
+        генератор их не перехватит, а повторной подписки после старта без инструментов не будет.
+        """
+        with self._lock:
+            if not self._figis:
+                return None, None
+            requests, done = queue.Queue(), threading.Event()
+            self._conn_requests = requests
+            first = self._subscribe_request(self._figis, SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE)
+        return self._request_iter(first, requests, done), (requests, done)
+
+    def _close_requests(self, conn):
+        requests, done = conn
+        done.set()
+        with self._lock:
+            if self._conn_requests is requests:
+                self._conn_requests = None
+
+    def _request_iter(self, first, requests, done):
+        yield first
+        while not (self._stop.is_set() or done.is_set()):
+            try:
+                yield requests.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def set_instruments(self, figis):
+        """Меняет набор инструментов на лету (досписываемся/отписываемся дельтой)."""
+        new = set(f for f in figis if f)
+        with self._lock:
+            added, removed = new - self._figis, self._figis - new
+            self._figis = new
+            requests = self._conn_requests
+            if requests is None:
+                return  # соединения нет — новое подпишется на снимок _figis
+            if added:
+                requests.put(self._subscribe_request(added, SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE))
+            if removed:
+                requests.put(self._subscribe_request(removed, SubscriptionAction.SUBSCRIPTION_ACTION_UNSUBSCRIBE))
+
+    # --- потоки ---
+
+    def _run_forever(self, name, body):
+        delay = 1.0
+        while not self._stop.is_set():
+            try:
+                body()
+                delay = 1.0
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                self.reconnects += 1
+                print(f"[stream {name}] обрыв: {e}. переподключение через {delay:.0f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def _prices_body(self):
+        req_iter, conn = self._open_requests()
+        if req_iter is None:
+            time.sleep(1)
+            return
+        try:
+            with self._client_factory() as client:
+                for resp in client.market_data_stream.market_data_stream(req_iter):
+                    if self._stop.is_set():
+                        return
+                    lp = getattr(resp, "last_price", None)
+                    if lp and lp.figi and self._price_cache is not None:
+                        self._price_cache.put(lp.figi, lp.price)
+        finally:
+            self._close_requests(conn)
+
+    def _trades_body(self):
+        with self._client_factory() as client:
+            for resp in client.orders_stream.trades_stream(accounts=[self._account_id]):
+                if self._stop.is_set():
+                    return
+                ot = getattr(resp, "order_trades", None)
+                if not ot or not ot.order_id:
+                    continue  # ping
+                evt = {
+                    "kind": "trade",
+                    "order_id": str(ot.order_id),
+                    "figi": ot.figi,
+                    "direction": int(getattr(ot.direction, "value", ot.direction) or 0),
+                    "trades": [(t.price, int(t.quantity)) for t in (ot.trades or [])],
+                    "trade_ids": [str(t.trade_id) for t in (ot.trades or []) if getattr(t, "trade_id", None)],
+                    "ts": time.time(),
+                }
+                self.last_event_ts = evt["ts"]
+                if self._on_trade:
+                    try:
+                        self._on_trade(evt)
+                    except Exception as e:
+                        print(f"[stream trades] ошибка обработчика: {e}")
+                self.events.put(evt)
+
+    def start(self, figis=()):
+        with self._lock:
+            self._figis = set(f for f in figis if f)
+        for name, body in (("prices", self._prices_body), ("trades", self._trades_body)):
+            t = threading.Thread(target=self._run_forever, args=(name, body), daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    # --- для бота ---
+
+    def wait_for_trades(self, timeout: float) -> list:
+        """Ждёт первое событие сделки (или timeout) и забирает всё накопившееся."""
+        out = []
+        try:
+            out.append(self.events.get(timeout=max(0.0, timeout)))
+        except queue.Empty:
+            return out
+        while True:
+            try:
+                out.append(self.events.get_nowait())
+            except queue.Empty:
+                return out
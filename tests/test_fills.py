@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fills import FILLED, FillResolver  # noqa: E402
+from instruments import Instrument  # noqa: E402
+from order_journal import OrderJournal  # noqa: E402
+
+
+def _op(op_id, price, ts, qty=10, direction=1, figi="FIGI"):
+    return {"id": op_id, "figi": figi, "direction": direction, "qty": qty, "price": price, "ts": ts,
+            "trade_ids": []}
+
+
+def test_cancelled_order_with_matching_operation_is_not_filled(tmp_path):
+    now = time.time()
+    ops = [_op("op1", 99.0, now - 5)]   # ручная сделка по той же цене и объёму
+    journal = OrderJournal(str(tmp_path / "orders.db"))
+    resolver = FillResolver(lambda since: ops, lambda oid: (3, None, 0), store=lambda: journal)
+
+    res = resolver.resolve("FIGI", 10, [("a", 1, 1, 100.0, now - 60)], tol=0.005)
+
+    assert res["a"]["status"] == 3
+    assert journal.consumed_ops(["op1"]) == set()
+
+
+def test_confirmed_fill_takes_price_from_feed_and_consumes_it(tmp_path):
+    now = time.time()
+    ops = [_op("op1", 99.0, now - 5)]
+    journal = OrderJournal(str(tmp_path / "orders.db"))
+    resolver = FillResolver(lambda since: ops, lambda oid: (FILLED, None, 1), store=lambda: journal)
+
+    res = resolver.resolve("FIGI", 10, [("b", 1, 1, 100.0, now - 60)], tol=0.005)
+
+    assert res["b"] == {"status": FILLED, "price": 99.0, "source": "state"}
+    assert journal.consumed_ops(["op1"]) == {"op1"}
+
+
+def test_filled_status_without_executed_lots_is_not_a_fill(tmp_path):
+    now = time.time()
+    resolver = FillResolver(lambda since: [], lambda oid: (FILLED, 100.0, 0))
+
+    res = resolver.resolve("FIGI", 10, [("c", 1, 1, 100.0, now - 60)], tol=0.005)
+
+    assert res["c"]["status"] is None
+
+
+def test_consumed_operation_survives_restart(tmp_path):
+    now = time.time()
+    ops = [_op("op1", 99.0, now - 5)]
+    path = str(tmp_path / "orders.db")
+    first = FillResolver(lambda since: ops, lambda oid: (FILLED, None, 1), store=lambda: OrderJournal(path))
+    assert first.resolve("FIGI", 10, [("d", 1, 1, 100.0, now - 60)], tol=0.005)["d"]["price"] == 99.0
+
+    journal = OrderJournal(path)   # «перезапуск»: новый резолвер, память пустая
+    second = FillResolver(lambda since: ops, lambda oid: (FILLED, None, 1), store=lambda: journal)
+    res = second.resolve("FIGI", 10, [("e", 1, 1, 100.0, now - 60)], tol=0.005)
+
+    assert res["e"]["price"] is None   # операция уже отдана заявке d
+
+
+def test_futures_operation_price_is_converted_to_points():
+    # фьючерс на индекс: шаг 10 пунктов стоит 7.5 руб., цена 150000 пунктов = 112500 руб.
+    ins = Instrument("RIZ5", {"figi": "FUT", "lot": 1, "min_price": 0, "step": 10, "units": 10, "nano": 0,
+                              "step_amount": 7.5})
+    assert ins.points(112500.0) == 150000.0
+
+    now = time.time()
+    ops = [_op("op1", ins.points(112507.5), now - 5, qty=1, direction=2, figi="FUT")]
+    resolver = FillResolver(lambda since: ops, lambda oid: (FILLED, None, 1))
+
+    # TP на продажу по 150000: операция по 150010 пунктов — исполнение, цена — в пунктах
+    res = resolver.resolve("FUT", 1, [("tp", 2, 1, 150000.0, now - 60)], tol=ins.step / 2)
+
+    assert res["tp"]["price"] == 150010.0
+
+
+def test_non_futures_price_is_unchanged():
+    ins = Instrument("SBER", {"figi": "S", "lot": 10, "min_price": 2, "step": 0.01, "units": 0,
+                              "nano": 10000000})
+    assert ins.points(301.25) == 301.25
@@ -0,0 +1,164 @@
+import os
+import queue
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("tinkoff.invest")
+
+from tinkoff.invest import SubscriptionAction  # noqa: E402
+
+from streaming import MarketStream  # noqa: E402
+
+
+class _Conn:
+    def __init__(self, server, n):
+        self.server = server
+        self.n = n
+        self.out = queue.Queue()   # ответы сервера клиенту
+
+    def consume(self, requests):
+        for req in requests:
+            self.server.seen.put((self.n, req))
+
+
+class FakeServer:
+    """Фейковый market_data_stream/trades_stream: запоминает запросы подписки по соединениям."""
+
+    def __init__(self):
+        self.seen = queue.Queue()   # (номер соединения, MarketDataRequest)
+        self.conns = []
+        self.stop = threading.Event()
+
+    # --- со стороны теста ---
+
+    def push_price(self, conn_no, figi, price):
+        lp = SimpleNamespace(figi=figi, price=price)
+        self.conns[conn_no - 1].out.put(SimpleNamespace(last_price=lp))
+
+    def break_conn(self, conn_no):
+        self.conns[conn_no - 1].out.put(ConnectionError("обрыв"))
+
+    # --- со стороны клиента ---
+
+    def market_data_stream(self, requests):
+        conn = _Conn(self, len(self.conns) + 1)
+        self.conns.append(conn)
+        threading.Thread(target=conn.consume, args=(requests,), daemon=True).start()
+        while not self.stop.is_set():
+            try:
+                item = conn.out.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def trades_stream(self, accounts):
+        self.stop.wait()
+        return
+        yield
+
+    def client(self):
+        server = self
+
+        class _Client:
+            market_data_stream = SimpleNamespace(market_data_stream=server.market_data_stream)
+            orders_stream = SimpleNamespace(trades_stream=server.trades_stream)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+        return _Client()
+
+
+class _Prices:
+    def __init__(self):
+        self.got = queue.Queue()
+
+    def put(self, figi, price):
+        self.got.put((figi, price))
+
+
+def _figis(req):
+    sub = req.subscribe_last_price_request
+    return sub.subscription_action, sorted(i.figi for i in sub.instruments)
+
+
+def _no_more(server, wait=0.5):
+    time.sleep(wait)
+    return server.seen.empty()
+
+
+@pytest.fixture
+def server():
+    srv = FakeServer()
+    yield srv
+    srv.stop.set()
+
+
+def _stream(server, figis=(), prices=None):
+    return MarketStream("token", "acc", price_cache=prices, client_factory=server.client).start(figis)
+
+
+def test_start_without_instruments_subscribes_once(server):
+    stream = _stream(server)
+    try:
+        stream.set_instruments(["F1"])
+        conn, req = server.seen.get(timeout=5)
+        assert conn == 1
+        assert _figis(req) == (SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, ["F1"])
+        assert _no_more(server)
+    finally:
+        stream.stop()
+
+
+def test_delta_goes_to_live_connection(server):
+    stream = _stream(server, ["F1"])
+    try:
+        assert server.seen.get(timeout=5)[0] == 1
+        stream.set_instruments(["F2"])
+        got = [server.seen.get(timeout=5) for _ in range(2)]
+        assert sorted(_figis(r) for _, r in got) == [
+            (SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, ["F2"]),
+            (SubscriptionAction.SUBSCRIPTION_ACTION_UNSUBSCRIBE, ["F1"]),
+        ]
+        assert {c for c, _ in got} == {1}
+    finally:
+        stream.stop()
+
+
+def test_reconnect_subscribes_current_snapshot(server):
+    stream = _stream(server, ["F1"])
+    try:
+        assert server.seen.get(timeout=5)[0] == 1
+        server.break_conn(1)
+        deadline = time.time() + 5
+        while stream.reconnects < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        stream.set_instruments(["F1", "F2"])   # пока ждём переподключения
+        conn, req = server.seen.get(timeout=5)
+        assert conn == 2
+        assert _figis(req) == (SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE, ["F1", "F2"])
+        assert _no_more(server)   # ни старое, ни новое соединение не получили дельту повторно
+    finally:
+        stream.stop()
+
+
+def test_last_price_goes_to_cache(server):
+    prices = _Prices()
+    stream = _stream(server, ["F1"], prices=prices)
+    try:
+        server.seen.get(timeout=5)
+        server.push_price(1, "F1", "Q")
+        assert prices.got.get(timeout=5) == ("F1", "Q")
+    finally:
+        stream.stop()
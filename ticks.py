@@ -0,0 +1,136 @@
+from functools import lru_cache
+
+from tinkoff.invest.schemas import Quotation
+
+
+# Цены внутри считаем целыми «нано» (1e-9), как в Quotation: без Decimal/str и без дрейфа float
+NANO = 1_000_000_000
+
+
+def to_nano(price) -> int:
+    """float/int/str -> целые нано (округление до 1e-9)."""
+    return int(round(float(price) * NANO))
+
+
+def from_nano(n: int) -> float:
+    return n / NANO
+
+
+def _div_half_up(n: int, d: int) -> int:
+    """round(n / d) с округлением половины от нуля (как ROUND_HALF_UP)."""
+    q, r = divmod(abs(n), d)
+    if 2 * r >= d:
+        q += 1
+    return q if n >= 0 else -q
+
+
+def round_to(n: int, unit: int) -> int:
+    """Округляет нано-цену к ближайшему кратному unit (тоже в нано)."""
+    return _div_half_up(n, unit) * unit
+
+
+def quotation_to_nano(q) -> int:
+    return int(q.units) * NANO + int(q.nano)
+
+
+def nano_to_quotation(n: int) -> Quotation:
+    units = abs(n) // NANO
+    nano = abs(n) - units * NANO
+    sign = -1 if n < 0 else 1
+    return Quotation(units=sign * units, nano=sign * nano)  # у units и nano один знак
+
+
+class PriceGrid:
+    """
+    Целочисленная арифметика цен одного инструмента.
+
+    quant — точность цены (10^-decimals), inc — шаг цены инструмента; оба в нано.
+    Тик — целое число шагов: price = ticks * inc.
+    """
+
+    __slots__ = ("decimals", "quant", "inc")
+
+    def __init__(self, inc_units: int, inc_nano: int, decimals: int):
+        self.decimals = int(decimals)
+        self.quant = 10 ** max(0, 9 - self.decimals)
+        self.inc = int(inc_units) * NANO + int(inc_nano) or NANO
+
+    # --- точность / шаг ---
+
+    def round_quant(self, n: int) -> int:
+        return round_to(n, self.quant)
+
+    def snap(self, n: int) -> int:
+        """К ближайшей цене, кратной шагу инструмента."""
+        return round_to(n, self.inc)
+
+    def to_ticks(self, price) -> int:
+        return _div_half_up(to_nano(price), self.inc)
+
+    def from_ticks(self, ticks: int) -> float:
+        return from_nano(ticks * self.inc)
+
+    # --- Quotation ---
+
+    def quotation(self, price) -> Quotation:
+        """Цена -> Quotation: одно округление до точности инструмента, nano кратен 10^(9-decimals)."""
+        return nano_to_quotation(self.round_quant(to_nano(price)))
+
+    def price(self, q) -> float:
+        return from_nano(self.round_quant(quotation_to_nano(q)))
+
+    # --- сдвиги цены (семантика misc.WithPrice / misc.WithoutPrice) ---
+
+    def plus_money(self, price, amount) -> float:
+        """price + amount (в деньгах), с точностью инструмента."""
+        return from_nano(self.round_quant(to_nano(price) + to_nano(amount)))
+
+    def minus_steps(self, price, steps) -> float:
+        """price - steps * шаг цены, с точностью инструмента."""
+        return from_nano(self.round_quant(to_nano(price) - _div_half_up(to_nano(steps) * self.inc, NANO)))
+
+
+@lru_cache(maxsize=4096)
+def grid(inc_units: int, inc_nano: int, decimals: int) -> PriceGrid:
+    return PriceGrid(inc_units, inc_nano, decimals)
+
+
+def grid_for(fi) -> PriceGrid:
+    """PriceGrid по записи справочника (figi[ticker]: step, nano, units, min_price) или Instrument."""
+    if hasattr(fi, "inc_units"):
+        return grid(fi.inc_units, fi.inc_nano, fi.decimals)
+    n = to_nano(fi["step"])
+    return grid(n // NANO, n % NANO, int(fi.get("min_price") or 0))
+
+
+def snap_to_step(price, step) -> float:
+    """Цена к ближайшему кратному step (оба — числа в деньгах)."""
+    return from_nano(round_to(to_nano(price), to_nano(step) or NANO))
+
+
+class QuotationConverter:
+    """
+    Предвычисленный конвертер цены инструмента в Quotation для пачек заявок:
+    квант точности уже в нано, за один проход — округление, знак, units/nano;
+    check() — проверка Quotation перед отправкой заявки.
+    """
+
+    __slots__ = ("decimals", "quant", "half")
+
+    def __init__(self, grid: PriceGrid):
+        self.decimals = grid.decimals
+        self.quant = grid.quant
+        self.half = grid.quant // 2
+
+    def from_float(self, price) -> Quotation:
+        n = int(round(price * NANO))
+        q = self.quant
+        if n >= 0:
+            n = (n + self.half) // q * q
+            return Quotation(units=n // NANO, nano=n % NANO)
+        n = (self.half - n) // q * q
+        return Quotation(units=-(n // NANO), nano=-(n % NANO))
+
+    def check(self, q) -> bool:
+        """nano кратен точности инструмента и знаки units/nano согласованы."""
+        return q.nano % self.quant == 0 and not (q.units > 0 > q.nano or q.units < 0 < q.nano)
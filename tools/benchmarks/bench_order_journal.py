@@ -0,0 +1,65 @@
+# Бенчмарк дневного отчёта: обход data/orders/*.json против индекса fill_events журнала ордеров.
+# Запуск из корня репозитория: python tools/benchmarks/bench_order_journal.py [n]
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from order_journal import OrderJournal  # noqa: E402
+
+
+def bench(n: int = 100_000, days: int = 250):
+    """
+    Бенчмарк дневного отчёта на n исторических карточках: старый обход data/orders/*.json
+    с фильтром по префиксу ts против индексированного запроса fill_events за один день.
+    """
+    tmp = tempfile.mkdtemp(prefix="orders_bench_")
+    try:
+        orders_dir = os.path.join(tmp, "orders")
+        os.makedirs(orders_dir)
+        start = datetime.date(2026, 1, 1)
+        for i in range(n):
+            day = (start + datetime.timedelta(days=random.randrange(days))).isoformat()
+            card = {"order_id": f"o{i}", "symbol": random.choice(("SBER", "GAZP", "LKOH", "YNDX")),
+                    "side": random.choice(("long", "short")), "size": 1, "order_price": 100.0,
+                    "status": "FILLED", "created_at": f"{day}T10:00:00", "finished_at": f"{day}T11:00:00",
+                    "events": [{"ts": f"{day}T10:00:00", "status": "WORKING", "op_name": "OPEN", "message": ""},
+                               {"ts": f"{day}T11:00:00", "status": "FILLED", "op_name": "OPEN->FILLED",
+                                "message": "", "extra": {"fill_price": 99.9}}]}
+            with open(os.path.join(orders_dir, f"o{i}.json"), "w", encoding="utf-8") as f:
+                json.dump(card, f)
+        day = (start + datetime.timedelta(days=days // 2)).isoformat()
+
+        t = time.perf_counter()
+        legacy = 0
+        for fname in os.listdir(orders_dir):
+            with open(os.path.join(orders_dir, fname), encoding="utf-8") as f:
+                data = json.load(f)
+            legacy += sum(1 for e in data["events"] if e["status"] == "FILLED" and e["ts"].startswith(day))
+        t_legacy = time.perf_counter() - t
+
+        j = OrderJournal(os.path.join(tmp, "orders.db"))
+        t = time.perf_counter()
+        j.import_json_dir(orders_dir)
+        t_import = time.perf_counter() - t
+        t = time.perf_counter()
+        indexed = sum(1 for _ in j.filled_events(day))
+        t_indexed = time.perf_counter() - t
+        assert legacy == indexed, (legacy, indexed)
+
+        print(f"карточек: {n}, исполнений за {day}: {indexed}")
+        print(f"обход JSON-файлов      {t_legacy * 1000:9.1f} мс")
+        print(f"индекс fill_events     {t_indexed * 1000:9.1f} мс")
+        print(f"(однократный перенос   {t_import * 1000:9.1f} мс)")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,47 @@
+# Микробенчмарк цены -> Quotation: старый путь через Decimal/str против ticks.PriceGrid и QuotationConverter.
+# Запуск из корня репозитория: python tools/benchmarks/bench_ticks.py [n]
+import os
+import random
+import sys
+import timeit
+from decimal import Decimal, ROUND_HALF_UP
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from tinkoff.invest.schemas import Quotation  # noqa: E402
+
+from ticks import NANO, QuotationConverter, grid_for  # noqa: E402
+
+
+def bench(n: int = 200_000):
+    decimals, step = 2, 0.01
+    quant = Decimal(1).scaleb(-decimals)
+    prices = [round(random.uniform(1, 5000), 4) for _ in range(1000)]
+
+    def legacy(price):
+        # как было: quantize -> Quotation -> ещё раз quantize + Quotation для проверки nano
+        def _q(p):
+            d = Decimal(str(p)).quantize(quant, rounding=ROUND_HALF_UP)
+            units = int(d)
+            return Quotation(units=units, nano=int((d - units) * NANO))
+        d = float(Decimal(str(price)).quantize(quant, rounding=ROUND_HALF_UP))
+        q = _q(d)
+        if _q(d).nano % (10 ** (9 - decimals)):
+            raise ValueError
+        return q
+
+    g = grid_for({"step": step, "min_price": decimals})
+    conv = QuotationConverter(g)
+    for p in prices:
+        assert legacy(p) == g.quotation(p) == conv.from_float(p), p
+        assert conv.check(conv.from_float(p)), p
+
+    loops = max(1, n // len(prices))
+    for name, fn in (("legacy Decimal", legacy), ("PriceGrid.quotation", g.quotation),
+                     ("QuotationConverter", conv.from_float)):
+        sec = timeit.timeit(lambda: [fn(p) for p in prices], number=loops)
+        print(f"{name:22s} {sec / (loops * len(prices)) * 1e6:7.3f} мкс/цена")
+
+
+if __name__ == '__main__':
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
@@ -1,5 +1,5 @@
 from config import *
-from tinkoff.invest import Client
+from tinkoff.invest import Client, GetOperationsByCursorRequest, OperationState, OperationType
 from tinkoff.invest.schemas import Quotation
 import time
 import datetime
@@ -10,6 +10,17 @@ from grpc import StatusCode
 from decimal import Decimal, ROUND_HALF_UP, ROUND_DOWN
 import re
 from uuid import uuid4, UUID
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from client_pool import make_pool
+from instruments import InstrumentCatalog, InstrumentRegistry
+from trading_schedule import TradingCalendar
+from fills import FillResolver
+import order_journal
+import ticks
+from broker_cache import CycleSnapshot, OrdersSnapshot, PriceCache
+from streaming import MarketStream
+from rate_limit import RateLimiter, reset_after
 
 
 UUID_RE = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
@@ -26,9 +37,16 @@ def _as_valid_uuid_or_none(x) -> str | None:
 
 NANOS_IN_UNIT = Decimal("1000000000")
 
-slt = 0.1  # Время задержки между запросами к API
 client_oa = openapi.api_client(TOKEN)
 
+# Token bucket на каждый сервис API: ждём ровно столько, сколько требует квота брокера
+limiter = RateLimiter.from_env()
+
+# Общий пул gRPC-сессий: один handshake на канал, а не на каждый запрос
+API_POOL_SIZE = int(os.environ.get("TINKOFF_POOL_SIZE", "4"))
+client_pool = make_pool(TOKEN, size=API_POOL_SIZE, limiter=limiter)
+
+
 _TRANSIENT_CODES = {
     StatusCode.INTERNAL,
     StatusCode.UNAVAILABLE,
@@ -38,8 +56,6 @@ _TRANSIENT_MSGS = (
     "internal",
     "network error",
     "deadline exceeded",
-    "ratelimit",
-    "resource_exhausted",
     "temporarily unavailable",
 )
 
@@ -52,10 +68,10 @@ def _quantize_price_for_symbol(symbol: str, price: float | int) -> Decimal:
     Округляет price до допустимой точности инструмента (кол-во знаков после запятой),
     используя settings из figi[symbol]["min_price"].
     """
-    # min_price у тебя — это КОЛИЧЕСТВО знаков после запятой (0, 2, 3 и т.п.)
-    decimals = int(figi[symbol]["min_price"])
-    q = Decimal("1").scaleb(-decimals)  # 0.01 для 2 знаков, 0.001 для 3 и т.д.
-    return Decimal(str(price)).quantize(q, rounding=ROUND_HALF_UP)
+    # min_price у тебя — это КОЛИЧЕСТВО знаков после запятой (0, 2, 3 и т.п.);
+    # округляем целочисленно в нано (ROUND_HALF_UP), Decimal — только на выходе
+    g = ticks.grid_for(registry[symbol])
+    return Decimal(g.round_quant(ticks.to_nano(price))).scaleb(-9).quantize(registry[symbol].quant)
 
 def _price_to_quotation(symbol: str, price: float | int) -> Quotation:
     """
@@ -68,22 +84,6 @@ def _price_to_quotation(symbol: str, price: float | int) -> Quotation:
 
 
 
-def _assert_price_step_ok(symbol: str, price: float | int):
-    """
-    Проверяет, что цена кратна шагу и точность соответствует инструменту.
-    Бросает ValueError, если не ок (лучше выявить до отправки заказа).
-    """
-    decimals = int(figi[symbol]["min_price"])
-    step_ticks = float(figi[symbol]["step"])  # "сколько тиков отступ", у тебя это множитель
-
-    d = _quantize_price_for_symbol(symbol, price)
-    # Проверка «кратности сотым/тысячным» делается по nano: nano % 10**(9-decimals) == 0
-    scale = 10 ** (9 - decimals)
-    q = _price_to_quotation(symbol, float(d))
-    if (q.nano % scale) != 0:
-        raise ValueError(f"{symbol}: некорректная точность nano для цены {d} (decimals={decimals})")
-
-
 def get_price_quotation(symbol: str, price: float | int) -> Quotation:
     """
     Гарантирует:
@@ -91,40 +91,42 @@ def get_price_quotation(symbol: str, price: float | int) -> Quotation:
     - nano строго 9 знаков,
     - nano кратен нужному разряду (для сотых — 10^7).
     """
-    d = _quantize_price_for_symbol(symbol, price)
-    q = _price_to_quotation(symbol, float(d))
-    # валидация nano (поймаем проблему сразу, не в брокере)
-    _assert_price_step_ok(symbol, float(d))
-    return q
+    # одно целочисленное округление и один Quotation; nano кратен кванту по построению
+    return quotation_converter(symbol).from_float(price)
+
+
+_converters = {}  # symbol -> (catalog.version, QuotationConverter)
+
+
+def quotation_converter(symbol: str) -> ticks.QuotationConverter:
+    """Предвычисленный конвертер цены в Quotation; пересобирается только при обновлении справочника."""
+    item = _converters.get(symbol)
+    if item is None or item[0] != catalog.version:
+        item = _converters[symbol] = (catalog.version, ticks.QuotationConverter(ticks.grid_for(registry[symbol])))
+    return item[1]
 
 
 # Получение идентификатора аккаунта
 def get_account_id():
-    with Client(TOKEN) as client:
+    limiter.acquire("users")
+    with client_pool.client("users") as client:
         # Получаем список аккаунтов и берем первый
         res = client.users.get_accounts().accounts[0].id
         return str(res)
 
 
 account_id = get_account_id()  # Получаем ID аккаунта
-time.sleep(slt)
 
 
-# Получение FIGI для различных типов инструментов (акции, облигации, валюты, фьючерсы и т.д.)
-def get_figi():
+# Полная выгрузка инструментов (акции, облигации, валюты, фьючерсы и т.д.) у брокера
+def _fetch_instruments():
     exchss = []
-    with Client(TOKEN) as client:
+    with client_pool.client("instruments") as client:
         # Получаем инструменты с разных рынков
-        exchss.append(client.instruments.bonds().instruments)
-        time.sleep(slt)
-        exchss.append(client.instruments.currencies().instruments)
-        time.sleep(slt)
-        exchss.append(client.instruments.etfs().instruments)
-        time.sleep(slt)
-        exchss.append(client.instruments.futures().instruments)
-        time.sleep(slt)
-        exchss.append(client.instruments.shares().instruments)
-        time.sleep(slt)
+        for fetch in (client.instruments.bonds, client.instruments.currencies, client.instruments.etfs,
+                      client.instruments.futures, client.instruments.shares):
+            limiter.acquire("instruments")
+            exchss.append(fetch().instruments)
 
     data = {}
 
@@ -146,18 +148,37 @@ def get_figi():
                 # if exch.ticker == "SiU2":
                 #     print(exch)
 
+            # стоимость шага цены в валюте — есть только у фьючерсов (у них пункт не равен рублю)
+            amount = getattr(exch, "min_price_increment_amount", None)
+            step_amount = (int(amount.units) + int(amount.nano) / 1e9) if amount is not None else 0.0
+
             # Добавляем информацию о каждом инструменте в словарь
             data[exch.ticker] = {
                 'figi': exch.figi,  # Уникальный идентификатор инструмента
                 'lot': exch.lot,  # Лот
                 'min_price': min_price,  # Минимальная цена
                 'step': step,  # Шаг цены
-                'nano': str(exch.min_price_increment.nano)  # Нано-шаг
+                'nano': str(exch.min_price_increment.nano),  # Нано-шаг
+                'units': int(exch.min_price_increment.units),  # Целая часть шага
+                'uid': exch.uid,  # UID инструмента
+                'exchange': exch.exchange,  # торговая площадка (ключ расписания торгов)
+                'step_amount': step_amount or None,  # стоимость шага цены в валюте (фьючерсы)
             }
 
     return data  # Возвращаем данные всех инструментов
 
 
+# Справочник кэшируется в data/instruments.json и обновляется в фоне по TTL
+catalog = InstrumentCatalog(_fetch_instruments)
+# Индексы ticker/figi/uid поверх справочника (перестраиваются при его обновлении)
+registry = InstrumentRegistry(catalog)
+
+
+# Получение FIGI для различных типов инструментов — общий для всех модулей словарь
+def get_figi():
+    return catalog.ensure()
+
+
 figi = get_figi()  # Получаем информацию о инструментах
 
 
@@ -170,28 +191,47 @@ def convert_float(q) -> float:
 
 
 
+# Последние цены сразу по списку инструментов — один запрос get_last_prices
+def _fetch_last_prices(figis: list) -> dict:
+    limiter.acquire("market_data")
+    with client_pool.client("market_data") as client:
+        res = client.market_data.get_last_prices(figi=list(figis))
+    return {lp.figi: lp.price for lp in res.last_prices}
+
+
+# Кэш последних цен: сколько секунд цена считается свежей
+PRICE_MAX_AGE = float(os.environ.get("TINKOFF_PRICE_TTL", "3"))
+price_cache = PriceCache(_fetch_last_prices, max_age=PRICE_MAX_AGE)
+
+
+def figis_for(tickers) -> list:
+    return [registry.figi(t) for t in tickers if t in registry]
+
+
+def refresh_prices(tickers, only_stale: bool = False) -> None:
+    """
+    Отслеживать цены этих тикеров и обновить их все одним запросом.
+    only_stale — в потоковом режиме: запрашивать только цены, которые поток давно не присылал.
+    """
+    price_cache.watch(figis_for(tickers))
+    if only_stale:
+        price_cache.refresh_stale()
+    else:
+        price_cache.refresh()
+
+
 # Получение цены с учетом минимального шага
 def get_price(ticker: str) -> float:
     """
     Возвращает цену как float, собранную из Quotation корректно:
-    - nano всегда паддится до 9 знаков
+    - units и nano складываются в целые нано (без строк и Decimal)
     - потом приводим к допустимой точности инструмента
     """
     try:
+        q = price_cache.get(registry.figi(ticker))  # из пакетного кэша последних цен
 
-
-        # Плюс/минус учитываем через знак
-        sign = -1 if (q.units < 0 or q.nano < 0) else 1
-        units = abs(q.units)
-        nano = abs(q.nano)
-
-        # ВАЖНО: паддинг до 9 знаков
-        price_str = f"{units}.{nano:09d}"
-        raw = Decimal(price_str) * sign
-
-        # округление под точность инструмента
-        d = _quantize_price_for_symbol(ticker, float(raw))
-        return float(d)
+        # units*1e9 + nano целым числом (знак у них общий), округление под точность инструмента
+        return ticks.grid_for(registry[ticker]).price(q)
     except Exception as e:
         print(f"Ошибка при получении цены для {ticker}: {e}")
         return 0.0
@@ -217,23 +257,113 @@ def order_const(order):
 
 
 # Получение статуса торгов для тикера
+def _fetch_trading_schedules(from_ts: float, to_ts: float) -> dict:
+    """Расписание всех площадок одним запросом: {exchange: [(start, end), ...]} в epoch."""
+    def _ts(v):
+        try:
+            t = v.timestamp()
+        except Exception:
+            return None
+        return t if t > 86400 else None  # незаполненное время приходит как 1970-01-01
+
+    limiter.acquire("instruments")
+    with client_pool.client("instruments") as client:
+        res = client.instruments.trading_schedules(
+            from_=datetime.datetime.fromtimestamp(from_ts, tz=datetime.timezone.utc),
+            to=datetime.datetime.fromtimestamp(to_ts, tz=datetime.timezone.utc),
+        )
+
+    out = {}
+    for sch in res.exchanges:
+        sessions = out.setdefault(sch.exchange, [])
+        for day in sch.days:
+            if not day.is_trading_day:
+                continue
+            start, end = _ts(day.start_time), _ts(day.end_time)
+            c_start, c_end = _ts(day.clearing_start_time), _ts(day.clearing_end_time)
+            if start and end:
+                if c_start and c_end and start < c_start < c_end < end:
+                    sessions += [(start, c_start), (c_end, end)]  # дневной клиринг — перерыв
+                else:
+                    sessions.append((start, end))
+            e_start, e_end = _ts(day.evening_start_time), _ts(day.evening_end_time)
+            if e_start and e_end:
+                sessions.append((e_start, e_end))
+    return out
+
+
+# Расписание торгов по площадкам: раз в сутки, статус отвечаем локально
+calendar = TradingCalendar(_fetch_trading_schedules)
+
+
 def get_status_ticker(symbol):
-    with Client(TOKEN) as client:
+    """
+    Статус торгов по расписанию площадки; к брокеру (get_instrument_by) идём
+    только рядом с границей сессии или если расписания по площадке нет.
+    """
+    ins = registry.get(symbol)
+    exchange = ins.exchange if ins else ""
+    try:
+        if exchange and not calendar.near_transition(exchange):
+            if calendar.is_open(exchange):
+                return "NormalTrading", f"calendar:{exchange}:open"
+            return "NotAvailableforTrading", f"calendar:{exchange}:closed"
+    except Exception as e:
+        print(f"[calendar] {symbol}: {e} — спрашиваем статус у брокера")
+    return _get_status_ticker_rpc(symbol)
+
+
+# Ближайшая смена состояния торгов по тикеру (epoch) или None, если расписания нет
+def next_session_change(symbol):
+    ins = registry.get(symbol)
+    if not ins or not ins.exchange:
+        return None
+    return calendar.next_change(ins.exchange)
+
+
+def _get_status_ticker_rpc(symbol):
+    limiter.acquire("instruments")
+    with client_pool.client("instruments") as client:
         # Получаем статус торгов для инструмента
-        res = client.instruments.get_instrument_by(id=figi[symbol]["figi"], id_type=1).instrument.trading_status
+        res = client.instruments.get_instrument_by(id=registry.figi(symbol), id_type=1).instrument.trading_status
         if res.value == 5:
             return "NormalTrading", str(res)  # Если торги доступны
         return "NotAvailableforTrading", str(res)  # Если торги недоступны
 
 
 
-def _post_order_with_retry(symbol: str, quantity: int, direction: int, order_type: int,
-                           price=None, max_retries: int = 5, client_order_id: str | None = None):
-    # Проверка nano для лимиток
+def _classify_request_error(e) -> str | None:
+    """
+    Что делать с ошибкой постановки (общая логика для sync и async ретраев):
+    "ratelimit" — ждать сброса окна, "transient" — ретрай с backoff,
+    "duplicate" — заявка уже принята брокером, None — отдать ошибку наверх.
+    """
+    code = getattr(e, "code", None) or getattr(e, "status", None)
+    msg  = (getattr(e, "message", "") or str(e)).lower()
+    if code == StatusCode.RESOURCE_EXHAUSTED:
+        return "ratelimit"
+    if (code in _TRANSIENT_CODES) or any(s in msg for s in _TRANSIENT_MSGS):
+        return "transient"
+    if code == StatusCode.INVALID_ARGUMENT and ("duplicate" in msg or "30057" in msg):
+        return "duplicate"
+    return None
+
+
+def _backoff_delay(attempt: int) -> float:
+    return min(2 ** attempt, 16) + random.uniform(0, 0.3)
+
+
+def _check_limit_price(symbol: str, order_type: int, price):
+    """Проверка nano для лимиток (sync и async): кратность точности инструмента и согласованные знаки units/nano."""
     if order_type == 1 and isinstance(price, Quotation):
+        conv = quotation_converter(symbol)
+        if not conv.check(price):
+            raise ValueError(f"{symbol}: nano={price.nano} не кратен {conv.quant} для точности {conv.decimals} знаков")
+
 
-        if abs(price.nano) % scale != 0:
-            raise ValueError(f"{symbol}: nano={price.nano} не кратен {scale} для точности {decimals} знаков")
+def _post_order_with_retry(symbol: str, quantity: int, direction: int, order_type: int,
+                           price=None, max_retries: int = 5, client_order_id: str | None = None):
+    _check_limit_price(symbol, order_type, price)
 
     # Для MARKET цена не нужна
     if order_type == 2:
@@ -249,7 +379,8 @@ def _post_order_with_retry(symbol: str, quantity: int, direction: int, order_typ
     last_exc = None
     for attempt in range(max_retries):
         try:
-            with Client(TOKEN) as client:
+            limiter.acquire("orders")
+            with client_pool.client("orders") as client:
                 res = client.orders.post_order(
                     figi=figi[symbol]["figi"],
                     quantity=int(quantity),
@@ -261,35 +392,33 @@ def _post_order_with_retry(symbol: str, quantity: int, direction: int, order_typ
                     order_id=order_id,   # <— используется ровно то значение, что выше
                 )
             print(f"[post_order OK] order_id={order_id} status={res.execution_report_status.value}")
-            return order_const(res)
+            return _note_posted(symbol, order_const(res))
         except RequestError as e:
             last_exc = e
-            code = getattr(e, "code", None) or getattr(e, "status", None)
-            msg  = (getattr(e, "message", "") or str(e)).lower()
+            kind = _classify_request_error(e)
 
-            # сетевые/временные ошибки — ретраим
-            if (code in _TRANSIENT_CODES) or any(s in msg for s in _TRANSIENT_MSGS):
-                delay = min(2 ** attempt, 16) + random.uniform(0, 0.3)
-                print(f"[post_order RETRY {attempt+1}/{max_retries}] {code or ''}: {e}. sleep {delay:.2f}s")
-                time.sleep(delay)
+            # лимиты — bucket "orders" уже заблокирован пулом до сброса окна; ждать будет limiter.acquire на ретрае
+            if kind == "ratelimit":
+                print(f"[post_order RATELIMIT] ждём сброса окна {reset_after(e):.2f}s")
                 continue
 
-            # лимиты — подождать и снова
-            if "ratelimit" in msg or "resource_exhausted" in msg:
-                delay = 1.0 + attempt * 0.5
-                print(f"[post_order RATELIMIT] sleep {delay:.2f}s")
+            # сетевые/временные ошибки — ретраим
+            if kind == "transient":
+                delay = _backoff_delay(attempt)
+                code = getattr(e, "code", None) or getattr(e, "status", None)
+                print(f"[post_order RETRY {attempt+1}/{max_retries}] {code or ''}: {e}. sleep {delay:.2f}s")
                 time.sleep(delay)
                 continue
 
             # дубль: ордер уже принят брокером, но отчёт не вернулся
-            if code == StatusCode.INVALID_ARGUMENT and ("duplicate" in msg or "30057" in msg):
+            if kind == "duplicate":
                 try:
-                    with Client(TOKEN) as client:
+                    limiter.acquire("orders")
+                    with client_pool.client("orders") as client:
                         st = client.orders.get_order_state(account_id=account_id, order_id=order_id)
-                    return order_const(st)  # трактуем как успешное размещение
+                    return _note_posted(symbol, order_const(st))  # трактуем как успешное размещение
                 except Exception:
-                    delay = min(2 ** attempt, 16) + random.uniform(0, 0.3)
-                    time.sleep(delay)
+                    time.sleep(_backoff_delay(attempt))
                     continue
 
 
@@ -314,53 +443,228 @@ def short_limit(symbol, size, price, client_order_id=None):
     return _post_order_with_retry(symbol, size, direction=2, order_type=1, price=q, client_order_id=client_order_id)
 
 
+# Все активные заявки счёта одним запросом, разложенные по figi
+def _fetch_active_orders():
+    limiter.acquire("orders")
+    with client_pool.client("orders") as client:
+        res = client.orders.get_orders(account_id=account_id)
+    by_figi = {}
+    for order in res.orders:
+        by_figi.setdefault(order.figi, []).append(order_const(order))
+    return by_figi
+
+
+# Снимок активных заявок на цикл бота (по умолчанию выключен: max_age=0 — как раньше, запрос на каждый вызов)
+orders_snapshot = OrdersSnapshot(_fetch_active_orders)
+
+
+def begin_cycle():
+    """Начало цикла бота: следующие get_orders/get_portfolio скачают свежие снимки счёта."""
+    orders_snapshot.invalidate()
+    portfolio_cache.invalidate()
+    fill_resolver.invalidate()
+
+
+def _note_posted(symbol: str, order: dict) -> dict:
+    # живую заявку сразу кладём в снимок, исполненную/отклонённую — не трогаем
+    status = order.get("status")
+    if status in (4, 5):  # NEW / PARTIALLYFILL
+        orders_snapshot.add(registry.figi(symbol), order)
+    elif status not in (1, 2, 3):  # неизвестный статус — пусть снимок перекачается
+        orders_snapshot.invalidate()
+    if status in (1, 5):  # было исполнение — позиция изменилась
+        portfolio_cache.invalidate()
+    return order
+
+
+def _on_stream_trade(evt: dict):
+    # сделка по счёту: заявки и позиция изменились — снимки перечитаем при следующем запросе
+    orders_snapshot.invalidate()
+    portfolio_cache.invalidate()
+    fill_resolver.note_trade(evt["order_id"], [(_money_float(p), q) for p, q in evt.get("trades") or []],
+                             evt.get("trade_ids") or ())
+
+
+def start_stream(tickers=(), target: str | None = None) -> MarketStream:
+    """Запускает потоковые подписки (цены -> price_cache, сделки -> сброс снимков)."""
+    target = target or os.environ.get("TINKOFF_STREAM_TARGET") or None
+    return MarketStream(TOKEN, account_id, price_cache=price_cache,
+                        on_trade=_on_stream_trade, target=target).start(figis_for(tickers))
+
+
 # Получение списка ордеров для конкретного тикера
 def get_orders(symbol):
-    with Client(TOKEN) as client:
-        res = client.orders.get_orders(account_id=account_id)
-        orders = []
-        for order in res.orders:
-            if order.figi == figi[symbol]["figi"]:
-                orders.append(order_const(order))  # Возвращаем ордера только для нужного тикера
-        return orders
+    return orders_snapshot.for_figi(registry.figi(symbol))  # Возвращаем ордера только для нужного тикера
 
 
 # Получение статуса ордера по его ID
 def get_orders_state(order_id):
-    with Client(TOKEN) as client:
+    limiter.acquire("orders")
+    with client_pool.client("orders") as client:
         res = client.orders.get_order_state(account_id=account_id, order_id=order_id)
         return res.execution_report_status.value
 
 
+def _money_float(m) -> float:
+    return int(m.units) + int(m.nano) / 1e9
+
+
+def _money_points(figi: str, m) -> float:
+    """MoneyValue -> цена в пунктах инструмента (у фьючерсов пункт не равен рублю)."""
+    ins = registry.get(figi)
+    return ins.points(_money_float(m)) if ins else _money_float(m)
+
+
+def _fetch_operations(since_ts: float) -> list:
+    """
+    Исполненные покупки/продажи счёта с since_ts: GetOperationsByCursor, обычно одна страница.
+    Цена операции приходит в деньгах — переводим в пункты, как у лимитных цен заявок.
+    """
+    directions = {OperationType.OPERATION_TYPE_BUY: 1, OperationType.OPERATION_TYPE_SELL: 2}
+    out, cursor = [], ""
+    with client_pool.client("operations") as client:
+        while True:
+            limiter.acquire("operations")
+            res = client.operations.get_operations_by_cursor(GetOperationsByCursorRequest(
+                account_id=account_id,
+                from_=datetime.datetime.fromtimestamp(since_ts, tz=datetime.timezone.utc),
+                to=datetime.datetime.now(datetime.timezone.utc),
+                cursor=cursor,
+                limit=1000,
+                operation_types=list(directions),
+                state=OperationState.OPERATION_STATE_EXECUTED,
+                without_commissions=True,
+                without_trades=False,  # номера сделок — чтобы узнать уже учтённые потоком
+            ))
+            for it in res.items:
+                trades_info = getattr(it, "trades_info", None)
+                out.append({
+                    "id": it.id,
+                    "figi": it.figi,
+                    "direction": directions.get(it.type, 0),
+                    "qty": int(it.quantity_done or it.quantity),
+                    "price": _money_points(it.figi, it.price),
+                    "ts": it.date.timestamp(),
+                    "trade_ids": [str(t.num) for t in (trades_info.trades if trades_info else []) if t.num],
+                })
+            if not res.has_next:
+                return out
+            cursor = res.next_cursor
+
+
+def _get_order_fill_state(order_id):
+    """(статус, средняя цена исполнения или None, исполнено лотов) одной заявки — подтверждение для FillResolver."""
+    limiter.acquire("orders")
+    with client_pool.client("orders") as client:
+        res = client.orders.get_order_state(account_id=account_id, order_id=order_id)
+    status = res.execution_report_status.value
+    price = _money_points(res.figi, res.average_position_price) if status == 1 else None  # в пунктах
+    return status, price, int(res.lots_executed or 0)
+
+
+# Исполнения пропавших заявок: поток сделок, иначе статус заявки; лента операций (раз в цикл) — источник цены.
+# Сопоставленные операции хранятся в журнале ордеров и после перезапуска не достаются другой заявке.
+fill_resolver = FillResolver(_fetch_operations, _get_order_fill_state, store=order_journal.journal)
+
+
+def resolve_fills(symbol, orders) -> dict:
+    """
+    orders — [(order_id, direction, lots, limit_price, created_ts), ...] заявки тикера, которых больше нет
+    у брокера; created_ts — epoch создания заявки (misc.order_created_ts) или None.
+    Возвращает {order_id: {"status", "price", "source"}}; status как у get_orders_state.
+    """
+    ins = registry[symbol]
+    return fill_resolver.resolve(ins.figi, ins.lot, orders, tol=ins.step / 2)
+
+
+# Параллельная отмена пачки заявок: темп задаёт limiter, параллелизм — размер пула сессий
+def cancel_orders_bulk(order_ids, max_workers: int | None = None) -> dict:
+    """
+    Отменяет заявки конкурентно и возвращает исход по каждой (в исходном порядке):
+    {order_id: None} — отменена, {order_id: "текст ошибки"} — не удалось.
+    """
+    ids = list(dict.fromkeys(str(oid) for oid in order_ids))
+    results = {oid: None for oid in ids}
+    if not ids:
+        return results
+    workers = max(1, min(int(max_workers or API_POOL_SIZE), len(ids)))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(cancel_order, oid): oid for oid in ids}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as e:
+                results[futures[fut]] = str(e) or e.__class__.__name__
+    return results
+
+
 # Отмена всех ордеров для конкретного тикера
 def cancel_all_orders(symbol):
     orders = get_orders(symbol)
-    for order in orders:
-        try:
-            cancel_order(order["order_id"])  # Отмена каждого ордера
-            time.sleep(0.5)  # Задержка между запросами
-        except:
-            pass
+    return cancel_orders_bulk([order["order_id"] for order in orders])
 
 
 # Отмена конкретного ордера
 def cancel_order(order_id):
-    with Client(TOKEN) as client:
-        return client.orders.cancel_order(account_id=account_id, order_id=str(order_id))
+    limiter.acquire("orders")
+    with client_pool.client("orders") as client:
+        res = client.orders.cancel_order(account_id=account_id, order_id=str(order_id))
+    orders_snapshot.discard(order_id)
+    return res
 
 
 # Получение баланса для конкретного тикера
 def balance_ticker(symbol):
-    with Client(TOKEN) as client:
-        res = client.operations.get_portfolio(account_id=account_id)
-        for r in res.positions:
-            if r.figi == figi[symbol]["figi"]:
-                lot = convert_float(r.quantity_lots)
-                return lot
+    pos = get_position(symbol)
+    if pos:
+        return pos["lots"]
 
     return 0
 
 
+def _pos_float(p, name):
+    val = getattr(p, name, None)
+    try:
+        return float(convert_float(val) or 0) if val is not None else None
+    except Exception:
+        return None
+
+
+# Портфель одним get_portfolio, разложенный по figi
+def _fetch_portfolio():
+    limiter.acquire("operations")
+    with client_pool.client("operations") as client:
+        res = client.operations.get_portfolio(account_id=account_id)
+    positions = {}
+    for p in res.positions:
+        positions[p.figi] = {
+            "lots": _pos_float(p, "quantity_lots") or 0.0,               # лоты в портфеле
+            "avg_price": _pos_float(p, "average_position_price") or 0.0,  # средняя цена входа
+            "var_margin": _pos_float(p, "var_margin") or 0.0,            # вариационная маржа (фьючерсы)
+            "expected_yield": _pos_float(p, "expected_yield"),
+            "instrument_type": str(getattr(p, "instrument_type", "")).lower(),
+        }
+    return positions
+
+
+# Кэш портфеля на цикл бота (по умолчанию выключен, как и снимок заявок)
+portfolio_cache = CycleSnapshot(_fetch_portfolio)
+
+
+def get_portfolio_positions() -> dict:
+    """{figi: {lots, avg_price, var_margin, expected_yield, instrument_type}}"""
+    return portfolio_cache.get()
+
+
+def get_position(symbol) -> dict | None:
+    return get_portfolio_positions().get(registry.figi(symbol))
+
+
+def invalidate_portfolio():
+    """Вызываем при исполнении заявок — следующий запрос перечитает портфель."""
+    portfolio_cache.invalidate()
+
+
 # Продажа всех позиций по конкретному тикеру(дописать логику согласно шагов на продажу)
 def sell_all(ticker, market, side):
     lots = balance_ticker(ticker)
@@ -379,8 +683,8 @@ def set_price_step(symbol: str, price: float) -> float:
     Округляет цену к ближайшему кратному шагу инструмента и
     режет до нужного количества знаков после запятой.
     """
-    step = figi[symbol]["step"]
-    return round(round(float(price) / step) * step, int(digits))
+    g = ticks.grid_for(registry[symbol])
+    return ticks.from_nano(g.round_quant(g.snap(ticks.to_nano(price))))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+# Асинхронный аналог trading_api поверх AsyncClient SDK.
+# Одна долгоживущая сессия на каждый event loop (после UNAVAILABLE/CANCELLED — переподключение),
+# темп — через общий trading_api.limiter,
+# ретраи/идемпотентность — как в trading_api._post_order_with_retry.
+# Независимые вызовы по разным тикерам можно запускать параллельно через asyncio.gather.
+import asyncio
+from uuid import uuid4
+
+from grpc import StatusCode
+from tinkoff.invest import AsyncClient
+from tinkoff.invest.exceptions import RequestError
+
+import trading_api
+from config import TOKEN
+from rate_limit import reset_after
+
+
+# Как в ClientPool: после этих кодов сессию закрываем и на следующем вызове открываем заново
+_RECONNECT_CODES = {
+    StatusCode.UNAVAILABLE,
+    StatusCode.CANCELLED,
+}
+
+
+class _LoopSession:
+    """AsyncClient-сессия и её замок — свои у каждого event loop."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.cm = None
+        self.client = None
+
+
+_sessions = {}  # event loop -> _LoopSession
+
+
+def _loop_session() -> _LoopSession:
+    loop = asyncio.get_running_loop()
+    for old in [lp for lp in _sessions if lp.is_closed()]:
+        del _sessions[old]  # сессия закрытого loop (прошлый asyncio.run) больше непригодна
+    sess = _sessions.get(loop)
+    if sess is None:
+        sess = _sessions[loop] = _LoopSession()
+    return sess
+
+
+async def _services():
+    """Лениво открывает AsyncClient-сессию текущего event loop."""
+    sess = _loop_session()
+    async with sess.lock:
+        if sess.client is None:
+            sess.cm = AsyncClient(TOKEN)
+            sess.client = await sess.cm.__aenter__()
+    return sess.client
+
+
+async def _drop(client=None):
+    """Закрывает сессию текущего loop (если это всё ещё client, когда он задан)."""
+    sess = _loop_session()
+    async with sess.lock:
+        if sess.cm is None or (client is not None and sess.client is not client):
+            return
+        cm, sess.cm, sess.client = sess.cm, None, None
+    try:
+        await cm.__aexit__(None, None, None)
+    except Exception:
+        pass
+
+
+async def close():
+    await _drop()
+
+
+async def _limit(service: str):
+    wait = trading_api.limiter.reserve(service)
+    if wait > 0:
+        await asyncio.sleep(wait)
+
+
+async def _call(service: str, fn):
+    """
+    limiter -> сессия loop -> fn(client); сетевой сбой закрывает сессию для переподключения,
+    RESOURCE_EXHAUSTED блокирует bucket сервиса до сброса окна (как ClientPool.client).
+    """
+    await _limit(service)
+    client = await _services()
+    try:
+        return await fn(client)
+    except RequestError as e:
+        code = getattr(e, "code", None)
+        if code in _RECONNECT_CODES:
+            await _drop(client)
+        elif code == StatusCode.RESOURCE_EXHAUSTED:
+            trading_api.limiter.penalize(service, reset_after(e))
+        raise
+    except (ConnectionError, OSError):
+        await _drop(client)
+        raise
+
+
+# Все активные заявки счёта, разложенные по figi
+async def get_all_orders() -> dict:
+    res = await _call("orders", lambda client: client.orders.get_orders(account_id=trading_api.account_id))
+    by_figi = {}
+    for order in res.orders:
+        by_figi.setdefault(order.figi, []).append(trading_api.order_const(order))
+    return by_figi
+
+
+# Получение списка ордеров для конкретного тикера
+async def get_orders(symbol: str) -> list:
+    return (await get_all_orders()).get(trading_api.registry.figi(symbol), [])
+
+
+# Получение статуса ордера по его ID
+async def get_order_state(order_id: str) -> int:
+    res = await _call("orders", lambda client: client.orders.get_order_state(
+        account_id=trading_api.account_id, order_id=str(order_id)))
+    return res.execution_report_status.value
+
+
+# Отмена конкретного ордера
+async def cancel_order(order_id: str):
+    res = await _call("orders", lambda client: client.orders.cancel_order(
+        account_id=trading_api.account_id, order_id=str(order_id)))
+    trading_api.orders_snapshot.discard(order_id)
+    return res
+
+
+# Последние цены пачкой: {ticker: float}, заодно кладём Quotation в общий price_cache
+async def get_last_prices(tickers) -> dict:
+    tickers = [t for t in tickers if t in trading_api.registry]
+    if not tickers:
+        return {}
+    figis = trading_api.figis_for(tickers)
+    res = await _call("market_data", lambda client: client.market_data.get_last_prices(figi=figis))
+    out = {}
+    for lp in res.last_prices:
+        trading_api.price_cache.put(lp.figi, lp.price)
+        ticker = trading_api.registry.ticker_by_figi(lp.figi)
+        if ticker:
+            out[ticker] = trading_api.convert_float(lp.price)
+    return out
+
+
+async def post_order(symbol: str, quantity: int, direction: int, order_type: int,
+                     price=None, max_retries: int = 5, client_order_id: str | None = None) -> dict:
+    """То же, что trading_api._post_order_with_retry: один idempotency-key на все попытки."""
+    trading_api._check_limit_price(symbol, order_type, price)  # та же проверка Quotation, что и в sync
+    if order_type == 2:
+        price = None  # Для MARKET цена не нужна
+
+    order_id = trading_api._as_valid_uuid_or_none(client_order_id) or str(uuid4())
+    print(f"[post_order async] {symbol} qty={quantity} dir={direction} type={order_type} order_id={order_id}")
+
+    last_exc = None
+    for attempt in range(max_retries):
+        try:
+            res = await _call("orders", lambda client: client.orders.post_order(
+                figi=trading_api.registry.figi(symbol),
+                quantity=int(quantity),
+                direction=direction,
+                order_type=order_type,
+                account_id=trading_api.account_id,
+                price=price,
+                confirm_margin_trade=True,
+                order_id=order_id,
+            ))
+            print(f"[post_order async OK] order_id={order_id} status={res.execution_report_status.value}")
+            return trading_api._note_posted(symbol, trading_api.order_const(res))
+        except RequestError as e:
+            last_exc = e
+            kind = trading_api._classify_request_error(e)
+            if kind == "ratelimit":
+                continue  # _call уже заблокировал bucket "orders" до сброса окна
+            if kind == "transient":
+                await asyncio.sleep(trading_api._backoff_delay(attempt))
+                continue
+            if kind == "duplicate":
+                try:
+                    st = await _call("orders", lambda client: client.orders.get_order_state(
+                        account_id=trading_api.account_id, order_id=order_id))
+                    return trading_api._note_posted(symbol, trading_api.order_const(st))
+                except Exception:
+                    await asyncio.sleep(trading_api._backoff_delay(attempt))
+                    continue
+            raise
+    raise last_exc
+
+
+async def long_limit(symbol, size, price, client_order_id=None):
+    q = trading_api.get_price_quotation(symbol, price)
+    return await post_order(symbol, size, direction=1, order_type=1, price=q, client_order_id=client_order_id)
+
+
+async def short_limit(symbol, size, price, client_order_id=None):
+    q = trading_api.get_price_quotation(symbol, price)
+    return await post_order(symbol, size, direction=2, order_type=1, price=q, client_order_id=client_order_id)
+
+
+async def long_market(symbol, size, client_order_id=None):
+    return await post_order(symbol, size, direction=1, order_type=2, client_order_id=client_order_id)
+
+
+async def short_market(symbol, size, client_order_id=None):
+    return await post_order(symbol, size, direction=2, order_type=2, client_order_id=client_order_id)
@@ -0,0 +1,95 @@
+import bisect
+import threading
+import time
+
+
+class TradingCalendar:
+    """
+    Расписание торгов по биржам с кэшем в памяти: {exchange: [(start, end), ...]} (epoch, сек).
+
+    fetch(from_ts, to_ts) -> {exchange: [(start, end), ...]} — одна выгрузка trading_schedules
+    по всем биржам сразу; перекачиваем раз в refresh_sec и при смене суток.
+    is_open()/next_change() отвечают локально; near_transition() подсказывает, что до границы
+    сессии меньше guard_sec — там стоит перепроверить статус у брокера.
+    """
+
+    def __init__(self, fetch, days: int = 3, refresh_sec: float = 6 * 3600, guard_sec: float = 90.0):
+        self._fetch = fetch
+        self.days = int(days)
+        self.refresh_sec = float(refresh_sec)
+        self.guard_sec = float(guard_sec)
+        self._sessions = {}     # exchange -> отсортированный список (start, end)
+        self._starts = {}       # exchange -> [start, ...] для bisect
+        self._loaded_at = 0.0
+        self._loaded_day = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self.fetches = 0
+
+    def _ensure(self, now: float):
+        day = int(now // 86400)
+        if self._loaded_day == day and now - self._loaded_at < self.refresh_sec:
+            return
+        if now < self._retry_at:
+            return
+        with self._lock:
+            if self._loaded_day == day and now - self._loaded_at < self.refresh_sec:
+                return
+            try:
+                raw = self._fetch(day * 86400.0, (day + self.days) * 86400.0)
+            except Exception as e:
+                print(f"[calendar] не удалось загрузить расписание торгов: {e}")
+                self._retry_at = now + 300
+                return
+            sessions, starts = {}, {}
+            for exchange, items in raw.items():
+                merged = []
+                for start, end in sorted((float(s), float(e)) for s, e in items if s and e and e > s):
+                    if merged and start <= merged[-1][1]:
+                        merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                    else:
+                        merged.append((start, end))
+                sessions[exchange] = merged
+                starts[exchange] = [s for s, _ in merged]
+            self._sessions, self._starts = sessions, starts
+            self._loaded_at, self._loaded_day = now, day
+            self.fetches += 1
+
+    def known(self, exchange: str, now: float | None = None) -> bool:
+        self._ensure(time.time() if now is None else now)
+        return bool(self._sessions.get(exchange))
+
+    def _locate(self, exchange: str, now: float):
+        """(открыта ли сессия сейчас, ts ближайшей смены состояния или None)."""
+        sessions = self._sessions.get(exchange) or []
+        i = bisect.bisect_right(self._starts.get(exchange) or [], now) - 1
+        if i >= 0 and now < sessions[i][1]:
+            return True, sessions[i][1]
+        nxt = sessions[i + 1][0] if i + 1 < len(sessions) else None
+        return False, nxt
+
+    def is_open(self, exchange: str, now: float | None = None) -> bool | None:
+        """True/False по расписанию; None — по бирже расписания нет."""
+        now = time.time() if now is None else now
+        if not self.known(exchange, now):
+            return None
+        return self._locate(exchange, now)[0]
+
+    def next_change(self, exchange: str, now: float | None = None) -> float | None:
+        """Когда начнётся ближайший перерыв (если сессия открыта) или следующая сессия."""
+        now = time.time() if now is None else now
+        if not self.known(exchange, now):
+            return None
+        return self._locate(exchange, now)[1]
+
+    def near_transition(self, exchange: str, now: float | None = None) -> bool:
+        """True, если граница сессии ближе guard_sec в любую сторону (или расписания нет)."""
+        now = time.time() if now is None else now
+        if not self.known(exchange, now):
+            return True
+        sessions = self._sessions[exchange]
+        i = bisect.bisect_left(self._starts[exchange], now - self.guard_sec)
+        for start, end in sessions[max(0, i - 1):i + 2]:
+            if abs(start - now) < self.guard_sec or abs(end - now) < self.guard_sec:
+                return True
+        return False